@@ -2,7 +2,9 @@
 import os
 import logging
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Dict, Any
+from cachetools import TTLCache
+from cache_engine import invalidate_table
 from jose import JWTError, jwt
 from fastapi import Depends, HTTPException, Request
 from google.oauth2 import id_token
@@ -17,8 +19,54 @@ ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_DAYS = 30
 GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
 
+# Authenticated-user cache (keyed by user id). Every path that updates
+# `users` must call invalidate_user_cache so edits show up immediately
+# in this worker; other workers see them after at most USER_CACHE_TTL.
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "30"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "5000"))
+
+# Tokens carry a `tv` (token version) claim; bumping users.token_version
+# revokes every token issued before. Run once in the Supabase SQL editor:
+#   ALTER TABLE users ADD COLUMN IF NOT EXISTS token_version INTEGER DEFAULT 0;
+# Claims-only endpoints learn about a bump within TOKEN_VERSION_TTL
+# (immediately in the worker that handled the revocation).
+TOKEN_VERSION_TTL = int(os.getenv("TOKEN_VERSION_TTL", "300"))
+
 logging.basicConfig(level=logging.INFO)
 
+_user_cache: TTLCache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+_user_cache_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+_token_versions: TTLCache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=TOKEN_VERSION_TTL)
+
+
+def invalidate_user_cache(user_id: Optional[int] = None, email: Optional[str] = None):
+    """
+    Drop a cached user after writing to their `users` row (no args: drop
+    all). Also the `users` change event for cached responses.
+    """
+    if user_id is None and email is None:
+        _user_cache.clear()
+        invalidate_table('users')
+    elif user_id is not None:
+        _user_cache.pop(user_id, None)
+        invalidate_table('users', user_id)
+    else:
+        for key, user in list(_user_cache.items()):
+            if user.email == email:
+                _user_cache.pop(key, None)
+                invalidate_table('users', key)
+    _user_cache_stats["invalidations"] += 1
+
+
+def get_user_cache_stats() -> Dict[str, Any]:
+    hits, misses = _user_cache_stats["hits"], _user_cache_stats["misses"]
+    return {
+        **_user_cache_stats,
+        "size": len(_user_cache),
+        "ttl": USER_CACHE_TTL,
+        "hit_rate": hits / max(1, hits + misses) * 100
+    }
+
 
 def verify_google_token(token: str) -> dict:
     """Verify Google OAuth token and return user info"""
@@ -49,6 +97,11 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     return encoded_jwt
 
 
+def create_user_token(user_id: int, email: str, token_version: int = 0) -> str:
+    """Access token with the claims get_current_principal relies on"""
+    return create_access_token({"sub": email, "user_id": user_id, "tv": token_version or 0})
+
+
 def verify_access_token(token: str) -> dict:
     """Verify JWT access token and return payload"""
     try:
@@ -59,9 +112,19 @@ def verify_access_token(token: str) -> dict:
         raise HTTPException(status_code=401, detail="Invalid or expired token")
 
 
+def user_id_from_token(token: Optional[str]) -> Optional[int]:
+    """User id claim of a valid token, or None (quiet; used for rate-limit keys)"""
+    if not token:
+        return None
+    try:
+        return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]).get("user_id")
+    except JWTError:
+        return None
+
+
 async def get_current_user(request: Request):
     """Get current user from JWT token in cookie"""
-    from database import supabase
+    from database import request_loader
     from models import User
     
     # Get token from cookie
@@ -82,23 +145,43 @@ async def get_current_user(request: Request):
             logging.error("Token payload missing user_id and email")
             raise HTTPException(status_code=401, detail="Invalid token payload")
         
+        token_version = payload.get("tv", 0)
+        
+        if user_id:
+            user = _user_cache.get(user_id)
+            if user is not None:
+                _user_cache_stats["hits"] += 1
+                if token_version < user.token_version:
+                    raise HTTPException(status_code=401, detail="Token revoked")
+                return user
+            _user_cache_stats["misses"] += 1
+        
         # Fetch user from database
         try:
+            # Memoized for the request so handlers re-reading the row share it
             if user_id:
-                response = supabase.table('users').select('*').eq('id', user_id).single().execute()
+                user_row = await request_loader().select_one('users', {'id': user_id})
             else:
-                response = supabase.table('users').select('*').eq('email', email).single().execute()
+                user_row = await request_loader().select_one('users', {'email': email})
             
-            if not response.data:
+            if not user_row:
                 logging.error(f"User not found: user_id={user_id}, email={email}")
                 raise HTTPException(status_code=401, detail="User not found")
             
-            user = User.from_supabase(response.data)
-            return user
+            user = User.from_supabase(user_row)
+            if user_id:
+                _user_cache[user_id] = user
+                _token_versions[user_id] = user.token_version
             
+        except HTTPException:
+            raise
         except Exception as db_error:
             logging.error(f"Database error fetching user: {str(db_error)}")
             raise HTTPException(status_code=500, detail=f"Database error: {str(db_error)}")
+        
+        if token_version < user.token_version:
+            raise HTTPException(status_code=401, detail="Token revoked")
+        return user
             
     except HTTPException:
         raise
@@ -106,4 +189,77 @@ async def get_current_user(request: Request):
         logging.error(f"Error in get_current_user: {str(e)}")
         import traceback
         traceback.print_exc()
-        raise HTTPException(status_code=401, detail="Authentication failed")
\ No newline at end of file
+        raise HTTPException(status_code=401, detail="Authentication failed")
+
+
+async def _current_token_version(user_id: int) -> int:
+    """Latest token version for a user (cached; one slim read on miss)"""
+    from database import request_loader
+    
+    version = _token_versions.get(user_id)
+    if version is not None:
+        return version
+    
+    user = _user_cache.get(user_id)
+    if user is not None:
+        version = user.token_version
+    else:
+        row = await request_loader().select_one('users', {'id': user_id}, 'token_version')
+        if not row:
+            raise HTTPException(status_code=401, detail="User not found")
+        version = row.get('token_version') or 0
+    
+    _token_versions[user_id] = version
+    return version
+
+
+async def get_current_principal(request: Request):
+    """
+    Lightweight alternative to get_current_user for endpoints that only
+    need the user's id/email: trusts the verified JWT claims and skips
+    loading the user row.
+    """
+    from models import Principal
+    
+    token = request.cookies.get("access_token")
+    
+    if not token:
+        logging.warning("No access_token cookie found")
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    payload = verify_access_token(token)
+    user_id = payload.get("user_id")
+    
+    if not user_id:
+        # Legacy email-only tokens need the row lookup
+        user = await get_current_user(request)
+        return Principal(id=user.id, email=user.email, token_version=user.token_version)
+    
+    token_version = payload.get("tv", 0)
+    try:
+        if token_version < await _current_token_version(user_id):
+            raise HTTPException(status_code=401, detail="Token revoked")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error checking token version: {str(e)}")
+        raise HTTPException(status_code=401, detail="Authentication failed")
+    
+    return Principal(id=user_id, email=payload.get("sub", ""), token_version=token_version)
+
+
+async def revoke_user_tokens(user_id: int) -> int:
+    """Invalidate every token issued to a user so far; returns the new version"""
+    from database import supabase
+    
+    response = await supabase.table('users').select('token_version').eq(
+        'id', user_id
+    ).single().execute()
+    version = ((response.data or {}).get('token_version') or 0) + 1
+    
+    await supabase.table('users').update({'token_version': version}).eq('id', user_id).execute()
+    invalidate_user_cache(user_id)
+    _token_versions[user_id] = version
+    
+    logging.info(f"Revoked tokens for user {user_id} (token version {version})")
+    return version
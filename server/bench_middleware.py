@@ -0,0 +1,157 @@
+# server/bench_middleware.py
+"""
+Per-request overhead of the middleware stack on a trivial endpoint.
+
+Compares the pure ASGI middlewares in middleware.py against the same
+stack built on BaseHTTPMiddleware (how it was written before), both in
+the order main.py installs them, plus a bare app as the floor. Requests
+are driven in-process through httpx's ASGI transport, so no network or
+server is involved.
+
+    python bench_middleware.py [requests] [concurrency]
+"""
+import sys
+import time
+import asyncio
+import logging
+import httpx
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from starlette.middleware.base import BaseHTTPMiddleware
+import middleware
+
+# Per-request log lines would dominate the measurement
+logging.disable(logging.CRITICAL)
+
+
+# ---------- previous stack (BaseHTTPMiddleware) ----------
+
+class LegacyRateLimitMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request, call_next):
+        if request.url.path.startswith(middleware.RateLimitMiddleware.skip_paths):
+            return await call_next(request)
+        response = await call_next(request)
+        response.headers["X-RateLimit-Remaining"] = "0"
+        return response
+
+
+class LegacyLoggingMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request, call_next):
+        start_time = time.time()
+        response = await call_next(request)
+        duration = time.time() - start_time
+        logging.info(f"{request.method} {request.url.path} - {response.status_code} - {duration:.3f}s")
+        response.headers["X-Response-Time"] = f"{duration:.3f}s"
+        return response
+
+
+class LegacyErrorHandlingMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request, call_next):
+        try:
+            return await call_next(request)
+        except Exception:
+            raise
+
+
+class LegacySecurityHeadersMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request, call_next):
+        response = await call_next(request)
+        response.headers["X-Content-Type-Options"] = "nosniff"
+        response.headers["X-Frame-Options"] = "DENY"
+        response.headers["X-XSS-Protection"] = "1; mode=block"
+        response.headers["Referrer-Policy"] = "strict-origin-when-cross-origin"
+        return response
+
+
+class LegacyRequestLoaderMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request, call_next):
+        from database import begin_request_reads, end_request_reads, request_loader
+
+        token = begin_request_reads()
+        try:
+            request.state.loader = request_loader()
+            return await call_next(request)
+        finally:
+            end_request_reads(token)
+
+
+STACKS = {
+    "none": [],
+    "BaseHTTPMiddleware": [
+        LegacySecurityHeadersMiddleware,
+        LegacyErrorHandlingMiddleware,
+        LegacyLoggingMiddleware,
+        LegacyRateLimitMiddleware,
+        LegacyRequestLoaderMiddleware,
+    ],
+    "pure ASGI": [
+        middleware.SecurityHeadersMiddleware,
+        middleware.ErrorHandlingMiddleware,
+        middleware.LoggingMiddleware,
+        middleware.RateLimitMiddleware,
+        middleware.RequestLoaderMiddleware,
+    ],
+}
+
+
+def build_app(stack) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/health")
+    async def health():
+        return {"status": "healthy"}
+
+    @app.get("/stream")
+    async def stream():
+        async def chunks():
+            for i in range(3):
+                yield f"chunk {i}\n"
+                await asyncio.sleep(0)
+        return StreamingResponse(chunks(), media_type="text/plain")
+
+    for cls in stack:
+        app.add_middleware(cls)
+    return app
+
+
+async def run(name: str, stack, total: int, concurrency: int) -> float:
+    app = build_app(stack)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        # Streaming bodies must pass through intact
+        streamed = await client.get("/stream")
+        assert streamed.text == "chunk 0\nchunk 1\nchunk 2\n", f"{name}: stream mangled"
+
+        for _ in range(200):  # warm-up
+            await client.get("/health")
+
+        per_worker = total // concurrency
+
+        async def worker():
+            for _ in range(per_worker):
+                response = await client.get("/health")
+                assert response.status_code == 200
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    return elapsed / (per_worker * concurrency) * 1e6
+
+
+async def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    results = {}
+    for name, stack in STACKS.items():
+        results[name] = await run(name, stack, total, concurrency)
+
+    floor = results["none"]
+    print(f"GET /health x {total} (concurrency {concurrency})")
+    for name, per_request in results.items():
+        print(f"  {name:<20} {per_request:8.1f} us/request   (+{per_request - floor:.1f} us middleware)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
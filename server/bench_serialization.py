@@ -0,0 +1,116 @@
+# server/bench_serialization.py
+"""
+Serialization time of the large read payloads for a 100-day, 5-habit user.
+
+Compares FastAPI's default path for a returned dict (jsonable_encoder,
+then JSONResponse.render), validating through the response model first
+(what `response_model=` costs when the endpoint returns a dict), and
+responses.FastJSONResponse (orjson when installed, stdlib fallback).
+No database or server is involved.
+
+    python bench_serialization.py [iterations]
+"""
+import sys
+import time
+import random
+from datetime import date, datetime, timedelta
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+import responses
+from responses import FastJSONResponse
+from schemas import AnalysisResponse
+
+DAYS = 100
+HABITS = 5
+USER_ID = 1
+
+
+def build_payloads() -> dict:
+    random.seed(7)
+    start = date.today() - timedelta(days=DAYS - 1)
+    habits = [
+        {
+            "id": h, "user_id": USER_ID, "name": f"Habit {h}", "why": "Because it matters to me",
+            "time": "07:30", "created_at": datetime(2025, 1, 1, 8, 0).isoformat(),
+            "calendar_event_id": None
+        }
+        for h in range(1, HABITS + 1)
+    ]
+
+    thoughts, sleep_records, completions, checkins = [], [], [], []
+    for i in range(DAYS):
+        day = (start + timedelta(days=i)).isoformat()
+        done = {h["id"]: random.random() < 0.8 for h in habits}
+        completed = sum(done.values())
+        completions.append({
+            "date": day, "habits": done, "all_completed": completed == HABITS,
+            "completed_count": completed, "total_habits": HABITS
+        })
+        for habit_id, ok in done.items():
+            checkins.append({
+                "id": len(checkins) + 1, "user_id": USER_ID, "habit_id": habit_id,
+                "date": day, "completed": ok, "created_at": f"{day}T21:00:00"
+            })
+        thoughts.append({
+            "id": i + 1, "user_id": USER_ID, "date": day,
+            "thought": "Today I noticed that small wins compound into momentum. " * 3,
+            "created_at": f"{day}T22:00:00", "updated_at": f"{day}T22:05:00"
+        })
+        sleep_records.append({
+            "id": i + 1, "user_id": USER_ID, "date": day, "sleep_time": "23:15",
+            "wake_time": "06:45", "sleep_hours": 7.5, "created_at": f"{day}T07:00:00",
+            "updated_at": None
+        })
+
+    monthly = {
+        "thoughts": thoughts, "sleep_records": sleep_records, "habit_completions": completions,
+        "habits": habits, "month": start.month, "year": start.year, "days_in_month": DAYS
+    }
+    insights = {
+        "current_streak": 12, "total_completed_days": 61, "total_habits": HABITS,
+        "habit_stats": [
+            {"name": h["name"], "completed_count": 80, "completion_rate": 80.0} for h in habits
+        ],
+        "total_thoughts": DAYS, "total_sleep_records": DAYS, "average_sleep": 7.5,
+        "weekly_data": completions[-7:], "weekly_sleep": sleep_records[-7:]
+    }
+    export = {
+        "exported_at": datetime.now().isoformat(), "habits": habits, "checkins": checkins,
+        "thoughts": thoughts, "sleep_records": sleep_records
+    }
+    return {
+        "/analysis/monthly": monthly,
+        "/insights": insights,
+        "/daily-thoughts": thoughts,
+        "/sleep-records": sleep_records,
+        "/analytics/export": export,
+    }
+
+
+def timed(fn, iterations: int) -> float:
+    fn()  # warm-up
+    started = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - started) / iterations * 1000
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    payloads = build_payloads()
+    encoder = "orjson" if responses.orjson is not None else "stdlib json"
+
+    print(f"{DAYS} days x {HABITS} habits, {iterations} iterations, FastJSONResponse uses {encoder}")
+    print(f"  {'route':<20} {'bytes':>8} {'default ms':>11} {'validated ms':>13} {'fast ms':>9} {'speed-up':>9}")
+    for route, payload in payloads.items():
+        size = len(FastJSONResponse(payload).body)
+        default = timed(lambda: JSONResponse(jsonable_encoder(payload)).body, iterations)
+        fast = timed(lambda: FastJSONResponse(payload).body, iterations)
+        validated = "-"
+        if route == "/analysis/monthly":
+            validated = f"{timed(lambda: JSONResponse(jsonable_encoder(AnalysisResponse.model_validate(payload))).body, iterations):.3f}"
+        print(f"  {route:<20} {size:>8} {default:>11.3f} {validated:>13} {fast:>9.3f} {default / fast:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
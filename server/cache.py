@@ -1,16 +1,16 @@
 # server/cache.py
 import json
 import logging
-from datetime import datetime, timedelta
-from typing import Any, Optional
+from typing import Any, Iterable, Optional
 from functools import wraps
 import hashlib
+from cache_engine import cache_engine
+from cache_tiers import tiered_cache
 
 logging.basicConfig(level=logging.INFO)
 
-# Simple in-memory cache (use Redis in production)
-_cache = {}
-_cache_ttl = {}
+# Thin shim over the shared cache engine (namespace "app")
+CACHE_NAMESPACE = "app"
 
 
 def cache_key(*args, **kwargs) -> str:
@@ -20,57 +20,34 @@ def cache_key(*args, **kwargs) -> str:
 
 
 def get_cache(key: str) -> Optional[Any]:
-    """Get value from cache"""
-    if key in _cache:
-        if datetime.now() < _cache_ttl.get(key, datetime.min):
-            return _cache[key]
-        else:
-            # Expired
-            del _cache[key]
-            del _cache_ttl[key]
-    return None
+    """Get value from this worker's cache (the decorator also reads the shared tier)"""
+    return cache_engine.get(key, namespace=CACHE_NAMESPACE)
 
 
-def set_cache(key: str, value: Any, ttl_seconds: int = 300):
+def set_cache(key: str, value: Any, ttl_seconds: int = 300, tags: Iterable[str] = ()):
     """Set value in cache"""
-    _cache[key] = value
-    _cache_ttl[key] = datetime.now() + timedelta(seconds=ttl_seconds)
+    cache_engine.set(key, value, ttl=ttl_seconds, namespace=CACHE_NAMESPACE, tags=tags)
 
 
 def invalidate_cache(pattern: str = None):
-    """Invalidate cache entries"""
+    """Invalidate cache entries (prefer cache_engine.invalidate_tag for hot paths)"""
     if pattern:
-        keys_to_delete = [k for k in _cache.keys() if pattern in k]
-        for k in keys_to_delete:
-            del _cache[k]
-            if k in _cache_ttl:
-                del _cache_ttl[k]
+        cache_engine.delete_matching(lambda k: pattern in k, namespace=CACHE_NAMESPACE)
     else:
-        _cache.clear()
-        _cache_ttl.clear()
+        cache_engine.clear(CACHE_NAMESPACE)
 
 
-def cached(ttl_seconds: int = 300, key_prefix: str = ""):
-    """Decorator for caching function results"""
+def cached(ttl_seconds: int = 300, key_prefix: str = "", stale_ttl: int = 0):
+    """Decorator for caching function results (single flight, optional stale-while-revalidate)"""
     def decorator(func):
         @wraps(func)
         async def wrapper(*args, **kwargs):
             # Generate cache key
             key = f"{key_prefix}:{func.__name__}:{cache_key(*args, **kwargs)}"
             
-            # Check cache
-            cached_value = get_cache(key)
-            if cached_value is not None:
-                logging.debug(f"Cache hit: {key}")
-                return cached_value
-            
-            # Call function
-            result = await func(*args, **kwargs)
-            
-            # Cache result
-            set_cache(key, result, ttl_seconds)
-            logging.debug(f"Cache set: {key}")
-            
-            return result
+            return await tiered_cache.get_or_compute(
+                key, lambda: func(*args, **kwargs),
+                ttl=ttl_seconds, namespace=CACHE_NAMESPACE, stale_ttl=stale_ttl
+            )
         return wrapper
-    return decorator
\ No newline at end of file
+    return decorator
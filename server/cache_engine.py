@@ -0,0 +1,283 @@
+# server/cache_engine.py
+import os
+import time
+import pickle
+import sys
+import logging
+from collections import OrderedDict, defaultdict
+from typing import Any, Callable, Dict, Iterable, Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO)
+
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "5000"))
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+CACHE_DEFAULT_TTL = int(os.getenv("CACHE_DEFAULT_TTL", "300"))
+# Tag generations kept before the ones no entry references are dropped
+CACHE_MAX_GENERATIONS = int(os.getenv("CACHE_MAX_GENERATIONS", "20000"))
+
+
+def _namespace_tag(namespace: str) -> str:
+    return f"ns:{namespace}"
+
+
+def estimate_size(value: Any) -> int:
+    """Approximate memory cost of a cached value in bytes"""
+    try:
+        return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return sys.getsizeof(value)
+
+
+class _Entry:
+    __slots__ = ("value", "expires_at", "size", "namespace", "tags")
+
+    def __init__(self, value, expires_at, size, namespace, tags):
+        self.value = value
+        self.expires_at = expires_at
+        self.size = size
+        self.namespace = namespace
+        self.tags = tags  # ((tag, generation), ...)
+
+
+class CacheEngine:
+    """
+    In-process cache with per-entry TTL, LRU eviction bounded by entry
+    count and approximate bytes, and O(1) invalidation by tag.
+
+    Every entry is stored with the generation of each of its tags (and of
+    its namespace). `invalidate_tag` just bumps a counter; entries holding
+    an older generation are treated as misses and dropped lazily.
+    Generations of tags that no entry references any more are dropped
+    once there are more than `max_generations` of them; an unknown tag
+    reads as generation 0.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = CACHE_MAX_ENTRIES,
+        max_bytes: int = CACHE_MAX_BYTES,
+        default_ttl: int = CACHE_DEFAULT_TTL,
+        max_generations: int = CACHE_MAX_GENERATIONS,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._generations: Dict[str, int] = {}
+        self.max_generations = max_generations
+        self._generation_limit = max_generations
+        self.compactions = 0
+        self._bytes = 0
+        self._invalidation_listeners: list = []
+        self._compaction_listeners: list = []
+        self._stats: Dict[str, Dict[str, int]] = defaultdict(
+            lambda: {"hits": 0, "misses": 0, "sets": 0, "evictions": 0, "expired": 0, "invalidated": 0}
+        )
+
+    @staticmethod
+    def _full_key(namespace: str, key: str) -> str:
+        return f"{namespace}\x1f{key}"
+
+    # ---------- reads / writes ----------
+
+    def get(self, key: str, namespace: str = "default") -> Optional[Any]:
+        full_key = self._full_key(namespace, key)
+        stats = self._stats[namespace]
+        entry = self._entries.get(full_key)
+
+        if entry is None:
+            stats["misses"] += 1
+            return None
+
+        if entry.expires_at <= time.monotonic():
+            self._remove(full_key)
+            stats["expired"] += 1
+            stats["misses"] += 1
+            return None
+
+        if not self.is_current(entry.tags):
+            self._remove(full_key)
+            stats["invalidated"] += 1
+            stats["misses"] += 1
+            return None
+
+        self._entries.move_to_end(full_key)
+        stats["hits"] += 1
+        return entry.value
+
+    def set(
+        self,
+        key: str,
+        value: Any,
+        ttl: Optional[float] = None,
+        namespace: str = "default",
+        tags: Iterable[str] = (),
+        size: Optional[int] = None,
+    ) -> None:
+        full_key = self._full_key(namespace, key)
+        if full_key in self._entries:
+            self._remove(full_key)
+
+        size = size if size is not None else estimate_size(value)
+        if size > self.max_bytes:
+            logging.warning(f"Cache value for {namespace}:{key} too large ({size} bytes), not cached")
+            return
+
+        entry = _Entry(
+            value=value,
+            expires_at=time.monotonic() + (ttl if ttl is not None else self.default_ttl),
+            size=size,
+            namespace=namespace,
+            tags=self.snapshot(tags, namespace),
+        )
+        self._entries[full_key] = entry
+        self._bytes += size
+        self._stats[namespace]["sets"] += 1
+        self._evict()
+
+    def delete(self, key: str, namespace: str = "default") -> None:
+        full_key = self._full_key(namespace, key)
+        if full_key in self._entries:
+            self._remove(full_key)
+
+    # ---------- invalidation ----------
+
+    def invalidate_tag(self, *tags: str) -> None:
+        """Invalidate every entry carrying any of `tags` (O(1) per tag)"""
+        for tag in tags:
+            self._generations[tag] = self._generations.get(tag, 0) + 1
+        self._maybe_compact()
+        for listener in self._invalidation_listeners:
+            listener(tags)
+
+    def clear(self, namespace: Optional[str] = None) -> None:
+        if namespace is None:
+            self._entries.clear()
+            self._bytes = 0
+            self.invalidate_tag(*(_namespace_tag(ns) for ns in list(self._stats)))
+        else:
+            self.invalidate_tag(_namespace_tag(namespace))
+
+    def add_invalidation_listener(self, listener: Callable[[tuple], None]) -> None:
+        """Call `listener(tags)` after every local invalidation (cross-worker fan-out)"""
+        self._invalidation_listeners.append(listener)
+
+    def observe_generation(self, tag: str, generation: int) -> None:
+        """Adopt a generation seen elsewhere (another worker); never moves backwards"""
+        if generation > self._generations.get(tag, 0):
+            self._generations[tag] = generation
+            self._maybe_compact()
+
+    def add_compaction_listener(self, listener: Callable[[set], None]) -> None:
+        """Call `listener(live_tags)` after generations were dropped (see _compact)"""
+        self._compaction_listeners.append(listener)
+
+    def snapshot(self, tags: Iterable[str], namespace: str = "default") -> tuple:
+        """((tag, generation), ...) for an entry's tags, namespace tag included"""
+        return tuple(
+            (tag, self._generations.get(tag, 0)) for tag in (_namespace_tag(namespace), *tags)
+        )
+
+    def generations(self, tags: Iterable[str]) -> tuple:
+        return tuple(self._generations.get(tag, 0) for tag in tags)
+
+    def is_current(self, snapshot: Iterable[tuple]) -> bool:
+        return all(self._generations.get(tag, 0) == generation for tag, generation in snapshot)
+
+    def delete_matching(self, predicate: Callable[[str], bool], namespace: str = "default") -> int:
+        """Linear scan delete by key predicate (legacy pattern invalidation)"""
+        prefix = self._full_key(namespace, "")
+        doomed = [
+            k for k in self._entries
+            if k.startswith(prefix) and predicate(k[len(prefix):])
+        ]
+        for full_key in doomed:
+            self._remove(full_key)
+        return len(doomed)
+
+    # ---------- internals ----------
+
+    def _remove(self, full_key: str) -> None:
+        entry = self._entries.pop(full_key)
+        self._bytes -= entry.size
+
+    def _maybe_compact(self) -> None:
+        if len(self._generations) > self._generation_limit:
+            self._compact()
+
+    def _compact(self) -> None:
+        """
+        Drop the generations of tags no stored entry carries. Nothing holds
+        their current value, so restarting them from 0 can't make an entry
+        current again; snapshots taken before and checked after an await
+        must compare `compactions` too (TieredCache.set).
+        """
+        live = {tag for entry in self._entries.values() for tag, _ in entry.tags}
+        self._generations = {
+            tag: generation for tag, generation in self._generations.items() if tag in live
+        }
+        # Referenced tags alone may exceed the limit: don't rescan every call
+        self._generation_limit = max(self.max_generations, 2 * len(self._generations))
+        self.compactions += 1
+        for listener in self._compaction_listeners:
+            try:
+                listener(live)
+            except Exception as e:
+                logging.error(f"Error in compaction listener: {str(e)}")
+
+    def _evict(self) -> None:
+        while self._entries and (
+            len(self._entries) > self.max_entries or self._bytes > self.max_bytes
+        ):
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.size
+            self._stats[entry.namespace]["evictions"] += 1
+
+    # ---------- stats ----------
+
+    def get_stats(self) -> Dict[str, Any]:
+        namespaces = {}
+        for namespace, stats in self._stats.items():
+            lookups = stats["hits"] + stats["misses"]
+            namespaces[namespace] = {
+                **stats,
+                "hit_rate": stats["hits"] / max(1, lookups) * 100
+            }
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "generations": len(self._generations),
+            "generation_compactions": self.compactions,
+            "namespaces": namespaces
+        }
+
+
+# Singleton instance shared by cache.py and middleware.py (L1 of cache_tiers)
+cache_engine = CacheEngine()
+
+
+# ============================================
+# TABLE DEPENDENCIES
+# ============================================
+
+def table_tags(tables: Iterable[str], user_id: Optional[int] = None) -> list:
+    """Tags for an entry derived from `tables` (optionally scoped to one user)"""
+    tags = []
+    for table in tables:
+        tags.append(f"table:{table}")
+        if user_id is not None:
+            tags.append(f"table:{table}:user:{user_id}")
+    return tags
+
+
+def invalidate_table(table: str, user_id: Optional[int] = None) -> None:
+    """Change event: evict entries derived from `table` (one user's, or everyone's)"""
+    if user_id is None:
+        cache_engine.invalidate_tag(f"table:{table}")
+    else:
+        cache_engine.invalidate_tag(f"table:{table}:user:{user_id}")
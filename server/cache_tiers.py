@@ -0,0 +1,584 @@
+# server/cache_tiers.py
+import os
+import time
+import json
+import math
+import uuid
+import pickle
+import random
+import asyncio
+import logging
+from collections import defaultdict
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+from dotenv import load_dotenv
+from cache_engine import CacheEngine, cache_engine
+
+try:
+    from redis import asyncio as redis_asyncio  # redis>=4.2
+except ImportError:
+    redis_asyncio = None
+
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO)
+
+# Shared L2 behind the in-process cache engine (L1).
+#   CACHE_L2_URL=                      -> L1 only (default)
+#   CACHE_L2_URL=redis://host:6379/0   -> Redis (or anything speaking its protocol)
+#   CACHE_L2_URL=local://              -> in-process stand-in, for tests / single worker
+CACHE_L2_URL = os.getenv("CACHE_L2_URL", "")
+CACHE_L2_PREFIX = os.getenv("CACHE_L2_PREFIX", "sankalp:cache")
+CACHE_L2_TIMEOUT = float(os.getenv("CACHE_L2_TIMEOUT", "0.25"))
+# Generation counters outlive every entry by a wide margin, and a recreated
+# counter starts from the current time in microseconds, so it never repeats
+# a value handed out before (entries and ETags stay unambiguous)
+CACHE_GENERATION_TTL = int(os.getenv("CACHE_GENERATION_TTL", "86400"))
+# Early refresh aggressiveness (XFetch beta): >1 refreshes sooner, 0 disables
+CACHE_EARLY_REFRESH_BETA = float(os.getenv("CACHE_EARLY_REFRESH_BETA", "1.0"))
+
+
+# ============================================
+# L2 BACKENDS
+# ============================================
+
+def _counter_seed() -> int:
+    return int(time.time() * 1_000_000)
+
+
+class LocalL2:
+    """
+    In-process stand-in for the shared tier with the same semantics as
+    RedisL2. State is shared by every instance in the process, so two
+    TieredCache objects behave like two workers against one server.
+    """
+
+    _store: Dict[str, Tuple[bytes, float]] = {}
+    _subscribers: Dict[str, List[asyncio.Queue]] = defaultdict(list)
+
+    name = "local"
+
+    def _live(self, key: str) -> Optional[bytes]:
+        item = self._store.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at <= time.time():
+            self._store.pop(key, None)
+            return None
+        return value
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return self._live(key)
+
+    async def mget(self, keys: List[str]) -> List[Optional[bytes]]:
+        return [self._live(key) for key in keys]
+
+    async def set(self, key: str, value: bytes, ttl: float) -> None:
+        self._store[key] = (value, time.time() + ttl)
+
+    async def delete(self, key: str) -> None:
+        self._store.pop(key, None)
+
+    async def keys(self, prefix: str) -> List[str]:
+        return [key for key in list(self._store) if key.startswith(prefix) and self._live(key) is not None]
+
+    async def incr(self, key: str, ttl: int) -> int:
+        value = int(self._live(key) or _counter_seed()) + 1
+        self._store[key] = (str(value).encode(), time.time() + ttl)
+        return value
+
+    async def publish(self, channel: str, message: str) -> None:
+        for queue in list(self._subscribers[channel]):
+            queue.put_nowait(message)
+
+    async def subscribe(self, channel: str) -> AsyncIterator[str]:
+        queue: asyncio.Queue = asyncio.Queue()
+        self._subscribers[channel].append(queue)
+        try:
+            yield None  # subscribed
+            while True:
+                yield await queue.get()
+        finally:
+            self._subscribers[channel].remove(queue)
+
+    async def close(self) -> None:
+        pass
+
+
+class RedisL2:
+    """Shared tier on any server speaking the Redis protocol"""
+
+    name = "redis"
+
+    def __init__(self, url: str):
+        self.client = redis_asyncio.from_url(url)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self.client.get(key)
+
+    async def mget(self, keys: List[str]) -> List[Optional[bytes]]:
+        return await self.client.mget(keys)
+
+    async def set(self, key: str, value: bytes, ttl: float) -> None:
+        await self.client.set(key, value, ex=max(1, int(ttl)))
+
+    async def delete(self, key: str) -> None:
+        await self.client.delete(key)
+
+    async def keys(self, prefix: str) -> List[str]:
+        return [
+            key.decode() if isinstance(key, bytes) else key
+            async for key in self.client.scan_iter(match=f"{prefix}*")
+        ]
+
+    async def incr(self, key: str, ttl: int) -> int:
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.set(key, _counter_seed(), nx=True, ex=ttl)
+            pipe.incr(key)
+            pipe.expire(key, ttl)
+            _, value, _ = await pipe.execute()
+        return int(value)
+
+    async def publish(self, channel: str, message: str) -> None:
+        await self.client.publish(channel, message)
+
+    async def subscribe(self, channel: str) -> AsyncIterator[str]:
+        pubsub = self.client.pubsub()
+        await pubsub.subscribe(channel)
+        try:
+            yield None  # subscribed
+            async for message in pubsub.listen():
+                if message.get("type") != "message":
+                    continue
+                data = message["data"]
+                yield data.decode() if isinstance(data, bytes) else data
+        finally:
+            await pubsub.unsubscribe(channel)
+            await pubsub.close()
+
+    async def close(self) -> None:
+        await self.client.close()
+
+
+def l2_from_url(url: str):
+    """Build the L2 backend for CACHE_L2_URL (None = L1 only)"""
+    if not url:
+        return None
+    if url.startswith("local://"):
+        return LocalL2()
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        if redis_asyncio is None:
+            logging.error("CACHE_L2_URL is set but no redis client is installed, running L1 only")
+            return None
+        return RedisL2(url)
+    logging.error(f"Unsupported CACHE_L2_URL scheme: {url.split('://')[0]}, running L1 only")
+    return None
+
+
+# ============================================
+# TWO-TIER CACHE
+# ============================================
+
+_skip_store: ContextVar[bool] = ContextVar("cache_skip_store", default=False)
+
+
+def dont_cache():
+    """Call from a cached function's fallback path so its result isn't stored"""
+    _skip_store.set(True)
+
+
+class _Fresh:
+    """A get_or_compute value with its freshness deadline and compute time"""
+    __slots__ = ("value", "fresh_until", "delta")
+
+    def __init__(self, value, fresh_until, delta):
+        self.value = value
+        self.fresh_until = fresh_until
+        self.delta = delta
+
+    def __getstate__(self):
+        return (self.value, self.fresh_until, self.delta)
+
+    def __setstate__(self, state):
+        self.value, self.fresh_until, self.delta = state
+
+
+class _TierStats:
+    __slots__ = ("hits", "misses", "errors", "calls", "total_ms", "max_ms")
+
+    def __init__(self):
+        self.hits = self.misses = self.errors = self.calls = 0
+        self.total_ms = self.max_ms = 0.0
+
+    def observe(self, started: float) -> None:
+        elapsed = (time.perf_counter() - started) * 1000
+        self.calls += 1
+        self.total_ms += elapsed
+        self.max_ms = max(self.max_ms, elapsed)
+
+    def as_dict(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+            "hit_rate": self.hits / max(1, lookups) * 100,
+            "avg_ms": round(self.total_ms / max(1, self.calls), 3),
+            "max_ms": round(self.max_ms, 3)
+        }
+
+
+class TieredCache:
+    """
+    L1 (this worker's CacheEngine) in front of a shared L2.
+
+    L2 entries carry the same (tag, generation) snapshot as L1 entries.
+    Tag generations live in L2 as counters: a local invalidation bumps the
+    counter and publishes the new value, and every worker adopts it into
+    its L1, so one write evicts the dependent entries in all workers.
+    """
+
+    def __init__(self, l1: CacheEngine, l2=None, prefix: str = CACHE_L2_PREFIX):
+        self.l1 = l1
+        self.l2 = l2
+        self.prefix = prefix
+        self.channel = f"{prefix}:invalidate"
+        self.instance_id = uuid.uuid4().hex
+        # Generations are only comparable within one worker unless shared via L2
+        self.epoch = "l2" if l2 is not None else self.instance_id
+        self._synced: set = set()  # tags whose generation was read from L2
+        self._pending: set = set()
+        self._listener: Optional[asyncio.Task] = None
+        self._l1_stats = _TierStats()
+        self._l2_stats = _TierStats()
+        self._published = 0
+        self._received = 0
+        self._inflight: Dict[Tuple[str, str], asyncio.Task] = {}
+        self._remote_listeners: list = []
+        self._stampede = {"computes": 0, "coalesced": 0, "early_refreshes": 0, "stale_served": 0, "refresh_errors": 0}
+        if l2 is not None:
+            l1.add_invalidation_listener(self._on_local_invalidation)
+            l1.add_compaction_listener(self._on_compaction)
+
+    def _l2_key(self, namespace: str, key: str) -> str:
+        return f"{self.prefix}:{namespace}:{key}"
+
+    def _generation_key(self, tag: str) -> str:
+        return f"{self.prefix}:gen:{tag}"
+
+    # ---------- reads / writes ----------
+
+    async def get(self, key: str, namespace: str = "default") -> Optional[Any]:
+        started = time.perf_counter()
+        value = self.l1.get(key, namespace=namespace)
+        self._l1_stats.observe(started)
+        if value is not None:
+            self._l1_stats.hits += 1
+            return value
+        self._l1_stats.misses += 1
+
+        if self.l2 is None:
+            return None
+
+        started = time.perf_counter()
+        try:
+            raw = await asyncio.wait_for(self.l2.get(self._l2_key(namespace, key)), CACHE_L2_TIMEOUT)
+            value = None
+            if raw is not None:
+                value, snapshot, expires_at = pickle.loads(raw)
+                await self._sync_generations(tag for tag, _ in snapshot)
+                remaining = expires_at - time.time()
+                if remaining <= 0 or not self.l1.is_current(snapshot):
+                    value = None
+                else:
+                    tags = [tag for tag, _ in snapshot[1:]]  # namespace tag is implicit in L1
+                    self.l1.set(key, value, ttl=remaining, namespace=namespace, tags=tags)
+        except Exception as e:
+            self._l2_stats.errors += 1
+            logging.warning(f"L2 cache get failed for {namespace}:{key}: {str(e)}")
+            value = None
+        finally:
+            self._l2_stats.observe(started)
+
+        if value is None:
+            self._l2_stats.misses += 1
+        else:
+            self._l2_stats.hits += 1
+        return value
+
+    async def set(
+        self,
+        key: str,
+        value: Any,
+        ttl: Optional[float] = None,
+        namespace: str = "default",
+        tags: Iterable[str] = ()
+    ) -> None:
+        tags = list(tags)
+        ttl = ttl if ttl is not None else self.l1.default_ttl
+
+        if self.l2 is None:
+            self.l1.set(key, value, ttl=ttl, namespace=namespace, tags=tags)
+            return
+
+        started = time.perf_counter()
+        try:
+            compactions = self.l1.compactions
+            snapshot = self.l1.snapshot(tags, namespace)
+            await self._sync_generations(tag for tag, _ in snapshot)
+            # Generations adopted from L2 since the snapshot mean the value may
+            # predate an invalidation elsewhere: keep it out of both tiers.
+            # A compaction meanwhile may have reset a tag the snapshot holds.
+            if self.l1.compactions != compactions or not self.l1.is_current(snapshot):
+                return
+            self.l1.set(key, value, ttl=ttl, namespace=namespace, tags=tags)
+            payload = pickle.dumps((value, snapshot, time.time() + ttl), protocol=pickle.HIGHEST_PROTOCOL)
+            await asyncio.wait_for(
+                self.l2.set(self._l2_key(namespace, key), payload, ttl), CACHE_L2_TIMEOUT
+            )
+        except Exception as e:
+            self._l2_stats.errors += 1
+            logging.warning(f"L2 cache set failed for {namespace}:{key}: {str(e)}")
+        finally:
+            self._l2_stats.observe(started)
+
+    async def delete(self, key: str, namespace: str = "default") -> None:
+        self.l1.delete(key, namespace=namespace)
+        if self.l2 is not None:
+            try:
+                await self.l2.delete(self._l2_key(namespace, key))
+            except Exception as e:
+                self._l2_stats.errors += 1
+                logging.warning(f"L2 cache delete failed for {namespace}:{key}: {str(e)}")
+
+    # ---------- read-through ----------
+
+    async def get_or_compute(
+        self,
+        key: str,
+        compute: Callable[[], Awaitable[Any]],
+        ttl: Optional[float] = None,
+        namespace: str = "default",
+        tags: Iterable[str] = (),
+        stale_ttl: float = 0,
+        early_refresh: bool = True
+    ) -> Any:
+        """
+        Cached `await compute()` with stampede protection:
+        - concurrent misses on a key in this worker share one computation
+        - a fresh value is refreshed in the background with rising
+          probability as it nears expiry (XFetch: delta * beta * -ln(rand))
+        - for `stale_ttl` seconds after expiry the old value is still
+          served while a single background task recomputes it
+        None results and results flagged with dont_cache() are not stored.
+        """
+        ttl = ttl if ttl is not None else self.l1.default_ttl
+        tags = list(tags)
+        args = (key, compute, ttl, namespace, tags, stale_ttl)
+
+        entry = await self.get(key, namespace)
+        if isinstance(entry, _Fresh):
+            now = time.time()
+            if now >= entry.fresh_until:
+                self._stampede["stale_served"] += 1
+                self._refresh_in_background(*args)
+            elif early_refresh and CACHE_EARLY_REFRESH_BETA > 0 and (
+                now - entry.delta * CACHE_EARLY_REFRESH_BETA * math.log(1.0 - random.random())
+                >= entry.fresh_until
+            ):
+                self._stampede["early_refreshes"] += 1
+                self._refresh_in_background(*args)
+            return entry.value
+
+        return await asyncio.shield(self._flight(*args))
+
+    def _flight(self, key, compute, ttl, namespace, tags, stale_ttl) -> asyncio.Task:
+        """The in-flight computation for a key, started if there is none"""
+        flight_key = (namespace, key)
+        task = self._inflight.get(flight_key)
+        if task is not None:
+            self._stampede["coalesced"] += 1
+            return task
+
+        task = asyncio.create_task(
+            self._compute_and_store(key, compute, ttl, namespace, tags, stale_ttl)
+        )
+        self._inflight[flight_key] = task
+
+        def _landed(done: asyncio.Task):
+            if self._inflight.get(flight_key) is done:
+                del self._inflight[flight_key]
+
+        task.add_done_callback(_landed)
+        return task
+
+    def _refresh_in_background(self, *args) -> None:
+        def _report(done: asyncio.Task):
+            if not done.cancelled() and done.exception() is not None:
+                self._stampede["refresh_errors"] += 1
+                logging.error(f"Background cache refresh failed for {args[0]}: {str(done.exception())}")
+
+        self._flight(*args).add_done_callback(_report)
+
+    async def _compute_and_store(self, key, compute, ttl, namespace, tags, stale_ttl) -> Any:
+        # Runs in its own task: dont_cache() inside compute lands in this context
+        self._stampede["computes"] += 1
+        _skip_store.set(False)
+        started = time.time()
+        value = await compute()
+        if value is not None and not _skip_store.get():
+            finished = time.time()
+            await self.set(
+                key, _Fresh(value, finished + ttl, finished - started),
+                ttl=ttl + stale_ttl, namespace=namespace, tags=tags
+            )
+        return value
+
+    # ---------- generations / invalidation ----------
+
+    async def _sync_generations(self, tags: Iterable[str]) -> None:
+        """Adopt the shared generation of tags this worker hasn't seen yet"""
+        missing = [tag for tag in tags if tag not in self._synced]
+        if not missing:
+            return
+        values = await asyncio.wait_for(
+            self.l2.mget([self._generation_key(tag) for tag in missing]), CACHE_L2_TIMEOUT
+        )
+        for tag, value in zip(missing, values):
+            self.l1.observe_generation(tag, int(value or 0))
+            self._synced.add(tag)
+
+    def _on_compaction(self, live: set) -> None:
+        """CacheEngine hook: tags whose generation was dropped are read from L2 again"""
+        self._synced &= live
+
+    async def generations(self, tags: Iterable[str]) -> tuple:
+        """Current generation of each tag (shared values when L2 is on)"""
+        tags = list(tags)
+        if self.l2 is not None:
+            try:
+                await self._sync_generations(tags)
+            except Exception as e:
+                self._l2_stats.errors += 1
+                logging.warning(f"L2 generation sync failed: {str(e)}")
+        return self.l1.generations(tags)
+
+    def add_remote_invalidation_listener(self, listener) -> None:
+        """
+        Call `listener(tags)` for invalidations adopted from other workers
+        (the counterpart of CacheEngine.add_invalidation_listener). After a
+        resync, when messages may have been missed, tags is ("*",).
+        """
+        self._remote_listeners.append(listener)
+
+    def _notify_remote(self, tags: tuple) -> None:
+        for listener in self._remote_listeners:
+            try:
+                listener(tags)
+            except Exception as e:
+                logging.error(f"Error in invalidation listener: {str(e)}")
+
+    def _on_local_invalidation(self, tags: tuple) -> None:
+        """CacheEngine hook: push a local invalidation out to the other workers"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Scripts / CLI without an event loop: entries in the server
+            # workers will still age out with their TTL
+            logging.debug(f"No event loop, invalidation of {tags} stays local")
+            return
+        task = loop.create_task(self._publish(tags))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def _publish(self, tags: tuple) -> None:
+        try:
+            generations = {}
+            for tag in tags:
+                generations[tag] = await self.l2.incr(self._generation_key(tag), CACHE_GENERATION_TTL)
+                self.l1.observe_generation(tag, generations[tag])
+                self._synced.add(tag)
+            await self.l2.publish(self.channel, json.dumps({
+                "origin": self.instance_id,
+                "generations": generations
+            }))
+            self._published += 1
+        except Exception as e:
+            self._l2_stats.errors += 1
+            logging.error(f"Error publishing cache invalidation for {tags}: {str(e)}")
+
+    async def _resync(self) -> None:
+        """Re-read every known generation (messages may have been missed)"""
+        tags = list(self._synced)
+        self._synced.clear()
+        for i in range(0, len(tags), 500):
+            await self._sync_generations(tags[i:i + 500])
+        self._notify_remote(("*",))
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                async for message in self.l2.subscribe(self.channel):
+                    if message is None:
+                        # (Re)subscribed: catch up on anything published meanwhile
+                        await self._resync()
+                        continue
+                    data = json.loads(message)
+                    if data.get("origin") == self.instance_id:
+                        continue
+                    generations = data.get("generations", {})
+                    for tag, generation in generations.items():
+                        self.l1.observe_generation(tag, int(generation))
+                        self._synced.add(tag)
+                    self._received += 1
+                    self._notify_remote(tuple(generations))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._l2_stats.errors += 1
+                logging.error(f"Cache invalidation listener error: {str(e)}")
+                await asyncio.sleep(1)
+
+    # ---------- lifecycle ----------
+
+    async def start(self) -> None:
+        """Subscribe to cross-worker invalidations (call from app startup)"""
+        if self.l2 is not None and self._listener is None:
+            self._listener = asyncio.create_task(self._listen())
+            logging.info(f"Two-tier cache enabled ({self.l2.name} L2)")
+
+    async def stop(self) -> None:
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+        if self.l2 is not None:
+            await self.l2.close()
+
+    # ---------- stats ----------
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.l1.get_stats(),
+            "tiers": {
+                "l1": self._l1_stats.as_dict(),
+                "l2": {
+                    "backend": self.l2.name if self.l2 is not None else None,
+                    **self._l2_stats.as_dict(),
+                    "invalidations_published": self._published,
+                    "invalidations_received": self._received,
+                    "listening": self._listener is not None and not self._listener.done()
+                }
+            },
+            "stampede": {**self._stampede, "in_flight": len(self._inflight)}
+        }
+
+
+# Singleton instance shared by cache.py and middleware.py
+tiered_cache = TieredCache(cache_engine, l2_from_url(CACHE_L2_URL))
@@ -5,6 +5,8 @@ import random
 from datetime import datetime, date, timedelta
 from typing import List, Dict, Any, Optional
 from dotenv import load_dotenv
+from daily_summary import daily_summary
+from auth import invalidate_user_cache
 
 load_dotenv()
 
@@ -142,7 +144,7 @@ class ChallengesService:
     def __init__(self, supabase_client):
         self.supabase = supabase_client
     
-    def get_daily_challenges(self, user_id: int, date_str: str = None) -> Dict[str, Any]:
+    async def get_daily_challenges(self, user_id: int, date_str: str = None) -> Dict[str, Any]:
         """Get daily challenges for a user"""
         if not date_str:
             date_str = date.today().strftime('%Y-%m-%d')
@@ -157,7 +159,7 @@ class ChallengesService:
         # Check completion status
         challenges = []
         for challenge in selected:
-            completed = self._check_challenge_completed(user_id, challenge, date_str)
+            completed = await self._check_challenge_completed(user_id, challenge, date_str)
             challenges.append({
                 **challenge,
                 "completed": completed,
@@ -171,7 +173,7 @@ class ChallengesService:
             "completed_count": sum(1 for c in challenges if c["completed"])
         }
     
-    def get_weekly_challenges(self, user_id: int) -> Dict[str, Any]:
+    async def get_weekly_challenges(self, user_id: int) -> Dict[str, Any]:
         """Get weekly challenges for a user"""
         today = date.today()
         week_start = today - timedelta(days=today.weekday())
@@ -179,10 +181,10 @@ class ChallengesService:
         
         challenges = []
         for challenge in WEEKLY_CHALLENGES:
-            completed = self._check_weekly_challenge_completed(
+            completed = await self._check_weekly_challenge_completed(
                 user_id, challenge, week_start, week_end
             )
-            progress = self._get_weekly_challenge_progress(
+            progress = await self._get_weekly_challenge_progress(
                 user_id, challenge, week_start, week_end
             )
             challenges.append({
@@ -201,7 +203,7 @@ class ChallengesService:
             "completed_count": sum(1 for c in challenges if c["completed"])
         }
     
-    def _check_challenge_completed(
+    async def _check_challenge_completed(
         self, user_id: int, challenge: Dict, date_str: str
     ) -> bool:
         """Check if a daily challenge is completed"""
@@ -211,7 +213,7 @@ class ChallengesService:
             
             if challenge_type == "thought":
                 # Check if thought exists with min characters
-                thought_response = self.supabase.table('daily_thoughts').select('thought').eq(
+                thought_response = await self.supabase.table('daily_thoughts').select('thought').eq(
                     'user_id', user_id
                 ).eq('date', date_str).execute()
                 
@@ -222,7 +224,7 @@ class ChallengesService:
             
             elif challenge_type == "sleep":
                 # Check sleep hours
-                sleep_response = self.supabase.table('sleep_records').select('sleep_hours').eq(
+                sleep_response = await self.supabase.table('sleep_records').select('sleep_hours').eq(
                     'user_id', user_id
                 ).eq('date', date_str).execute()
                 
@@ -237,13 +239,13 @@ class ChallengesService:
                 has_thought = False
                 
                 if condition.get('track_sleep'):
-                    sleep_response = self.supabase.table('sleep_records').select('id').eq(
+                    sleep_response = await self.supabase.table('sleep_records').select('id').eq(
                         'user_id', user_id
                     ).eq('date', date_str).execute()
                     has_sleep = bool(sleep_response.data)
                 
                 if condition.get('track_thought'):
-                    thought_response = self.supabase.table('daily_thoughts').select('id').eq(
+                    thought_response = await self.supabase.table('daily_thoughts').select('id').eq(
                         'user_id', user_id
                     ).eq('date', date_str).execute()
                     has_thought = bool(thought_response.data)
@@ -252,7 +254,7 @@ class ChallengesService:
             
             elif challenge_type == "streak":
                 # Check if streak is maintained
-                habits_response = self.supabase.table('habits').select('id').eq(
+                habits_response = await self.supabase.table('habits').select('id').eq(
                     'user_id', user_id
                 ).execute()
                 total_habits = len(habits_response.data) if habits_response.data else 0
@@ -260,7 +262,7 @@ class ChallengesService:
                 if total_habits == 0:
                     return False
                 
-                checkins_response = self.supabase.table('checkins').select('*').eq(
+                checkins_response = await self.supabase.table('checkins').select('*').eq(
                     'user_id', user_id
                 ).eq('date', date_str).eq('completed', True).execute()
                 
@@ -269,7 +271,7 @@ class ChallengesService:
             
             elif challenge_type == "timing":
                 # Check if all habits completed without being overdue
-                habits_response = self.supabase.table('habits').select('*').eq(
+                habits_response = await self.supabase.table('habits').select('*').eq(
                     'user_id', user_id
                 ).execute()
                 habits = habits_response.data or []
@@ -277,7 +279,7 @@ class ChallengesService:
                 if not habits:
                     return False
                 
-                checkins_response = self.supabase.table('checkins').select('*').eq(
+                checkins_response = await self.supabase.table('checkins').select('*').eq(
                     'user_id', user_id
                 ).eq('date', date_str).execute()
                 
@@ -289,12 +291,12 @@ class ChallengesService:
             
             else:
                 # Default: check if all habits completed
-                habits_response = self.supabase.table('habits').select('id').eq(
+                habits_response = await self.supabase.table('habits').select('id').eq(
                     'user_id', user_id
                 ).execute()
                 total_habits = len(habits_response.data) if habits_response.data else 0
                 
-                checkins_response = self.supabase.table('checkins').select('*').eq(
+                checkins_response = await self.supabase.table('checkins').select('*').eq(
                     'user_id', user_id
                 ).eq('date', date_str).eq('completed', True).execute()
                 
@@ -304,11 +306,11 @@ class ChallengesService:
             logging.error(f"Error checking challenge completion: {str(e)}")
             return False
     
-    def _check_weekly_challenge_completed(
+    async def _check_weekly_challenge_completed(
         self, user_id: int, challenge: Dict, week_start: date, week_end: date
     ) -> bool:
         """Check if a weekly challenge is completed"""
-        progress = self._get_weekly_challenge_progress(user_id, challenge, week_start, week_end)
+        progress = await self._get_weekly_challenge_progress(user_id, challenge, week_start, week_end)
         condition = challenge.get("condition", {})
         
         if "perfect_days" in condition:
@@ -320,62 +322,35 @@ class ChallengesService:
         
         return False
     
-    def _get_weekly_challenge_progress(
+    async def _get_weekly_challenge_progress(
         self, user_id: int, challenge: Dict, week_start: date, week_end: date
     ) -> int:
         """Get progress for a weekly challenge"""
         try:
             condition = challenge.get("condition", {})
             
+            # One summary row per day of the week covers every weekly condition
+            summary_by_date = await daily_summary.get_range(
+                user_id,
+                week_start.strftime('%Y-%m-%d'),
+                min(week_end, date.today()).strftime('%Y-%m-%d')
+            )
+            days = summary_by_date.values()
+            
             if "perfect_days" in condition:
                 # Count perfect days
-                habits_response = self.supabase.table('habits').select('id').eq(
-                    'user_id', user_id
-                ).execute()
-                total_habits = len(habits_response.data) if habits_response.data else 0
-                
-                if total_habits == 0:
-                    return 0
-                
-                perfect_days = 0
-                current_date = week_start
-                
-                while current_date <= min(week_end, date.today()):
-                    date_str = current_date.strftime('%Y-%m-%d')
-                    checkins_response = self.supabase.table('checkins').select('*').eq(
-                        'user_id', user_id
-                    ).eq('date', date_str).eq('completed', True).execute()
-                    
-                    if len(checkins_response.data or []) == total_habits:
-                        perfect_days += 1
-                    
-                    current_date += timedelta(days=1)
-                
-                return perfect_days
+                return sum(1 for d in days if d.get('is_perfect'))
             
             elif "optimal_sleep_days" in condition:
                 # Count days with optimal sleep
-                sleep_response = self.supabase.table('sleep_records').select('*').eq(
-                    'user_id', user_id
-                ).gte('date', week_start.strftime('%Y-%m-%d')).lte(
-                    'date', week_end.strftime('%Y-%m-%d')
-                ).execute()
-                
-                optimal_days = sum(
-                    1 for r in (sleep_response.data or [])
-                    if 7 <= r.get('sleep_hours', 0) <= 9
+                return sum(
+                    1 for d in days
+                    if d.get('sleep_hours') is not None and 7 <= d['sleep_hours'] <= 9
                 )
-                return optimal_days
             
             elif "thought_days" in condition:
                 # Count days with thoughts
-                thoughts_response = self.supabase.table('daily_thoughts').select('id').eq(
-                    'user_id', user_id
-                ).gte('date', week_start.strftime('%Y-%m-%d')).lte(
-                    'date', week_end.strftime('%Y-%m-%d')
-                ).execute()
-                
-                return len(thoughts_response.data or [])
+                return sum(1 for d in days if d.get('has_thought'))
             
             return 0
             
@@ -383,7 +358,7 @@ class ChallengesService:
             logging.error(f"Error getting weekly challenge progress: {str(e)}")
             return 0
     
-    def complete_challenge(
+    async def complete_challenge(
         self, user_id: int, challenge_id: str, date_str: str = None
     ) -> Dict[str, Any]:
         """Mark a challenge as completed and award XP"""
@@ -406,7 +381,7 @@ class ChallengesService:
             return {"success": False, "error": "Challenge not found"}
         
         # Check if already completed
-        existing = self.supabase.table('challenge_completions').select('id').eq(
+        existing = await self.supabase.table('challenge_completions').select('id').eq(
             'user_id', user_id
         ).eq('challenge_id', challenge_id).eq('date', date_str).execute()
         
@@ -414,13 +389,13 @@ class ChallengesService:
             return {"success": False, "error": "Challenge already completed"}
         
         # Verify challenge is actually completed
-        is_completed = self._check_challenge_completed(user_id, challenge, date_str)
+        is_completed = await self._check_challenge_completed(user_id, challenge, date_str)
         
         if not is_completed:
             return {"success": False, "error": "Challenge conditions not met"}
         
         # Record completion
-        self.supabase.table('challenge_completions').insert({
+        await self.supabase.table('challenge_completions').insert({
             'user_id': user_id,
             'challenge_id': challenge_id,
             'date': date_str,
@@ -428,16 +403,17 @@ class ChallengesService:
         }).execute()
         
         # Award XP
-        user_response = self.supabase.table('users').select('total_xp').eq(
+        user_response = await self.supabase.table('users').select('total_xp').eq(
             'id', user_id
         ).single().execute()
         
         current_xp = user_response.data.get('total_xp', 0) if user_response.data else 0
         new_xp = current_xp + challenge['xp_reward']
         
-        self.supabase.table('users').update({
+        await self.supabase.table('users').update({
             'total_xp': new_xp
         }).eq('id', user_id).execute()
+        invalidate_user_cache(user_id)
         
         return {
             "success": True,
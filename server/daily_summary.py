@@ -0,0 +1,207 @@
+# server/daily_summary.py
+import sys
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+from dotenv import load_dotenv
+from database import supabase, iter_rows, notify_write
+
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO)
+
+# One row per user per day, refreshed atomically by every check-in,
+# sleep-record and daily-thought write. completed_count only counts the
+# user's current habits, so a day is perfect when every one of them is
+# completed (the same rule as StreakEngine). Run once in the Supabase SQL
+# editor (re-run the functions after changing them, then rebuild):
+#
+# CREATE TABLE IF NOT EXISTS user_daily_summary (
+#     user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+#     date DATE NOT NULL,
+#     completed_count INTEGER NOT NULL DEFAULT 0,
+#     checkin_count INTEGER NOT NULL DEFAULT 0,
+#     total_habits INTEGER NOT NULL DEFAULT 0,
+#     is_perfect BOOLEAN NOT NULL DEFAULT FALSE,
+#     sleep_hours REAL,
+#     has_thought BOOLEAN NOT NULL DEFAULT FALSE,
+#     updated_at TIMESTAMP DEFAULT NOW(),
+#     PRIMARY KEY (user_id, date)
+# );
+#
+# CREATE OR REPLACE FUNCTION refresh_daily_summary(p_user_id INTEGER, p_date DATE)
+# RETURNS user_daily_summary AS $$
+#     INSERT INTO user_daily_summary AS s
+#         (user_id, date, completed_count, checkin_count, total_habits,
+#          is_perfect, sleep_hours, has_thought, updated_at)
+#     SELECT p_user_id, p_date, c.completed, c.tracked, h.total,
+#            h.total > 0 AND c.completed = h.total,
+#            (SELECT sleep_hours FROM sleep_records
+#              WHERE user_id = p_user_id AND date = p_date LIMIT 1),
+#            EXISTS (SELECT 1 FROM daily_thoughts
+#                     WHERE user_id = p_user_id AND date = p_date),
+#            NOW()
+#     FROM (SELECT COUNT(DISTINCT habit_id) FILTER (
+#                      WHERE completed AND habit_id IN (SELECT id FROM habits WHERE user_id = p_user_id)
+#                  ) AS completed,
+#                  COUNT(*) AS tracked
+#             FROM checkins WHERE user_id = p_user_id AND date = p_date) c,
+#          (SELECT COUNT(*) AS total FROM habits WHERE user_id = p_user_id) h
+#     ON CONFLICT (user_id, date) DO UPDATE SET
+#         completed_count = EXCLUDED.completed_count,
+#         checkin_count = EXCLUDED.checkin_count,
+#         total_habits = EXCLUDED.total_habits,
+#         is_perfect = EXCLUDED.is_perfect,
+#         sleep_hours = EXCLUDED.sleep_hours,
+#         has_thought = EXCLUDED.has_thought,
+#         updated_at = EXCLUDED.updated_at
+#     RETURNING *;
+# $$ LANGUAGE sql;
+#
+# CREATE OR REPLACE FUNCTION refresh_daily_summaries(p_user_id INTEGER, p_dates DATE[])
+# RETURNS SETOF user_daily_summary AS $$
+#     SELECT r.* FROM unnest(p_dates) AS d,
+#            LATERAL refresh_daily_summary(p_user_id, d) AS r
+#     ORDER BY r.date;
+# $$ LANGUAGE sql;
+#
+# Backfill existing history with:  python daily_summary.py rebuild [user_id]
+
+SUMMARY_COLUMNS = 'date, completed_count, checkin_count, total_habits, is_perfect, sleep_hours, has_thought'
+REBUILD_BATCH_SIZE = 500
+
+
+def completion_rate(row: Dict[str, Any]) -> float:
+    """Percentage of habits completed on a summary day"""
+    total = row.get('total_habits') or 0
+    return (row.get('completed_count', 0) / total) * 100 if total > 0 else 0
+
+
+class DailySummaryStore:
+    """Read model with per-user daily completion, sleep and thought flags"""
+
+    def __init__(self, supabase_client):
+        self.supabase = supabase_client
+
+    async def refresh_day(self, user_id: int, date_str: str) -> Dict[str, Any]:
+        """Recompute one day from source tables (single atomic RPC)"""
+        response = await self.supabase.rpc('refresh_daily_summary', {
+            'p_user_id': user_id,
+            'p_date': date_str
+        }).execute()
+        notify_write('user_daily_summary', user_id)
+        data = response.data
+        if isinstance(data, list):
+            data = data[0] if data else {}
+        return data or {}
+
+    async def refresh_days(self, user_id: int, dates: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Recompute several days in one round trip, keyed by date"""
+        response = await self.supabase.rpc('refresh_daily_summaries', {
+            'p_user_id': user_id,
+            'p_dates': sorted(set(dates))
+        }).execute()
+        notify_write('user_daily_summary', user_id)
+        return {str(row['date']): row for row in (response.data or [])}
+
+    async def get_range(
+        self, user_id: int, start: str, end: str
+    ) -> Dict[str, Dict[str, Any]]:
+        """Summary rows keyed by date for an inclusive date range"""
+        response = await self.supabase.table('user_daily_summary').select(SUMMARY_COLUMNS).eq(
+            'user_id', user_id
+        ).gte('date', start).lte('date', end).order('date').execute()
+        return {str(row['date']): row for row in (response.data or [])}
+
+    def iter_all(self, user_id: int, columns: str = SUMMARY_COLUMNS):
+        """Stream every summary row for a user in date order"""
+        return iter_rows('user_daily_summary', {'user_id': user_id}, columns=columns, order_by=('date',))
+
+    async def rebuild_user(self, user_id: int) -> int:
+        """Rebuild all summary rows for a user from raw history"""
+        habits_response = await self.supabase.table('habits').select('id').eq(
+            'user_id', user_id
+        ).execute()
+        habit_ids = {h['id'] for h in (habits_response.data or [])}
+        total_habits = len(habit_ids)
+
+        days: Dict[str, Dict[str, Any]] = {}
+
+        def day(date_str: str) -> Dict[str, Any]:
+            if date_str not in days:
+                days[date_str] = {
+                    'user_id': user_id,
+                    'date': date_str,
+                    'completed': set(),
+                    'checkin_count': 0,
+                    'sleep_hours': None,
+                    'has_thought': False
+                }
+            return days[date_str]
+
+        async for checkin in iter_rows(
+            'checkins', {'user_id': user_id}, columns='habit_id, date, completed'
+        ):
+            d = day(str(checkin['date']))
+            d['checkin_count'] += 1
+            if checkin['completed'] and checkin['habit_id'] in habit_ids:
+                d['completed'].add(checkin['habit_id'])
+
+        async for record in iter_rows(
+            'sleep_records', {'user_id': user_id}, columns='date, sleep_hours'
+        ):
+            day(str(record['date']))['sleep_hours'] = record.get('sleep_hours')
+
+        async for thought in iter_rows('daily_thoughts', {'user_id': user_id}, columns='date'):
+            day(str(thought['date']))['has_thought'] = True
+
+        now = datetime.now().isoformat()
+        rows = []
+        for d in days.values():
+            completed_count = len(d.pop('completed'))
+            rows.append({
+                **d,
+                'completed_count': completed_count,
+                'total_habits': total_habits,
+                'is_perfect': total_habits > 0 and completed_count == total_habits,
+                'updated_at': now
+            })
+
+        for i in range(0, len(rows), REBUILD_BATCH_SIZE):
+            await self.supabase.table('user_daily_summary').upsert(
+                rows[i:i + REBUILD_BATCH_SIZE], on_conflict='user_id,date'
+            ).execute()
+
+        notify_write('user_daily_summary', user_id)
+        return len(rows)
+
+    async def rebuild_all(self, user_ids: Optional[List[int]] = None) -> Dict[str, Any]:
+        """Rebuild summaries for the given users (default: everyone)"""
+        results = {"users": 0, "rows": 0, "errors": []}
+
+        if user_ids is None:
+            user_ids = [u['id'] async for u in iter_rows('users', columns='id', order_by=('id',))]
+
+        for user_id in user_ids:
+            try:
+                results["rows"] += await self.rebuild_user(user_id)
+                results["users"] += 1
+            except Exception as e:
+                logging.error(f"Error rebuilding summary for user {user_id}: {str(e)}")
+                results["errors"].append(f"User {user_id}: {str(e)}")
+
+        return results
+
+
+# Singleton instance
+daily_summary = DailySummaryStore(supabase)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "rebuild":
+        print("Usage: python daily_summary.py rebuild [user_id ...]")
+        sys.exit(1)
+
+    ids = [int(arg) for arg in sys.argv[2:]] or None
+    print(asyncio.run(daily_summary.rebuild_all(ids)))
@@ -1,6 +1,12 @@
 # server/database.py
 import os
-from supabase import create_client, Client
+import asyncio
+import httpx
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+from supabase import AsyncClient, AsyncClientOptions
+from cache_engine import invalidate_table
+from metrics import count_db_response
 from dotenv import load_dotenv
 import logging
 
@@ -12,5 +18,245 @@ SUPABASE_KEY = os.getenv("SUPABASE_KEY")  # Use service role key for backend
 if not SUPABASE_URL or not SUPABASE_KEY:
     raise ValueError("Missing SUPABASE_URL or SUPABASE_KEY in environment variables")
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-logging.info(f"✅ Connected to Supabase: {SUPABASE_URL}")
\ No newline at end of file
+# Connection pool settings (shared by every PostgREST round trip)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_POOL_KEEPALIVE = int(os.getenv("DB_POOL_KEEPALIVE", str(DB_POOL_SIZE)))
+DB_KEEPALIVE_EXPIRY = float(os.getenv("DB_KEEPALIVE_EXPIRY", "30"))
+DB_CONNECT_TIMEOUT = float(os.getenv("DB_CONNECT_TIMEOUT", "5"))
+DB_TIMEOUT = float(os.getenv("DB_TIMEOUT", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+DB_HTTP2 = os.getenv("DB_HTTP2", "true").lower() == "true"
+
+_http_client = httpx.AsyncClient(
+    http2=DB_HTTP2,
+    limits=httpx.Limits(
+        max_connections=DB_POOL_SIZE,
+        max_keepalive_connections=DB_POOL_KEEPALIVE,
+        keepalive_expiry=DB_KEEPALIVE_EXPIRY,
+    ),
+    timeout=httpx.Timeout(
+        DB_TIMEOUT,
+        connect=DB_CONNECT_TIMEOUT,
+        pool=DB_POOL_TIMEOUT,
+    ),
+    event_hooks={"response": [count_db_response]},
+)
+
+# Async client - every query must be awaited: `await supabase.table(...).execute()`
+supabase: AsyncClient = AsyncClient(
+    SUPABASE_URL,
+    SUPABASE_KEY,
+    options=AsyncClientOptions(
+        httpx_client=_http_client,
+        postgrest_client_timeout=DB_TIMEOUT,
+        auto_refresh_token=False,
+        persist_session=False,
+    ),
+)
+logging.info(f"✅ Connected to Supabase: {SUPABASE_URL} (pool={DB_POOL_SIZE}, http2={DB_HTTP2})")
+
+
+async def close_db():
+    """Close pooled connections (call on app shutdown)"""
+    await _http_client.aclose()
+    logging.info("Supabase connection pool closed")
+
+
+# ============================================
+# PAGINATED READS
+# ============================================
+
+# Keep this at or below the PostgREST `max-rows` setting (Supabase default: 1000);
+# a page shorter than DB_PAGE_SIZE is treated as the last one.
+DB_PAGE_SIZE = int(os.getenv("DB_PAGE_SIZE", "500"))
+
+
+def _after_cursor(query, order_by: Tuple[str, ...], cursor: Tuple[Any, ...]):
+    """Restrict query to rows strictly after the keyset cursor"""
+    if len(order_by) == 1:
+        return query.gt(order_by[0], cursor[0])
+    first, second = order_by
+    return query.or_(
+        f"{first}.gt.{cursor[0]},and({first}.eq.{cursor[0]},{second}.gt.{cursor[1]})"
+    )
+
+
+async def iter_rows(
+    table: str,
+    filters: Optional[Dict[str, Any]] = None,
+    columns: str = "*",
+    order_by: Tuple[str, ...] = ("date", "id"),
+    page_size: int = DB_PAGE_SIZE,
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Stream every matching row in keyset pages ordered by `order_by`
+    (one or two columns, e.g. (date, id)). Only `columns` are fetched,
+    plus the order columns needed for the cursor. A list or tuple filter
+    value matches any of its values (`in_`).
+    """
+    if not 1 <= len(order_by) <= 2:
+        raise ValueError("order_by must have one or two columns")
+    
+    select_columns = columns
+    if columns != "*":
+        wanted = [c.strip() for c in columns.split(",")]
+        select_columns = ", ".join(wanted + [k for k in order_by if k not in wanted])
+    
+    cursor = None
+    while True:
+        query = supabase.table(table).select(select_columns)
+        for column, value in (filters or {}).items():
+            if isinstance(value, (list, tuple)):
+                query = query.in_(column, list(value))
+            else:
+                query = query.eq(column, value)
+        if cursor is not None:
+            query = _after_cursor(query, order_by, cursor)
+        for key in order_by:
+            query = query.order(key)
+        
+        response = await query.limit(page_size).execute()
+        rows = response.data or []
+        
+        for row in rows:
+            yield row
+        
+        if len(rows) < page_size:
+            return
+        cursor = tuple(rows[-1][key] for key in order_by)
+
+
+# ============================================
+# UPSERTS
+# ============================================
+
+# upsert_row relies on these unique keys. Run once in the Supabase SQL editor:
+#   ALTER TABLE checkins ADD CONSTRAINT checkins_user_habit_date_key UNIQUE (user_id, habit_id, date);
+#   ALTER TABLE sleep_records ADD CONSTRAINT sleep_records_user_date_key UNIQUE (user_id, date);
+#   ALTER TABLE daily_thoughts ADD CONSTRAINT daily_thoughts_user_date_key UNIQUE (user_id, date);
+#   ALTER TABLE habit_streaks ADD CONSTRAINT habit_streaks_user_habit_key UNIQUE (user_id, habit_id);
+#   ALTER TABLE user_xp ADD CONSTRAINT user_xp_user_key UNIQUE (user_id);
+# Columns left out of the payload keep their value on update and their
+# default on insert (e.g. created_at DEFAULT NOW(), total_xp DEFAULT 0).
+
+
+async def upsert_row(
+    table: str,
+    data: Dict[str, Any],
+    on_conflict: str,
+    client: Optional[AsyncClient] = None,
+) -> Optional[Dict[str, Any]]:
+    """
+    Insert or update a single row on the table's unique key
+    (`on_conflict`, e.g. "user_id,date") in one round trip and
+    return the row as stored.
+    """
+    response = await (client or supabase).table(table).upsert(
+        data, on_conflict=on_conflict
+    ).execute()
+    notify_write(table, data.get('user_id'))
+    return response.data[0] if response.data else None
+
+
+def notify_write(table: str, user_id: Optional[int] = None):
+    """
+    Table change event - call after every write. Drops this request's
+    memoized reads of `table` and evicts cached responses that depend on
+    it (for `user_id` only, or for everyone when no user is given).
+    """
+    invalidate_reads(table)
+    invalidate_table(table, user_id)
+
+
+# ============================================
+# REQUEST-SCOPED READS
+# ============================================
+
+class RequestLoader:
+    """
+    Per-request memo of `(table, filters, columns)` selects. Identical
+    reads made while handling one request - including concurrent ones -
+    share a single round trip. Writers call `invalidate(table)`.
+    """
+    
+    def __init__(self, client: Optional[AsyncClient] = None):
+        self.client = client or supabase
+        self._pending: Dict[Tuple, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+    
+    @staticmethod
+    def _key(table: str, filters: Dict[str, Any], columns: str) -> Tuple:
+        return (table, columns, tuple(sorted(filters.items())))
+    
+    async def _fetch(self, table: str, filters: Dict[str, Any], columns: str) -> List[Dict[str, Any]]:
+        query = self.client.table(table).select(columns)
+        for column, value in filters.items():
+            query = query.eq(column, value)
+        response = await query.execute()
+        return response.data or []
+    
+    async def select(
+        self,
+        table: str,
+        filters: Optional[Dict[str, Any]] = None,
+        columns: str = "*",
+    ) -> List[Dict[str, Any]]:
+        """Rows matching equality `filters`; callers get their own row copies"""
+        filters = filters or {}
+        key = self._key(table, filters, columns)
+        
+        task = self._pending.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._fetch(table, filters, columns))
+            self._pending[key] = task
+        else:
+            self.hits += 1
+        
+        try:
+            # Shielded: a caller being cancelled mustn't cancel the shared fetch
+            rows = await asyncio.shield(task)
+        except BaseException:
+            # Don't memoize failures or cancelled reads
+            if self._pending.get(key) is task:
+                del self._pending[key]
+            raise
+        return [dict(row) for row in rows]
+    
+    async def select_one(
+        self,
+        table: str,
+        filters: Optional[Dict[str, Any]] = None,
+        columns: str = "*",
+    ) -> Optional[Dict[str, Any]]:
+        rows = await self.select(table, filters, columns)
+        return rows[0] if rows else None
+    
+    def invalidate(self, table: str):
+        for key in [k for k in self._pending if k[0] == table]:
+            del self._pending[key]
+
+
+_request_loader: ContextVar[Optional[RequestLoader]] = ContextVar("request_loader", default=None)
+
+
+def begin_request_reads():
+    """Attach a fresh loader to the current context; returns a reset token"""
+    return _request_loader.set(RequestLoader())
+
+
+def end_request_reads(token):
+    _request_loader.reset(token)
+
+
+def request_loader() -> RequestLoader:
+    """Loader for the current request (a throwaway one outside requests, e.g. cron jobs)"""
+    return _request_loader.get() or RequestLoader()
+
+
+def invalidate_reads(table: str):
+    """Drop memoized reads of `table` after writing to it in this request"""
+    loader = _request_loader.get()
+    if loader is not None:
+        loader.invalidate(table)
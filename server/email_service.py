@@ -7,6 +7,7 @@ from email.mime.multipart import MIMEMultipart
 from datetime import datetime, timedelta
 import logging
 from dotenv import load_dotenv
+from metrics import external_call
 
 # Load environment variables
 load_dotenv()
@@ -220,7 +221,8 @@ def send_otp_email(to_email: str, otp: str, name: str = "User"):
                 logging.error("Make sure you're using an App Password, not your regular Gmail password")
                 return False
             
-            server.send_message(msg)
+            with external_call("smtp"):
+                server.send_message(msg)
             logging.info(f"✅ OTP email sent successfully to {to_email}")
 
         return True
@@ -6,6 +6,7 @@ from datetime import datetime, date, timedelta
 from typing import List, Dict, Any, Optional
 from dotenv import load_dotenv
 from database import supabase
+from metrics import external_call
 
 load_dotenv()
 
@@ -29,10 +30,10 @@ class ConversationManager:
     """Manage AI coach conversations with memory"""
     
     @staticmethod
-    def get_conversation_history(user_id: int, limit: int = 10) -> List[Dict[str, Any]]:
+    async def get_conversation_history(user_id: int, limit: int = 10) -> List[Dict[str, Any]]:
         """Get recent conversation history"""
         try:
-            response = supabase.table('ai_conversations').select('*').eq(
+            response = await supabase.table('ai_conversations').select('*').eq(
                 'user_id', user_id
             ).order('created_at', desc=True).limit(limit).execute()
             
@@ -42,10 +43,10 @@ class ConversationManager:
             return []
     
     @staticmethod
-    def save_message(user_id: int, role: str, content: str, metadata: Dict = None):
+    async def save_message(user_id: int, role: str, content: str, metadata: Dict = None):
         """Save a message to conversation history"""
         try:
-            supabase.table('ai_conversations').insert({
+            await supabase.table('ai_conversations').insert({
                 'user_id': user_id,
                 'role': role,
                 'content': content,
@@ -56,10 +57,10 @@ class ConversationManager:
             logging.error(f"Error saving message: {str(e)}")
     
     @staticmethod
-    def clear_history(user_id: int):
+    async def clear_history(user_id: int):
         """Clear conversation history"""
         try:
-            supabase.table('ai_conversations').delete().eq('user_id', user_id).execute()
+            await supabase.table('ai_conversations').delete().eq('user_id', user_id).execute()
         except Exception as e:
             logging.error(f"Error clearing history: {str(e)}")
 
@@ -68,32 +69,32 @@ class EnhancedAICoach:
     """Enhanced AI Coach with memory, context, and proactive insights"""
     
     @staticmethod
-    def get_user_context(user_id: int) -> Dict[str, Any]:
+    async def get_user_context(user_id: int) -> Dict[str, Any]:
         """Get comprehensive user context for AI"""
         try:
             # User info
-            user = supabase.table('users').select('*').eq('id', user_id).single().execute()
+            user = await supabase.table('users').select('*').eq('id', user_id).single().execute()
             
             # Habits
-            habits = supabase.table('habits').select('*').eq('user_id', user_id).execute()
+            habits = await supabase.table('habits').select('*').eq('user_id', user_id).execute()
             
             # Recent checkins
             today = date.today()
             week_ago = today - timedelta(days=7)
-            checkins = supabase.table('checkins').select('*').eq(
+            checkins = await supabase.table('checkins').select('*').eq(
                 'user_id', user_id
             ).gte('date', week_ago.strftime('%Y-%m-%d')).execute()
             
             # Streaks
-            streaks = supabase.table('habit_streaks').select('*').eq('user_id', user_id).execute()
+            streaks = await supabase.table('habit_streaks').select('*').eq('user_id', user_id).execute()
             
             # Recent sleep
-            sleep = supabase.table('sleep_records').select('*').eq(
+            sleep = await supabase.table('sleep_records').select('*').eq(
                 'user_id', user_id
             ).order('date', desc=True).limit(7).execute()
             
             # Recent thoughts
-            thoughts = supabase.table('daily_thoughts').select('*').eq(
+            thoughts = await supabase.table('daily_thoughts').select('*').eq(
                 'user_id', user_id
             ).order('date', desc=True).limit(5).execute()
             
@@ -156,10 +157,10 @@ class EnhancedAICoach:
         """Chat with enhanced context and memory"""
         try:
             # Get context
-            context = EnhancedAICoach.get_user_context(user_id)
+            context = await EnhancedAICoach.get_user_context(user_id)
             
             # Get conversation history
-            history = ConversationManager.get_conversation_history(user_id, limit=6)
+            history = await ConversationManager.get_conversation_history(user_id, limit=6)
             
             # Build conversation for AI
             conversation_text = ""
@@ -199,13 +200,14 @@ INSTRUCTIONS:
 Respond naturally:"""
 
             model = get_model()
-            response = model.generate_content(prompt)
+            with external_call("gemini"):
+                response = model.generate_content(prompt)
             
             ai_response = response.text.strip() if response.text else "I'm here to help! What's on your mind?"
             
             # Save to conversation history
-            ConversationManager.save_message(user_id, 'user', message)
-            ConversationManager.save_message(user_id, 'assistant', ai_response, {
+            await ConversationManager.save_message(user_id, 'user', message)
+            await ConversationManager.save_message(user_id, 'assistant', ai_response, {
                 'context_used': True,
                 'habits_referenced': context['total_habits']
             })
@@ -245,7 +247,7 @@ Respond naturally:"""
     async def get_proactive_insight(user_id: int) -> Optional[Dict[str, Any]]:
         """Generate proactive insight based on user data"""
         try:
-            context = EnhancedAICoach.get_user_context(user_id)
+            context = await EnhancedAICoach.get_user_context(user_id)
             
             insights = []
             
@@ -288,7 +290,7 @@ Respond naturally:"""
     async def generate_weekly_coaching_plan(user_id: int) -> Dict[str, Any]:
         """Generate personalized weekly coaching plan"""
         try:
-            context = EnhancedAICoach.get_user_context(user_id)
+            context = await EnhancedAICoach.get_user_context(user_id)
             
             prompt = f"""Create a personalized weekly coaching plan for {context['user_name']}.
 
@@ -312,7 +314,8 @@ Create a JSON response with:
 }}"""
 
             model = get_model()
-            response = model.generate_content(prompt)
+            with external_call("gemini"):
+                response = model.generate_content(prompt)
             
             try:
                 # Try to parse JSON from response
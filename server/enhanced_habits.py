@@ -3,7 +3,10 @@ import logging
 from datetime import datetime, date, timedelta
 from typing import List, Dict, Any, Optional
 from pydantic import BaseModel
-from database import supabase
+from database import supabase, iter_rows
+from auth import invalidate_user_cache
+from streak_engine import streak_engine
+from daily_summary import daily_summary, completion_rate as summary_completion_rate
 
 logging.basicConfig(level=logging.INFO)
 
@@ -46,74 +49,25 @@ class HabitStreakManager:
     """Manage individual habit streaks"""
     
     @staticmethod
-    def update_streak(user_id: int, habit_id: int, completed_date: str) -> Dict[str, Any]:
-        """Update streak for a specific habit"""
+    async def update_streak(user_id: int, habit_id: int, completed_date: str) -> Dict[str, Any]:
+        """Record a completion for a specific habit (delegates to the streak engine)"""
         try:
-            today = date.today()
-            completed = datetime.strptime(completed_date, '%Y-%m-%d').date()
-            
-            # Get current streak record
-            streak_response = supabase.table('habit_streaks').select('*').eq(
-                'user_id', user_id
-            ).eq('habit_id', habit_id).execute()
-            
-            if streak_response.data:
-                streak = streak_response.data[0]
-                last_date = datetime.strptime(streak['last_completed_date'], '%Y-%m-%d').date() if streak['last_completed_date'] else None
-                
-                if last_date:
-                    days_diff = (completed - last_date).days
-                    
-                    if days_diff == 0:
-                        # Already completed today
-                        return streak
-                    elif days_diff == 1:
-                        # Consecutive day - increment streak
-                        new_streak = streak['current_streak'] + 1
-                        best_streak = max(new_streak, streak['best_streak'])
-                    elif days_diff > 1:
-                        # Streak broken - reset
-                        new_streak = 1
-                        best_streak = streak['best_streak']
-                    else:
-                        # Past date completion
-                        new_streak = streak['current_streak']
-                        best_streak = streak['best_streak']
-                else:
-                    new_streak = 1
-                    best_streak = 1
-                
-                # Update streak
-                updated = supabase.table('habit_streaks').update({
-                    'current_streak': new_streak,
-                    'best_streak': best_streak,
-                    'last_completed_date': completed_date,
-                    'updated_at': datetime.now().isoformat()
-                }).eq('id', streak['id']).execute()
-                
-                return updated.data[0] if updated.data else streak
-            else:
-                # Create new streak record
-                new_streak = supabase.table('habit_streaks').insert({
-                    'user_id': user_id,
-                    'habit_id': habit_id,
-                    'current_streak': 1,
-                    'best_streak': 1,
-                    'last_completed_date': completed_date,
-                    'streak_started_date': completed_date
-                }).execute()
-                
-                return new_streak.data[0] if new_streak.data else {}
-                
+            state = await streak_engine.record_habit_checkin(user_id, habit_id, completed_date, True)
+            return {
+                'habit_id': habit_id,
+                'current_streak': state.current_streak,
+                'best_streak': state.longest_streak,
+                'last_completed_date': state.last_perfect_date
+            }
         except Exception as e:
             logging.error(f"Error updating streak: {str(e)}")
             return {}
     
     @staticmethod
-    def get_habit_streaks(user_id: int) -> List[Dict[str, Any]]:
+    async def get_habit_streaks(user_id: int) -> List[Dict[str, Any]]:
         """Get all habit streaks for a user"""
         try:
-            response = supabase.table('habit_streaks').select(
+            response = await supabase.table('habit_streaks').select(
                 '*, habits(name, icon, color)'
             ).eq('user_id', user_id).execute()
             
@@ -123,21 +77,21 @@ class HabitStreakManager:
             return []
     
     @staticmethod
-    def check_streak_at_risk(user_id: int) -> List[Dict[str, Any]]:
+    async def check_streak_at_risk(user_id: int) -> List[Dict[str, Any]]:
         """Find habits that haven't been completed today (streak at risk)"""
         try:
             today = date.today().strftime('%Y-%m-%d')
             yesterday = (date.today() - timedelta(days=1)).strftime('%Y-%m-%d')
             
             # Get habits with active streaks
-            streaks = supabase.table('habit_streaks').select(
+            streaks = await supabase.table('habit_streaks').select(
                 '*, habits(name, icon)'
             ).eq('user_id', user_id).gt('current_streak', 0).execute()
             
             at_risk = []
             for streak in (streaks.data or []):
                 # Check if completed today
-                checkin = supabase.table('checkins').select('*').eq(
+                checkin = await supabase.table('checkins').select('*').eq(
                     'habit_id', streak['habit_id']
                 ).eq('date', today).eq('completed', True).execute()
                 
@@ -214,14 +168,14 @@ class DailyChallengeManager:
     ]
     
     @staticmethod
-    def generate_daily_challenges(user_id: int) -> List[Dict[str, Any]]:
+    async def generate_daily_challenges(user_id: int) -> List[Dict[str, Any]]:
         """Generate 3 daily challenges for a user"""
         import random
         
         today = date.today().strftime('%Y-%m-%d')
         
         # Check if challenges already exist for today
-        existing = supabase.table('daily_challenges').select('*').eq(
+        existing = await supabase.table('daily_challenges').select('*').eq(
             'user_id', user_id
         ).eq('date', today).execute()
         
@@ -250,25 +204,25 @@ class DailyChallengeManager:
             if challenge['type'] == 'bonus_habit':
                 data['description'] = f"Complete this bonus: {random.choice(challenge['bonus_habits'])}"
             
-            response = supabase.table('daily_challenges').insert(data).execute()
+            response = await supabase.table('daily_challenges').insert(data).execute()
             if response.data:
                 challenges.append(response.data[0])
         
         return challenges
     
     @staticmethod
-    def check_challenge_completion(user_id: int, challenge_type: str) -> bool:
+    async def check_challenge_completion(user_id: int, challenge_type: str) -> bool:
         """Check if a specific challenge is completed"""
         today = date.today().strftime('%Y-%m-%d')
         
         try:
             if challenge_type == 'perfectionist':
                 # Check if all habits are completed
-                habits = supabase.table('habits').select('id').eq('user_id', user_id).execute()
+                habits = await supabase.table('habits').select('id').eq('user_id', user_id).execute()
                 if not habits.data:
                     return False
                 
-                checkins = supabase.table('checkins').select('*').eq(
+                checkins = await supabase.table('checkins').select('*').eq(
                     'user_id', user_id
                 ).eq('date', today).eq('completed', True).execute()
                 
@@ -279,7 +233,7 @@ class DailyChallengeManager:
             
             elif challenge_type == 'early_bird':
                 # Check if any habit completed before 7 AM
-                checkins = supabase.table('checkins').select('*').eq(
+                checkins = await supabase.table('checkins').select('*').eq(
                     'user_id', user_id
                 ).eq('date', today).eq('completed', True).execute()
                 
@@ -291,7 +245,7 @@ class DailyChallengeManager:
                 return False
             
             elif challenge_type == 'sleep_champion':
-                sleep = supabase.table('sleep_records').select('*').eq(
+                sleep = await supabase.table('sleep_records').select('*').eq(
                     'user_id', user_id
                 ).eq('date', today).execute()
                 
@@ -301,7 +255,7 @@ class DailyChallengeManager:
                 return False
             
             elif challenge_type == 'reflector':
-                thought = supabase.table('daily_thoughts').select('*').eq(
+                thought = await supabase.table('daily_thoughts').select('*').eq(
                     'user_id', user_id
                 ).eq('date', today).execute()
                 
@@ -317,11 +271,11 @@ class DailyChallengeManager:
             return False
     
     @staticmethod
-    def update_challenge_progress(user_id: int) -> Dict[str, Any]:
+    async def update_challenge_progress(user_id: int) -> Dict[str, Any]:
         """Update all daily challenge progress"""
         today = date.today().strftime('%Y-%m-%d')
         
-        challenges = supabase.table('daily_challenges').select('*').eq(
+        challenges = await supabase.table('daily_challenges').select('*').eq(
             'user_id', user_id
         ).eq('date', today).execute()
         
@@ -332,13 +286,13 @@ class DailyChallengeManager:
             if challenge['completed']:
                 continue
             
-            is_completed = DailyChallengeManager.check_challenge_completion(
+            is_completed = await DailyChallengeManager.check_challenge_completion(
                 user_id, challenge['challenge_type']
             )
             
             if is_completed:
                 # Mark as completed
-                supabase.table('daily_challenges').update({
+                await supabase.table('daily_challenges').update({
                     'completed': True,
                     'progress': 1
                 }).eq('id', challenge['id']).execute()
@@ -347,14 +301,15 @@ class DailyChallengeManager:
                 completed_challenges.append(challenge)
                 
                 # Add XP to user
-                user_data = supabase.table('users').select('total_xp').eq(
+                user_data = await supabase.table('users').select('total_xp').eq(
                     'id', user_id
                 ).single().execute()
                 
                 current_xp = user_data.data.get('total_xp', 0) if user_data.data else 0
-                supabase.table('users').update({
+                await supabase.table('users').update({
                     'total_xp': current_xp + challenge['xp_reward']
                 }).eq('id', user_id).execute()
+                invalidate_user_cache(user_id)
         
         return {
             'xp_earned': xp_earned,
@@ -368,13 +323,13 @@ class HabitAnalytics:
     """Advanced analytics for habits"""
     
     @staticmethod
-    def get_habit_performance(user_id: int, habit_id: int, days: int = 30) -> Dict[str, Any]:
+    async def get_habit_performance(user_id: int, habit_id: int, days: int = 30) -> Dict[str, Any]:
         """Get detailed performance metrics for a habit"""
         try:
             end_date = date.today()
             start_date = end_date - timedelta(days=days)
             
-            checkins = supabase.table('checkins').select('*').eq(
+            checkins = await supabase.table('checkins').select('*').eq(
                 'habit_id', habit_id
             ).gte('date', start_date.strftime('%Y-%m-%d')).lte(
                 'date', end_date.strftime('%Y-%m-%d')
@@ -404,7 +359,7 @@ class HabitAnalytics:
             avg_time = sum(times) / len(times) if times else None
             
             # Streak info
-            streak = supabase.table('habit_streaks').select('*').eq(
+            streak = await supabase.table('habit_streaks').select('*').eq(
                 'habit_id', habit_id
             ).single().execute()
             
@@ -427,50 +382,28 @@ class HabitAnalytics:
             return {}
     
     @staticmethod
-    def get_correlation_insights(user_id: int) -> Dict[str, Any]:
+    async def get_correlation_insights(user_id: int) -> Dict[str, Any]:
         """Find correlations between sleep, habits, and mood"""
         try:
             # Get last 30 days of data
             end_date = date.today()
             start_date = end_date - timedelta(days=30)
             
-            # Fetch all data
-            sleep_data = supabase.table('sleep_records').select('*').eq(
-                'user_id', user_id
-            ).gte('date', start_date.strftime('%Y-%m-%d')).execute()
-            
-            checkins = supabase.table('checkins').select('*').eq(
-                'user_id', user_id
-            ).gte('date', start_date.strftime('%Y-%m-%d')).execute()
-            
-            habits = supabase.table('habits').select('*').eq('user_id', user_id).execute()
-            total_habits = len(habits.data) if habits.data else 1
-            
-            # Build daily summaries
-            daily_data = {}
+            # One summary row per day carries sleep and completion counts
+            summary_by_date = await daily_summary.get_range(
+                user_id, start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')
+            )
             
-            for sleep in (sleep_data.data or []):
-                daily_data[sleep['date']] = {
-                    'sleep_hours': sleep['sleep_hours'],
-                    'completed_habits': 0,
-                    'completion_rate': 0
+            # Build daily summaries (days with sleep or check-ins)
+            daily_data = {
+                d: {
+                    'sleep_hours': row.get('sleep_hours'),
+                    'completed_habits': row.get('completed_count', 0),
+                    'completion_rate': summary_completion_rate(row)
                 }
-            
-            for checkin in (checkins.data or []):
-                if checkin['date'] not in daily_data:
-                    daily_data[checkin['date']] = {
-                        'sleep_hours': None,
-                        'completed_habits': 0,
-                        'completion_rate': 0
-                    }
-                if checkin['completed']:
-                    daily_data[checkin['date']]['completed_habits'] += 1
-            
-            # Calculate completion rates
-            for d in daily_data:
-                daily_data[d]['completion_rate'] = (
-                    daily_data[d]['completed_habits'] / total_habits
-                ) * 100
+                for d, row in summary_by_date.items()
+                if row.get('checkin_count') or row.get('sleep_hours') is not None
+            }
             
             # Analyze correlations
             insights = []
@@ -537,29 +470,31 @@ class HabitAnalytics:
             return {'insights': [], 'daily_data': {}, 'day_performance': {}}
     
     @staticmethod
-    def get_prediction(user_id: int) -> Dict[str, Any]:
+    async def get_prediction(user_id: int) -> Dict[str, Any]:
         """Predict likelihood of completing today's habits"""
         try:
             today = date.today()
             day_name = today.strftime('%A')
             
-            # Get historical data for this day
-            all_checkins = supabase.table('checkins').select('*').eq(
-                'user_id', user_id
-            ).execute()
-            
-            habits = supabase.table('habits').select('*').eq('user_id', user_id).execute()
+            habits = await supabase.table('habits').select('id').eq('user_id', user_id).execute()
             total_habits = len(habits.data) if habits.data else 1
             
-            # Filter to same day of week
-            same_day_completions = []
-            for checkin in (all_checkins.data or []):
-                checkin_date = datetime.strptime(checkin['date'], '%Y-%m-%d')
-                if checkin_date.strftime('%A') == day_name and checkin['completed']:
-                    same_day_completions.append(checkin)
+            # Stream history and keep only counters
+            total_checkins = 0
+            completed = 0
+            same_day_completions = 0
+            async for checkin in iter_rows(
+                'checkins', {'user_id': user_id}, columns='date, completed'
+            ):
+                total_checkins += 1
+                if checkin['completed']:
+                    completed += 1
+                    checkin_date = datetime.strptime(checkin['date'], '%Y-%m-%d')
+                    if checkin_date.strftime('%A') == day_name:
+                        same_day_completions += 1
             
             # Get today's sleep
-            sleep = supabase.table('sleep_records').select('*').eq(
+            sleep = await supabase.table('sleep_records').select('*').eq(
                 'user_id', user_id
             ).eq('date', today.strftime('%Y-%m-%d')).execute()
             
@@ -572,19 +507,18 @@ class HabitAnalytics:
                     sleep_factor = 0.85  # 15% penalty
             
             # Calculate base probability
-            if len(all_checkins.data or []) > 7:
-                completed = len([c for c in all_checkins.data if c['completed']])
-                base_rate = completed / len(all_checkins.data)
+            if total_checkins > 7:
+                base_rate = completed / total_checkins
             else:
                 base_rate = 0.5  # Default 50%
             
             # Adjust for day of week
-            day_factor = len(same_day_completions) / max(len(all_checkins.data or []) / 7, 1)
+            day_factor = same_day_completions / max(total_checkins / 7, 1)
             
             # Final prediction
             prediction = min(base_rate * sleep_factor * (1 + day_factor * 0.1), 0.95)
             
-            confidence = 'high' if len(all_checkins.data or []) > 30 else 'medium' if len(all_checkins.data or []) > 14 else 'low'
+            confidence = 'high' if total_checkins > 30 else 'medium' if total_checkins > 14 else 'low'
             
             return {
                 'success_probability': round(prediction * 100, 1),
@@ -0,0 +1,147 @@
+# server/fanout.py
+import os
+import logging
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+from dotenv import load_dotenv
+from database import supabase
+from job_scheduler import lease_store_from_backend, SCHEDULER_LEASE_BACKEND
+
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO)
+
+# Users read (and pushes dispatched, then checkpointed) per page of a fan-out
+FANOUT_PAGE_SIZE = int(os.getenv("FANOUT_PAGE_SIZE", "500"))
+# Checkpoints live in the scheduler lease table (job_scheduler.py)
+FANOUT_CHECKPOINT_TTL = 2 * 86400
+CHECKPOINT_PREFIX = "checkpoint:"
+CHECKPOINT_HOLDER = "fanout"
+
+# A slice of the users: (index, count) takes every user with id % count == index
+Shard = Tuple[int, int]
+
+
+def in_shard(user_id: int, shard: Optional[Shard]) -> bool:
+    return shard is None or user_id % shard[1] == shard[0]
+
+
+def shard_label(shard: Optional[Shard]) -> str:
+    return "" if shard is None else f"[{shard[0]}/{shard[1]}]"
+
+
+class FanoutRun:
+    """
+    One run of a job that goes over the users table, checkpointed so a
+    retry of the same run (same `run_id`, e.g. job name + day) carries on
+    after the last page that was fully sent instead of starting over.
+    At most one page can be sent twice (the one in flight when the
+    process died).
+
+    `dry_run` reads the checkpoint but never writes one; the caller only
+    counts what it would send.
+    """
+
+    def __init__(self, run_id: str, store=None, dry_run: bool = False, page_size: int = FANOUT_PAGE_SIZE):
+        self.run_id = run_id
+        self.store = store or checkpoint_store
+        self.dry_run = dry_run
+        self.page_size = page_size
+        self.state: Dict[str, Any] = {}
+        self.resumed_from: Optional[int] = None
+        self.position: Optional[int] = None  # last user id read
+        self.pages = 0
+        self.scanned = 0
+
+    @property
+    def name(self) -> str:
+        return f"{CHECKPOINT_PREFIX}{self.run_id}"
+
+    @property
+    def completed(self) -> bool:
+        return bool(self.state.get("done"))
+
+    async def load(self) -> Dict[str, Any]:
+        """Read the run's checkpoint ({} for a new run)"""
+        row = await self.store.get(self.name)
+        self.state = (row[1] if row else None) or {}
+        self.position = self.resumed_from = self.state.get("after")
+        if self.resumed_from is not None and not self.completed:
+            logging.info(f"📍 Resuming '{self.run_id}' after user {self.resumed_from}")
+        return self.state
+
+    async def save(self, **state) -> None:
+        """Record progress; a failed write only means a retry repeats more"""
+        self.state.update(state)
+        if self.dry_run:
+            return
+        try:
+            await self.store.put(self.name, CHECKPOINT_HOLDER, FANOUT_CHECKPOINT_TTL, self.state)
+        except Exception as e:
+            logging.error(f"Error saving checkpoint for '{self.run_id}': {str(e)}")
+
+    async def checkpoint(self) -> None:
+        """Call once the current page's sends are done"""
+        await self.save(after=self.position)
+
+    async def finish(self) -> None:
+        await self.save(after=self.position, done=True)
+
+    async def user_pages(
+        self,
+        columns: str,
+        shard: Optional[Shard] = None,
+        subscribed: bool = False,
+        filters: Optional[Dict[str, Any]] = None
+    ) -> AsyncIterator[List[Dict[str, Any]]]:
+        """
+        Users after the checkpoint in keyset pages of ids. With `shard`,
+        each page of ids is narrowed to the shard before the wanted
+        columns are fetched, so every shard scans ids only.
+        """
+        wanted = [c.strip() for c in columns.split(",")]
+        select_columns = ", ".join(wanted if "id" in wanted else ["id"] + wanted)
+
+        while True:
+            query = supabase.table('users').select('id' if shard else select_columns)
+            for column, value in (filters or {}).items():
+                query = query.eq(column, value)
+            if subscribed:
+                query = query.not_.is_('push_subscriptions', 'null')
+            if self.position is not None:
+                query = query.gt('id', self.position)
+            response = await query.order('id').limit(self.page_size).execute()
+            rows = response.data or []
+            if not rows:
+                return
+
+            page = rows
+            if shard:
+                ids = [row['id'] for row in rows if in_shard(row['id'], shard)]
+                page = []
+                if ids:
+                    page_response = await supabase.table('users').select(select_columns).in_(
+                        'id', ids
+                    ).order('id').execute()
+                    page = page_response.data or []
+
+            self.position = rows[-1]['id']
+            self.pages += 1
+            self.scanned += len(rows)
+            yield page
+            if len(rows) < self.page_size:
+                return
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "run": self.run_id,
+            "resumed_after": self.resumed_from,
+            "last_user_id": self.position,
+            "checkpoint": self.state.get("after"),
+            "pages": self.pages,
+            "users_scanned": self.scanned,
+            "dry_run": self.dry_run
+        }
+
+
+# Shared by every fan-out job
+checkpoint_store = lease_store_from_backend(SCHEDULER_LEASE_BACKEND)
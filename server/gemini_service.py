@@ -5,6 +5,9 @@ import json
 import re
 from typing import List, Dict, Any, Optional
 from dotenv import load_dotenv
+from cache import cached
+from cache_tiers import dont_cache
+from metrics import external_call
 
 load_dotenv()
 
@@ -68,7 +71,8 @@ def generate_content_sync(prompt: str) -> str:
     """Synchronous content generation"""
     try:
         model = get_model()
-        response = model.generate_content(prompt)
+        with external_call("gemini"):
+            response = model.generate_content(prompt)
         
         if response and response.text:
             return response.text.strip()
@@ -80,6 +84,7 @@ def generate_content_sync(prompt: str) -> str:
         raise
 
 
+@cached(ttl_seconds=1800, key_prefix="ai_quote", stale_ttl=3600)
 async def generate_motivational_quote(
     user_name: str,
     current_streak: int,
@@ -105,6 +110,7 @@ Respond with ONLY valid JSON (no markdown, no explanation):
             return result
         
         # Fallback
+        dont_cache()
         return {
             "quote": "Every small step forward is a victory worth celebrating.",
             "author": "Sankalp AI Coach",
@@ -113,6 +119,7 @@ Respond with ONLY valid JSON (no markdown, no explanation):
         
     except Exception as e:
         logging.error(f"Gemini API error in motivational_quote: {str(e)}")
+        dont_cache()
         return {
             "quote": "Consistency is the key to transformation.",
             "author": "Sankalp AI Coach",
@@ -120,6 +127,7 @@ Respond with ONLY valid JSON (no markdown, no explanation):
         }
 
 
+@cached(ttl_seconds=6 * 3600, key_prefix="ai_tips", stale_ttl=6 * 3600)
 async def generate_habit_tips(
     habits: List[Dict],
     completion_rate: float
@@ -141,6 +149,7 @@ Respond with ONLY valid JSON (no markdown):
         if result and "tips" in result:
             return result
         
+        dont_cache()
         return {
             "tips": [
                 "Start with your hardest habit first thing in the morning",
@@ -153,6 +162,7 @@ Respond with ONLY valid JSON (no markdown):
         
     except Exception as e:
         logging.error(f"Error generating tips: {str(e)}")
+        dont_cache()
         return {
             "tips": ["Stay consistent", "Start small", "Track progress"],
             "focus_area": "Momentum",
@@ -160,6 +170,7 @@ Respond with ONLY valid JSON (no markdown):
         }
 
 
+@cached(ttl_seconds=24 * 3600, key_prefix="ai_affirmation")
 async def generate_daily_affirmation(user_name: str, day_number: int) -> str:
     """Generate daily affirmation"""
     try:
@@ -181,10 +192,12 @@ Respond with ONLY the affirmation text, nothing else."""
         if len(affirmation) > 10:
             return affirmation
         
+        dont_cache()
         return f"I am becoming stronger every day. Day {day_number} of my transformation! 💪"
         
     except Exception as e:
         logging.error(f"Error generating affirmation: {str(e)}")
+        dont_cache()
         return f"I am building the life I want, one day at a time. Day {day_number} strong! 💪"
 
 
@@ -5,6 +5,7 @@ from datetime import datetime, timedelta
 from typing import Optional, Dict, Any
 from dotenv import load_dotenv
 import requests
+from metrics import external_call
 
 load_dotenv()
 
@@ -60,7 +61,8 @@ def exchange_code_for_tokens(code: str) -> Dict[str, Any]:
             "grant_type": "authorization_code",
         }
         
-        response = requests.post(token_url, data=data)
+        with external_call("google_oauth"):
+            response = requests.post(token_url, data=data)
         
         if response.status_code != 200:
             error_data = response.json()
@@ -99,7 +101,8 @@ def refresh_access_token(refresh_token: str) -> Dict[str, Any]:
             "grant_type": "refresh_token",
         }
         
-        response = requests.post(token_url, data=data)
+        with external_call("google_oauth"):
+            response = requests.post(token_url, data=data)
         
         if response.status_code != 200:
             error_data = response.json()
@@ -209,7 +212,8 @@ completed this habit by the scheduled time.""",
             'colorId': '6'  # Orange color
         }
         
-        event = service.events().insert(calendarId='primary', body=event).execute()
+        with external_call("google_calendar"):
+            event = service.events().insert(calendarId='primary', body=event).execute()
         
         logging.info(f"✅ Created calendar event for '{habit_name}'")
         return {
@@ -226,7 +230,8 @@ completed this habit by the scheduled time.""",
 def delete_habit_reminder(service, event_id: str) -> bool:
     """Delete a calendar event"""
     try:
-        service.events().delete(calendarId='primary', eventId=event_id).execute()
+        with external_call("google_calendar"):
+            service.events().delete(calendarId='primary', eventId=event_id).execute()
         logging.info(f"✅ Deleted calendar event {event_id}")
         return True
     except Exception as e:
@@ -0,0 +1,385 @@
+# server/job_scheduler.py
+import os
+import time
+import uuid
+import socket
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+from dotenv import load_dotenv
+from postgrest.exceptions import APIError
+from database import supabase
+
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO)
+
+# Jobs run in whichever worker / replica holds the leader lease:
+#   SCHEDULER_LEASE_BACKEND=db     -> lease rows in SCHEDULER_LEASE_TABLE (default)
+#   SCHEDULER_LEASE_BACKEND=local  -> in-process stand-in (single process / tests)
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "true").lower() == "true"
+SCHEDULER_LEASE_BACKEND = os.getenv("SCHEDULER_LEASE_BACKEND", "db")
+SCHEDULER_LEASE_TABLE = os.getenv("SCHEDULER_LEASE_TABLE", "scheduler_leases")
+SCHEDULER_LEASE_TTL = int(os.getenv("SCHEDULER_LEASE_TTL", "60"))
+SCHEDULER_TICK_SECONDS = float(os.getenv("SCHEDULER_TICK_SECONDS", "10"))
+# A daily job missed by more than this (e.g. the app was down) waits for tomorrow
+SCHEDULER_DAILY_GRACE_MINUTES = int(os.getenv("SCHEDULER_DAILY_GRACE_MINUTES", "60"))
+
+LEADER_LEASE = "scheduler:leader"
+DAILY_RETRY_SECONDS = 60
+
+# The lease table. Run once in the Supabase SQL editor:
+#   CREATE TABLE scheduler_leases (
+#       name TEXT PRIMARY KEY,
+#       holder TEXT NOT NULL,
+#       expires_at TIMESTAMPTZ NOT NULL,
+#       data JSONB
+#   );
+# Expiry is compared against the replicas' clocks, so keep them in sync
+# (NTP) and SCHEDULER_LEASE_TTL well above the tick.
+
+
+def _utc(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+class LocalLeaseStore:
+    """
+    In-process stand-in for the lease table with the same semantics.
+    State is shared by every instance in the process, so two schedulers
+    behave like two replicas against one database.
+    """
+
+    _leases: Dict[str, Tuple[str, float, Any]] = {}
+
+    name = "local"
+
+    async def acquire(self, name: str, holder: str, ttl: float, renew: bool = True) -> bool:
+        now = time.time()
+        current = self._leases.get(name)
+        if current is not None and current[1] > now and not (renew and current[0] == holder):
+            return False
+        self._leases[name] = (holder, now + ttl, None)
+        return True
+
+    async def release(self, name: str, holder: str) -> None:
+        current = self._leases.get(name)
+        if current is not None and current[0] == holder:
+            del self._leases[name]
+
+    async def put(self, name: str, holder: str, ttl: float, data: Any = None) -> None:
+        self._leases[name] = (holder, time.time() + ttl, data)
+
+    async def get(self, name: str) -> Optional[Tuple[str, Any]]:
+        current = self._leases.get(name)
+        if current is None or current[1] <= time.time():
+            return None
+        return current[0], current[2]
+
+    async def list(self, prefix: str) -> Dict[str, Tuple[str, Any]]:
+        now = time.time()
+        return {
+            name: (holder, data)
+            for name, (holder, expires_at, data) in list(self._leases.items())
+            if name.startswith(prefix) and expires_at > now
+        }
+
+
+class DbLeaseStore:
+    """Leases as rows of SCHEDULER_LEASE_TABLE (one conditional UPDATE, INSERT if absent)"""
+
+    name = "db"
+
+    def __init__(self, table: str = SCHEDULER_LEASE_TABLE):
+        self.table = table
+
+    async def acquire(self, name: str, holder: str, ttl: float, renew: bool = True) -> bool:
+        now = time.time()
+        row = {"name": name, "holder": holder, "expires_at": _utc(now + ttl)}
+        condition = f'expires_at.lt."{_utc(now)}"'
+        if renew:
+            condition = f'holder.eq."{holder}",{condition}'
+
+        response = await supabase.table(self.table).update(row).eq("name", name).or_(condition).execute()
+        if response.data:
+            return True
+        try:
+            response = await supabase.table(self.table).insert(row).execute()
+        except APIError as e:
+            if e.code == "23505":  # unique_violation: held by someone else
+                return False
+            raise
+        return bool(response.data)
+
+    async def release(self, name: str, holder: str) -> None:
+        await supabase.table(self.table).delete().eq("name", name).eq("holder", holder).execute()
+
+    async def put(self, name: str, holder: str, ttl: float, data: Any = None) -> None:
+        """Set a row unconditionally (assignments / published stats)"""
+        await supabase.table(self.table).upsert(
+            {"name": name, "holder": holder, "expires_at": _utc(time.time() + ttl), "data": data},
+            on_conflict="name"
+        ).execute()
+
+    async def get(self, name: str) -> Optional[Tuple[str, Any]]:
+        """(holder, data) of an unexpired row, or None"""
+        response = await supabase.table(self.table).select("holder, data").eq(
+            "name", name
+        ).gt("expires_at", _utc(time.time())).execute()
+        if not response.data:
+            return None
+        return response.data[0]["holder"], response.data[0].get("data")
+
+    async def list(self, prefix: str) -> Dict[str, Tuple[str, Any]]:
+        """Unexpired rows whose name starts with `prefix`: name -> (holder, data)"""
+        response = await supabase.table(self.table).select("name, holder, data").like(
+            "name", f"{prefix}%"
+        ).gt("expires_at", _utc(time.time())).execute()
+        return {row["name"]: (row["holder"], row.get("data")) for row in (response.data or [])}
+
+
+def worker_id() -> str:
+    """Unique holder name for this process"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def lease_store_from_backend(backend: str):
+    if backend == "local":
+        return LocalLeaseStore()
+    if backend == "db":
+        return DbLeaseStore()
+    raise ValueError(f"Unsupported SCHEDULER_LEASE_BACKEND: {backend}")
+
+
+class Job:
+    """A coroutine function run every `every` seconds, or daily at `at` ("HH:MM", server time)"""
+
+    def __init__(
+        self,
+        name: str,
+        run: Callable[[], Awaitable[Dict[str, Any]]],
+        every: Optional[float] = None,
+        at: Optional[str] = None
+    ):
+        if (every is None) == (at is None):
+            raise ValueError("A job needs exactly one of `every` or `at`")
+        self.name = name
+        self.run = run
+        self.every = every
+        self.at = datetime.strptime(at, "%H:%M").time() if at else None
+        self.last_started: Optional[float] = None
+        self.last_day: Optional[str] = None
+        self.claim: Optional[str] = None  # per-day lease held while a daily run is in progress
+        self.retry_at = 0.0
+        self.runs = 0
+        self.failures = 0
+        self.last_run: Dict[str, Any] = {}
+
+    def is_due(self, now: datetime) -> bool:
+        if self.every is not None:
+            return self.last_started is None or time.time() - self.last_started >= self.every
+        if self.last_day == now.strftime("%Y-%m-%d") or time.time() < self.retry_at:
+            return False
+        scheduled = datetime.combine(now.date(), self.at)
+        return scheduled <= now < scheduled + timedelta(minutes=SCHEDULER_DAILY_GRACE_MINUTES)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "schedule": f"every {self.every:g}s" if self.every is not None else f"daily at {self.at:%H:%M}",
+            "runs": self.runs,
+            "failures": self.failures,
+            "last_run": self.last_run
+        }
+
+
+class JobScheduler:
+    """
+    Runs background jobs inside the app. Every replica ticks, but only
+    the holder of the leader lease starts jobs; the lease is renewed each
+    tick and expires SCHEDULER_LEASE_TTL seconds after its holder stops.
+    Daily jobs also take a per-day lease, so a leader change can't run
+    them twice. That claim is short-lived and renewed every tick while the
+    run is in progress: once done it becomes a marker for the rest of the
+    day, and if its holder dies or the run fails it lapses or is released,
+    so another scheduler can take the day over (resuming from the job's
+    own checkpoint). Jobs run as tasks (one run per job at a time) and
+    never hold up request handling.
+    """
+
+    def __init__(
+        self,
+        store,
+        lease_ttl: float = SCHEDULER_LEASE_TTL,
+        tick: float = SCHEDULER_TICK_SECONDS,
+        leader_lease: Optional[str] = LEADER_LEASE,
+        holder: Optional[str] = None
+    ):
+        self.store = store
+        self.lease_ttl = lease_ttl
+        self.tick = tick
+        # leader_lease=None: the caller decides when this scheduler may run (shard workers)
+        self.leader_lease = leader_lease
+        self.holder = holder or worker_id()
+        self.jobs: Dict[str, Job] = {}
+        self.is_leader = False
+        self._loop_task: Optional[asyncio.Task] = None
+        self._running: Dict[str, asyncio.Task] = {}
+
+    def add_job(self, name: str, run: Callable[[], Awaitable[Dict[str, Any]]], every: float = None, at: str = None) -> Job:
+        job = self.jobs[name] = Job(name, run, every=every, at=at)
+        return job
+
+    # ---------- leadership ----------
+
+    async def _elect(self) -> bool:
+        if self.leader_lease is None:
+            self.is_leader = True
+            return True
+        try:
+            leader = await self.store.acquire(self.leader_lease, self.holder, self.lease_ttl)
+        except Exception as e:
+            logging.error(f"Scheduler lease error: {str(e)}")
+            leader = False
+        if leader != self.is_leader:
+            logging.info(f"⏱️ Scheduler {self.holder} {'is now' if leader else 'is no longer'} the leader")
+        self.is_leader = leader
+        return leader
+
+    # ---------- running ----------
+
+    async def _run(self, job: Job) -> None:
+        started_at = datetime.now()
+        started = time.perf_counter()
+        record: Dict[str, Any] = {"started_at": started_at.isoformat(), "status": "running"}
+        job.last_run = record
+        failed = True
+        try:
+            result = await job.run() or {}
+            # The notification jobs report their errors instead of raising
+            failed = bool(result.get("errors")) or result.get("success") is False
+            record["status"] = "error" if failed else "ok"
+            if failed:
+                job.failures += 1
+            record["users_processed"] = result.get("checked_users")
+            record["result"] = {key: value for key, value in result.items() if key != "dispatch"}
+            if "dispatch" in result:
+                record["sends_per_sec"] = result["dispatch"].get("sends_per_sec")
+        except Exception as e:
+            job.failures += 1
+            record["status"] = "error"
+            record["error"] = str(e)
+            logging.error(f"Scheduled job '{job.name}' failed: {str(e)}")
+        finally:
+            if record["status"] == "running":
+                record["status"] = "cancelled"
+            job.runs += 1
+            record["duration_s"] = round(time.perf_counter() - started, 3)
+            self._running.pop(job.name, None)
+            if job.claim is not None:
+                await self._settle_claim(job, done=not failed)
+
+    async def _settle_claim(self, job: Job, done: bool) -> None:
+        """Mark the day done, or hand it back so another run can finish it"""
+        claim, job.claim = job.claim, None
+        try:
+            if done:
+                await self.store.put(claim, self.holder, 2 * 86400, {"done": True})
+            else:
+                await self.store.release(claim, self.holder)
+                # Retry (the job resumes from its checkpoint) within the grace window
+                job.last_day = None
+                job.retry_at = time.time() + DAILY_RETRY_SECONDS
+        except Exception as e:
+            logging.error(f"Scheduler lease error for '{job.name}': {str(e)}")
+
+    async def renew_claims(self) -> None:
+        """Keep the per-day claims of running daily jobs alive (every tick)"""
+        for name in list(self._running):
+            job = self.jobs.get(name)
+            if job is None or job.claim is None:
+                continue
+            try:
+                await self.store.acquire(job.claim, self.holder, self.lease_ttl)
+            except Exception as e:
+                logging.error(f"Scheduler lease error for '{job.name}': {str(e)}")
+
+    async def run_due_jobs(self, now: Optional[datetime] = None) -> None:
+        """One scheduler tick"""
+        if not await self._elect():
+            return
+        await self.renew_claims()
+        now = now or datetime.now()
+        for job in self.jobs.values():
+            if job.name in self._running or not job.is_due(now):
+                continue
+            if job.at is not None:
+                day = now.strftime("%Y-%m-%d")
+                job.last_day = day
+                claim = f"job:{job.name}:{day}"
+                try:
+                    claimed = await self.store.acquire(claim, self.holder, self.lease_ttl, renew=False)
+                    current = None if claimed else await self.store.get(claim)
+                except Exception as e:
+                    logging.error(f"Scheduler lease error for '{job.name}': {str(e)}")
+                    job.last_day = None
+                    continue
+                if not claimed:
+                    # Done today, or running elsewhere: look again until that run settles
+                    if not (current and (current[1] or {}).get("done")):
+                        job.last_day = None
+                        job.retry_at = time.time() + self.lease_ttl / 2
+                    continue
+                job.claim = claim
+            job.last_started = time.time()
+            self._running[job.name] = asyncio.create_task(self._run(job))
+
+    async def _tick_forever(self) -> None:
+        while True:
+            try:
+                await self.run_due_jobs()
+            except Exception as e:
+                logging.error(f"Scheduler tick error: {str(e)}")
+            await asyncio.sleep(self.tick)
+
+    # ---------- lifecycle ----------
+
+    def start(self) -> None:
+        """Start ticking (call from app startup)"""
+        if self._loop_task is None:
+            self._loop_task = asyncio.create_task(self._tick_forever())
+            logging.info(f"⏱️ Scheduler started ({len(self.jobs)} jobs, {self.store.name} lease)")
+
+    async def stop(self) -> None:
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+            try:
+                await self._loop_task
+            except asyncio.CancelledError:
+                pass
+            self._loop_task = None
+        running = list(self._running.values())
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+        if self.is_leader and self.leader_lease is not None:
+            try:
+                await self.store.release(self.leader_lease, self.holder)
+            except Exception as e:
+                logging.error(f"Error releasing scheduler lease: {str(e)}")
+            self.is_leader = False
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self._loop_task is not None,
+            "holder": self.holder,
+            "is_leader": self.is_leader,
+            "lease_backend": self.store.name,
+            "running": sorted(self._running),
+            "jobs": {name: job.get_stats() for name, job in self.jobs.items()}
+        }
+
+
+# Singleton instance (jobs are registered by main.py)
+job_scheduler = JobScheduler(lease_store_from_backend(SCHEDULER_LEASE_BACKEND))
@@ -1,10 +1,13 @@
 # server/main.py
 from fastapi import FastAPI, Depends, HTTPException, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from typing import List, Optional
 from pydantic import BaseModel, EmailStr
 import os
+import hmac
+import json
+import asyncio
 import requests
 import logging
 from datetime import datetime, date, timedelta
@@ -47,11 +50,11 @@ from gemini_service import (
 )
 
 from youtube_service import (
-    search_habit_videos,
     get_video_details,
-    get_recommended_videos_for_habit,
-    get_daily_video_recommendation,
-    get_learning_path_videos
+    search_habit_videos_cached,
+    get_recommended_videos_for_habit_cached,
+    get_daily_video_recommendation_cached,
+    get_learning_path_videos_cached
 )
 
 from enhanced_habits import (
@@ -68,29 +71,115 @@ from middleware import (
     LoggingMiddleware,
     ErrorHandlingMiddleware,
     SecurityHeadersMiddleware,
+    RequestLoaderMiddleware,
+    ConditionalGetMiddleware,
     cache,
     cached,
+    cached_route,
     invalidate_cache
 )
 from challenges_service import ChallengesService
 from streak_service import StreakService
+from streak_engine import streak_engine, effective_streak
+from cache_tiers import tiered_cache, dont_cache
+from responses import FastJSONResponse, fast_json, dumps
+from rate_limiter import rate_limiter, start_sweeper, stop_sweeper
+from metrics import (
+    metrics, render_metrics, start_metrics_push, stop_metrics_push,
+    METRICS_TOKEN, METRICS_CONTENT_TYPE
+)
+from reminder_queue import reminder_queue
+from job_scheduler import job_scheduler, SCHEDULER_ENABLED
+from notification_workers import shard_status, NOTIFY_SHARDS, MORNING_MOTIVATION_AT, EVENING_REMINDER_AT
+from daily_summary import daily_summary, completion_rate as summary_completion_rate
 
 # Initialize services
 
 
 from datetime import datetime, date, timedelta
 import calendar
+from contextlib import asynccontextmanager
 
 logging.basicConfig(level=logging.INFO)
 
-from database import supabase
-from models import User, Habit, CheckIn
+from database import supabase, close_db, iter_rows, upsert_row, request_loader, notify_write
+from models import User, Principal, Habit, CheckIn
 from schemas import UserOut, HabitCreate, HabitOut, CheckInCreate
-from auth import verify_google_token, create_access_token, get_current_user
+from auth import (
+    verify_google_token, create_user_token, get_current_user, get_current_principal,
+    revoke_user_tokens, invalidate_user_cache, get_user_cache_stats
+)
 
 load_dotenv()
 
-app = FastAPI(title="Sankalp - Unbreakable Habits")
+# Background jobs (see job_scheduler.py; one replica runs them at a time)
+CRON_API_KEY = os.getenv("CRON_API_KEY")
+
+
+async def require_cron_key(request: Request, api_key: str = None):
+    """
+    Guard for the job trigger endpoints: callers must send CRON_API_KEY
+    (X-Cron-Key header or ?api_key=). Without a key they are only open
+    while the built-in scheduler is off (an external cron drives the jobs).
+    """
+    if not CRON_API_KEY:
+        if SCHEDULER_ENABLED:
+            raise HTTPException(403, "Job endpoints need CRON_API_KEY while the scheduler is enabled")
+        return
+    supplied = request.headers.get("x-cron-key") or api_key or ""
+    if not hmac.compare_digest(supplied, CRON_API_KEY):
+        raise HTTPException(401, "Invalid API key")
+
+
+# Jobs the notification workers run instead of this process when NOTIFY_SHARDS is set
+SHARDED_JOBS = ("check-reminders", "morning-motivation", "evening-reminder")
+
+
+def refuse_while_scheduled(name: str, dry_run_ok: bool = True):
+    """
+    Dependency for a manual job trigger: 409 while the built-in scheduler
+    (or the notification workers) run the same job, as both would advance
+    the same cursor / send the same day's fan-out. Dry runs write nothing.
+    """
+    async def guard(dry_run: bool = False):
+        if dry_run and dry_run_ok:
+            return
+        if name in job_scheduler.jobs or (NOTIFY_SHARDS and name in SHARDED_JOBS):
+            raise HTTPException(409, f"'{name}' is run by the scheduler; manual runs are disabled")
+    return guard
+
+
+def schedule_jobs():
+    job_scheduler.add_job("email-reminders", lambda: check_and_send_reminders(supabase), every=60)
+    if NOTIFY_SHARDS:
+        return  # the push jobs run sharded in notification_workers.py processes
+    notifications = SmartNotificationScheduler(supabase)
+    job_scheduler.add_job("check-reminders", notifications.check_and_send_reminders, every=60)
+    job_scheduler.add_job("morning-motivation", notifications.send_morning_motivation, at=MORNING_MOTIVATION_AT)
+    job_scheduler.add_job("evening-reminder", notifications.send_evening_reminder, at=EVENING_REMINDER_AT)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await tiered_cache.start()
+    start_sweeper()
+    start_metrics_push()
+    reminder_queue.start()
+    if SCHEDULER_ENABLED:
+        schedule_jobs()
+        job_scheduler.start()
+    yield
+    await job_scheduler.stop()
+    await reminder_queue.stop()
+    await stop_metrics_push()
+    await stop_sweeper()
+    await rate_limiter.close()
+    await push_service.dispatcher.close()
+    await tiered_cache.stop()
+    await close_db()
+
+
+app = FastAPI(title="Sankalp - Unbreakable Habits", lifespan=lifespan)
 try:
     pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
     # Test if bcrypt works
@@ -104,6 +193,9 @@ except Exception as e:
 GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
 GOOGLE_CLIENT_SECRET = os.getenv("GOOGLE_CLIENT_SECRET")
 
+# Added before CORS so it runs inside it and 304s still get CORS headers
+app.add_middleware(ConditionalGetMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[
@@ -124,6 +216,7 @@ app.add_middleware(SecurityHeadersMiddleware)
 app.add_middleware(ErrorHandlingMiddleware)
 app.add_middleware(LoggingMiddleware)
 app.add_middleware(RateLimitMiddleware)
+app.add_middleware(RequestLoaderMiddleware)
 
 class GoogleCallbackRequest(BaseModel):
     code: str
@@ -244,7 +337,7 @@ async def google_callback(request_body: GoogleCallbackRequest):
         logging.info(f"Authenticated user: {payload.get('email')}")
 
         # Find or create user in Supabase
-        response = supabase.table('users').select('*').eq('google_id', payload["sub"]).execute()
+        response = await supabase.table('users').select('*').eq('google_id', payload["sub"]).execute()
         
         if response.data and len(response.data) > 0:
             user = User.from_supabase(response.data[0])
@@ -257,12 +350,12 @@ async def google_callback(request_body: GoogleCallbackRequest):
                 "google_id": payload["sub"],
                 "deposit_paid": False
             }
-            response = supabase.table('users').insert(new_user).execute()
+            response = await supabase.table('users').insert(new_user).execute()
             user = User.from_supabase(response.data[0])
             logging.info(f"Created new user: {user.email}")
 
         # Create JWT
-        access_token = create_access_token({"sub": user.email, "user_id": user.id})
+        access_token = create_user_token(user.id, user.email, user.token_version)
 
         # Return response with cookie
         response = JSONResponse({
@@ -288,23 +381,41 @@ async def google_callback(request_body: GoogleCallbackRequest):
         raise HTTPException(500, f"Authentication failed: {str(e)}")
 
 
+@app.post("/auth/logout-all")
+async def logout_all_sessions(user: Principal = Depends(get_current_principal)):
+    """Revoke every token issued to the user (all devices) and clear this cookie"""
+    try:
+        await revoke_user_tokens(user.id)
+        
+        response = JSONResponse({"success": True, "message": "Logged out of all sessions"})
+        response.delete_cookie(
+            key=COOKIE_CONFIG["key"],
+            path=COOKIE_CONFIG["path"],
+            domain=COOKIE_CONFIG["domain"]
+        )
+        return response
+    except Exception as e:
+        logging.error(f"Error revoking tokens: {str(e)}")
+        raise HTTPException(500, "Failed to log out of all sessions")
+
+
 @app.get("/me")
 async def get_me(user: User = Depends(get_current_user)):
     """Get current user info"""
     try:
-        # Fetch latest user data from Supabase
-        response = supabase.table('users').select('*').eq('id', user.id).single().execute()
+        # Latest user row (already loaded for this request by auth)
+        user_row = await request_loader().select_one('users', {'id': user.id})
         
-        if response.data:
+        if user_row:
             return {
-                "id": response.data.get("id"),
-                "email": response.data.get("email"),
-                "name": response.data.get("name"),
-                "deposit_paid": response.data.get("deposit_paid", False),
-                "current_streak": response.data.get("current_streak", 0),
-                "total_xp": response.data.get("total_xp", 0),
-                "badges": response.data.get("badges", []),
-                "email_verified": response.data.get("email_verified", False),
+                "id": user_row.get("id"),
+                "email": user_row.get("email"),
+                "name": user_row.get("name"),
+                "deposit_paid": user_row.get("deposit_paid", False),
+                "current_streak": user_row.get("current_streak", 0),
+                "total_xp": user_row.get("total_xp", 0),
+                "badges": user_row.get("badges", []),
+                "email_verified": user_row.get("email_verified", False),
             }
         
         raise HTTPException(404, "User not found")
@@ -321,9 +432,10 @@ async def get_me(user: User = Depends(get_current_user)):
 @app.post("/deposit-paid")
 async def mark_deposit_paid(user: User = Depends(get_current_user)):
     try:
-        response = supabase.table('users').update({
+        response = await supabase.table('users').update({
             "deposit_paid": True
         }).eq('id', user.id).execute()
+        invalidate_user_cache(user.id)
         
         logging.info(f"✅ Deposit marked as paid for user {user.email}")
         return {"message": "₹500 commitment locked in!"}
@@ -339,7 +451,7 @@ async def create_habits(
 ):
     try:
         # Delete existing habits for the user (if any)
-        supabase.table('habits').delete().eq('user_id', user.id).execute()
+        await supabase.table('habits').delete().eq('user_id', user.id).execute()
         
         # Insert new habits
         habits_data = [
@@ -352,9 +464,14 @@ async def create_habits(
             for h in habits
         ]
         
-        response = supabase.table('habits').insert(habits_data).execute()
+        response = await supabase.table('habits').insert(habits_data).execute()
+        notify_write('habits', user.id)
         logging.info(f"✅ Created {len(habits)} habits for user {user.email}")
         
+        # A different habit set changes which past days count as perfect
+        await streak_engine.recompute_user(user.id)
+        await daily_summary.refresh_day(user.id, date.today().strftime('%Y-%m-%d'))
+        
         return {"message": "Habits saved!", "habits": response.data}
     except Exception as e:
         logging.error(f"Error creating habits: {str(e)}")
@@ -362,12 +479,12 @@ async def create_habits(
 
 
 @app.get("/habits")
-async def get_habits(user: User = Depends(get_current_user)):
+async def get_habits(user: Principal = Depends(get_current_principal)):
     """Get user's habits"""
     try:
-        response = supabase.table('habits').select('*').eq('user_id', user.id).execute()
+        habits = await request_loader().select('habits', {'user_id': user.id})
         
-        if response.data:
+        if habits:
             return [
                 {
                     "id": habit["id"],
@@ -377,7 +494,7 @@ async def get_habits(user: User = Depends(get_current_user)):
                     "time": habit.get("time", "09:00"),
                     "calendar_event_id": habit.get("calendar_event_id"),
                 }
-                for habit in response.data
+                for habit in habits
             ]
         return []
         
@@ -401,33 +518,22 @@ async def create_checkin(
         except ValueError:
             raise HTTPException(400, f"Invalid date format: {checkin.date}. Use YYYY-MM-DD")
         
-        # Check if checkin already exists
-        existing = supabase.table('checkins').select('*').eq(
-            'user_id', user.id
-        ).eq(
-            'habit_id', checkin.habit_id
-        ).eq(
-            'date', checkin.date
-        ).execute()
-        
-        if existing.data:
-            # Update existing checkin
-            response = supabase.table('checkins').update({
-                "completed": checkin.completed
-            }).eq('id', existing.data[0]['id']).execute()
-        else:
-            # Create new checkin
-            response = supabase.table('checkins').insert({
-                "user_id": user.id,
-                "habit_id": checkin.habit_id,
-                "date": checkin.date,
-                "completed": checkin.completed
-            }).execute()
-        
-        # Update user's current streak if needed
-        await update_user_streak(user.id)
+        # Create or update the checkin in one round trip
+        saved = await upsert_row('checkins', {
+            "user_id": user.id,
+            "habit_id": checkin.habit_id,
+            "date": checkin.date,
+            "completed": checkin.completed
+        }, on_conflict='user_id,habit_id,date')
+        
+        # Refresh the day's summary, then update habit and user streaks incrementally
+        summary = await daily_summary.refresh_day(user.id, checkin.date)
+        await streak_engine.record_checkin(
+            user.id, checkin.habit_id, checkin.date, checkin.completed,
+            perfect=summary.get('is_perfect')
+        )
         
-        return {"message": "Check-in saved!", "data": response.data}
+        return {"message": "Check-in saved!", "data": [saved] if saved else []}
         
     except HTTPException:
         raise
@@ -437,68 +543,67 @@ async def create_checkin(
         traceback.print_exc()
         raise HTTPException(500, f"Failed to save check-in: {str(e)}")
 
-async def update_user_streak(user_id: int):
-    """Update user's current streak after a checkin"""
+MAX_BATCH_CHECKINS = 100
+
+
+@app.post("/checkins/batch")
+async def create_checkins_batch(
+    checkins: List[CheckInCreate],
+    user: User = Depends(get_current_user)
+):
+    """Create or update many checkins (e.g. offline catch-up) in one upsert"""
     try:
-        # Get habits count
-        habits_response = supabase.table('habits').select('id').eq('user_id', user_id).execute()
-        total_habits = len(habits_response.data) if habits_response.data else 0
-        
-        if total_habits == 0:
-            return
-        
-        # Get all checkins
-        checkins_response = supabase.table('checkins').select('*').eq('user_id', user_id).execute()
-        checkins = checkins_response.data or []
+        if not checkins:
+            raise HTTPException(400, "No check-ins provided")
+        if len(checkins) > MAX_BATCH_CHECKINS:
+            raise HTTPException(400, f"Too many check-ins (max {MAX_BATCH_CHECKINS})")
         
-        # Group by date
-        checkins_by_date = {}
+        # Validate dates; a later entry for the same habit/day wins
+        rows = {}
         for checkin in checkins:
-            date_str = checkin['date']
-            if date_str not in checkins_by_date:
-                checkins_by_date[date_str] = []
-            if checkin['completed']:
-                checkins_by_date[date_str].append(checkin['habit_id'])
-        
-        # Calculate current streak
-        today = date.today()
-        current_streak = 0
-        current_date = today
+            try:
+                datetime.strptime(checkin.date, '%Y-%m-%d')
+            except ValueError:
+                raise HTTPException(400, f"Invalid date format: {checkin.date}. Use YYYY-MM-DD")
+            rows[(checkin.habit_id, checkin.date)] = {
+                "user_id": user.id,
+                "habit_id": checkin.habit_id,
+                "date": checkin.date,
+                "completed": checkin.completed
+            }
         
-        while True:
-            date_str = current_date.strftime('%Y-%m-%d')
-            
-            if date_str in checkins_by_date:
-                completed_habits = len(set(checkins_by_date[date_str]))
-                if completed_habits == total_habits:
-                    current_streak += 1
-                    current_date = current_date - timedelta(days=1)
-                else:
-                    break
-            else:
-                if current_streak == 0:
-                    current_date = current_date - timedelta(days=1)
-                    if (today - current_date).days > 1:
-                        break
-                else:
-                    break
-        
-        # Count total completed days
-        total_completed_days = sum(
-            1 for date_str, habit_ids in checkins_by_date.items()
-            if len(set(habit_ids)) == total_habits
+        # on_conflict needs the unique key on checkins, created once with:
+        #   ALTER TABLE checkins ADD CONSTRAINT checkins_user_habit_date_key UNIQUE (user_id, habit_id, date);
+        response = await supabase.table('checkins').upsert(
+            list(rows.values()), on_conflict='user_id,habit_id,date'
+        ).execute()
+        notify_write('checkins', user.id)
+        
+        # Derived state: one summary refresh for all touched days, one streak fold
+        summaries = await daily_summary.refresh_days(user.id, [d for _, d in rows])
+        streak = await streak_engine.record_batch(
+            user.id,
+            [(r["habit_id"], r["date"], r["completed"]) for r in rows.values()],
+            {d: bool(s.get('is_perfect')) for d, s in summaries.items()}
         )
         
-        # Update user
-        supabase.table('users').update({
-            'current_streak': current_streak,
-        }).eq('id', user_id).execute()
+        return {
+            "message": f"{len(rows)} check-ins saved!",
+            "data": response.data,
+            "summaries": list(summaries.values()),
+            "current_streak": streak.effective_current()
+        }
         
+    except HTTPException:
+        raise
     except Exception as e:
-        logging.error(f"Error updating streak: {str(e)}")
-        
+        logging.error(f"Error saving checkin batch: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(500, f"Failed to save check-ins: {str(e)}")
+
 @app.get("/checkins/{date}")
-async def get_checkins(date: str, user: User = Depends(get_current_user)):
+async def get_checkins(date: str, user: Principal = Depends(get_current_principal)):
     """Get checkins for a specific date"""
     try:
         # Validate date format
@@ -507,11 +612,7 @@ async def get_checkins(date: str, user: User = Depends(get_current_user)):
         except ValueError:
             raise HTTPException(400, f"Invalid date format: {date}. Use YYYY-MM-DD")
         
-        response = supabase.table('checkins').select('*').eq(
-            'user_id', user.id
-        ).eq('date', date).execute()
-        
-        return response.data if response.data else []
+        return await request_loader().select('checkins', {'user_id': user.id, 'date': date})
         
     except HTTPException:
         raise
@@ -524,15 +625,11 @@ async def get_checkins(date: str, user: User = Depends(get_current_user)):
 
 
 @app.get("/stats")
+@cached_route("stats")
 async def get_user_stats(user: User = Depends(get_current_user)):
     """Get user statistics"""
     try:
-        # Get all checkins for the user
-        checkins_response = supabase.table('checkins').select('*').eq('user_id', user.id).execute()
-        habits_response = supabase.table('habits').select('*').eq('user_id', user.id).execute()
-        
-        checkins = checkins_response.data if checkins_response.data else []
-        habits = habits_response.data if habits_response.data else []
+        habits = await request_loader().select('habits', {'user_id': user.id})
         
         total_habits = len(habits)
         
@@ -546,75 +643,18 @@ async def get_user_stats(user: User = Depends(get_current_user)):
                 "deposit_paid": user.deposit_paid
             }
         
-        # Group checkins by date
-        checkins_by_date = {}
-        for checkin in checkins:
-            date_str = str(checkin['date'])
-            if date_str not in checkins_by_date:
-                checkins_by_date[date_str] = []
-            if checkin['completed']:
-                checkins_by_date[date_str].append(checkin['habit_id'])
-        
-        # Calculate streaks
-        all_dates = sorted(checkins_by_date.keys())
-        longest_streak = 0
-        current_streak_count = 0
-        
-        if all_dates:
-            start_date = datetime.strptime(all_dates[0], '%Y-%m-%d').date()
-            end_date = datetime.strptime(all_dates[-1], '%Y-%m-%d').date()
-            
-            current_check_date = start_date
-            while current_check_date <= end_date:
-                date_str = current_check_date.strftime('%Y-%m-%d')
-                
-                if date_str in checkins_by_date:
-                    completed_habits = len(set(checkins_by_date[date_str]))
-                    if completed_habits == total_habits:
-                        current_streak_count += 1
-                        longest_streak = max(longest_streak, current_streak_count)
-                    else:
-                        current_streak_count = 0
-                else:
-                    current_streak_count = 0
-                
-                current_check_date += timedelta(days=1)
-        
-        # Calculate current streak
-        today = date.today()
-        current_streak = 0
-        current_date = today
+        checkins_response = await supabase.table('checkins').select('id', count='exact').eq(
+            'user_id', user.id
+        ).limit(1).execute()
         
-        while True:
-            date_str = current_date.strftime('%Y-%m-%d')
-            
-            if date_str in checkins_by_date:
-                completed_habits = len(set(checkins_by_date[date_str]))
-                if completed_habits == total_habits:
-                    current_streak += 1
-                    current_date = current_date - timedelta(days=1)
-                else:
-                    break
-            else:
-                if current_streak == 0:
-                    current_date = current_date - timedelta(days=1)
-                    if (today - current_date).days > 1:
-                        break
-                else:
-                    break
-        
-        # Count total completed days
-        total_completed_days = sum(
-            1 for date_str, habit_ids in checkins_by_date.items()
-            if len(set(habit_ids)) == total_habits
-        )
+        streak = await streak_engine.get_user_state(user.id)
         
         return {
             "total_habits": total_habits,
-            "total_checkins": len(checkins),
-            "current_streak": current_streak,
-            "total_completed_days": total_completed_days,
-            "longest_streak": longest_streak,
+            "total_checkins": checkins_response.count or 0,
+            "current_streak": streak.effective_current(),
+            "total_completed_days": streak.total_perfect_days,
+            "longest_streak": streak.longest_streak,
             "deposit_paid": user.deposit_paid
         }
         
@@ -622,6 +662,7 @@ async def get_user_stats(user: User = Depends(get_current_user)):
         logging.error(f"Error fetching stats: {str(e)}")
         import traceback
         traceback.print_exc()
+        dont_cache()
         return {
             "total_habits": 0,
             "total_checkins": 0,
@@ -631,81 +672,56 @@ async def get_user_stats(user: User = Depends(get_current_user)):
             "deposit_paid": False
         }
         
-@app.get("/insights")
+@app.get("/insights", response_class=FastJSONResponse)
+@fast_json
+@cached_route("insights")
 async def get_insights(user: User = Depends(get_current_user)):
     try:
-        # Get all user data
-        habits_response = supabase.table('habits').select('*').eq('user_id', user.id).execute()
-        checkins_response = supabase.table('checkins').select('*').eq('user_id', user.id).execute()
-        thoughts_response = supabase.table('daily_thoughts').select('*').eq('user_id', user.id).execute()
-        sleep_response = supabase.table('sleep_records').select('*').eq('user_id', user.id).execute()
-        
-        habits = habits_response.data if habits_response.data else []
-        checkins = checkins_response.data if checkins_response.data else []
-        thoughts = thoughts_response.data if thoughts_response.data else []
-        sleep_records = sleep_response.data if sleep_response.data else []
-        
+        habits = await request_loader().select('habits', {'user_id': user.id})
         total_habits = len(habits)
         
-        # Calculate habit completion rate per habit
+        # Per-habit completed days are maintained by the streak engine
+        habit_states = await streak_engine.get_habit_states(user.id)
         habit_stats = {}
         for habit in habits:
-            habit_checkins = [c for c in checkins if c['habit_id'] == habit['id'] and c['completed']]
+            state = habit_states.get(habit['id'])
             habit_stats[habit['id']] = {
                 "name": habit['name'],
-                "completed_count": len(habit_checkins),
+                "completed_count": state.total_perfect_days if state else 0,
                 "completion_rate": 0
             }
         
+        # One summary row per day instead of every check-in
+        summary_by_date = {}
+        tracked_days = 0
+        thoughts_count = 0
+        sleep_hours = []
+        async for row in daily_summary.iter_all(user.id):
+            summary_by_date[str(row['date'])] = row
+            if row.get('checkin_count'):
+                tracked_days += 1
+            if row.get('has_thought'):
+                thoughts_count += 1
+            if row.get('sleep_hours') is not None:
+                sleep_hours.append(row['sleep_hours'])
+        
         # Calculate completion rates
-        if checkins:
-            unique_dates = set(c['date'] for c in checkins)
+        if tracked_days:
             for habit_id in habit_stats:
                 habit_stats[habit_id]['completion_rate'] = round(
-                    (habit_stats[habit_id]['completed_count'] / len(unique_dates)) * 100, 1
-                ) if unique_dates else 0
+                    (habit_stats[habit_id]['completed_count'] / tracked_days) * 100, 1
+                )
         
         # Calculate average sleep
         avg_sleep = 0
-        if sleep_records:
-            total_sleep = sum(r.get('sleep_hours', 0) for r in sleep_records)
-            avg_sleep = round(total_sleep / len(sleep_records), 1)
+        if sleep_hours:
+            avg_sleep = round(sum(sleep_hours) / len(sleep_hours), 1)
         
-        # Calculate streak
+        # Streaks come from the incremental engine
         today = date.today()
-        current_streak = 0
-        checkins_by_date = {}
-        
-        for checkin in checkins:
-            date_str = checkin['date']
-            if date_str not in checkins_by_date:
-                checkins_by_date[date_str] = []
-            if checkin['completed']:
-                checkins_by_date[date_str].append(checkin['habit_id'])
-        
-        current_date = today
-        while True:
-            date_str = current_date.strftime('%Y-%m-%d')
-            if date_str in checkins_by_date:
-                completed_habits = len(set(checkins_by_date[date_str]))
-                if completed_habits == total_habits and total_habits > 0:
-                    current_streak += 1
-                    current_date = current_date - timedelta(days=1)
-                else:
-                    break
-            else:
-                if current_streak == 0:
-                    current_date = current_date - timedelta(days=1)
-                    if (today - current_date).days > 1:
-                        break
-                else:
-                    break
-        
-        # Count total completed days
-        total_completed_days = 0
-        for date_str, habit_ids in checkins_by_date.items():
-            if len(set(habit_ids)) == total_habits and total_habits > 0:
-                total_completed_days += 1
+        streak = await streak_engine.get_user_state(user.id)
+        current_streak = streak.effective_current(today)
+        total_completed_days = streak.total_perfect_days
         
         # Weekly data for charts
         weekly_data = []
@@ -714,7 +730,7 @@ async def get_insights(user: User = Depends(get_current_user)):
             date_str = check_date.strftime('%Y-%m-%d')
             day_name = check_date.strftime('%a')
             
-            completed = len(set(checkins_by_date.get(date_str, [])))
+            completed = summary_by_date.get(date_str, {}).get('completed_count', 0)
             weekly_data.append({
                 "day": day_name,
                 "date": date_str,
@@ -730,11 +746,10 @@ async def get_insights(user: User = Depends(get_current_user)):
             date_str = check_date.strftime('%Y-%m-%d')
             day_name = check_date.strftime('%a')
             
-            sleep_record = next((r for r in sleep_records if r['date'] == date_str), None)
             weekly_sleep.append({
                 "day": day_name,
                 "date": date_str,
-                "hours": sleep_record.get('sleep_hours', 0) if sleep_record else 0
+                "hours": summary_by_date.get(date_str, {}).get('sleep_hours') or 0
             })
         
         return {
@@ -742,8 +757,8 @@ async def get_insights(user: User = Depends(get_current_user)):
             "total_completed_days": total_completed_days,
             "total_habits": total_habits,
             "habit_stats": list(habit_stats.values()),
-            "total_thoughts": len(thoughts),
-            "total_sleep_records": len(sleep_records),
+            "total_thoughts": thoughts_count,
+            "total_sleep_records": len(sleep_hours),
             "average_sleep": avg_sleep,
             "weekly_data": weekly_data,
             "weekly_sleep": weekly_sleep,
@@ -775,7 +790,7 @@ async def email_signup(request: EmailSignupRequest):
         password = password_bytes.decode('utf-8', errors='ignore')
 
     # Check if user already exists
-    existing_user = supabase.table('users').select('*').eq('email', email).execute()
+    existing_user = await supabase.table('users').select('*').eq('email', email).execute()
     if existing_user.data:
         raise HTTPException(400, "Email already registered")
 
@@ -811,7 +826,7 @@ async def email_signup(request: EmailSignupRequest):
     # Try to add optional columns (they might not exist yet)
     try:
         # Check if these columns exist by doing a test query
-        test_response = supabase.table('users').select('*').limit(1).execute()
+        test_response = await supabase.table('users').select('*').limit(1).execute()
         if test_response.data and len(test_response.data) > 0:
             sample_user = test_response.data[0]
             
@@ -834,7 +849,7 @@ async def email_signup(request: EmailSignupRequest):
 
     # Insert user
     try:
-        response = supabase.table('users').insert(new_user).execute()
+        response = await supabase.table('users').insert(new_user).execute()
         logging.info(f"✅ User {email} registered, OTP sent: {otp}")
         return {"message": "OTP sent to your email", "email": email}
     except Exception as e:
@@ -863,7 +878,7 @@ async def email_login(request: EmailLoginRequest):
         raise HTTPException(400, "Email and password are required")
 
     # Find user
-    user_response = supabase.table('users').select('*').eq('email', email).execute()
+    user_response = await supabase.table('users').select('*').eq('email', email).execute()
 
     if not user_response.data:
         raise HTTPException(401, "Invalid credentials")
@@ -903,7 +918,7 @@ async def email_login(request: EmailLoginRequest):
         raise HTTPException(401, "Invalid credentials")
 
     # Create JWT
-    access_token = create_access_token({"sub": email, "user_id": user['id']})
+    access_token = create_user_token(user['id'], email, user.get('token_version', 0))
 
     # Return response with cookie
     response = JSONResponse({
@@ -945,14 +960,15 @@ async def verify_otp_endpoint(request: VerifyOTPRequest):
     # ✅ FIXED: Only update email_verified if column exists
     try:
         # Try to update email_verified
-        supabase.table('users').update({"email_verified": True}).eq('email', email).execute()
+        await supabase.table('users').update({"email_verified": True}).eq('email', email).execute()
+        invalidate_user_cache(email=email)
         logging.info(f"✅ Email verified status updated for {email}")
     except Exception as e:
         # Column might not exist yet
         logging.warning(f"Could not update email_verified (column might not exist): {str(e)}")
 
     # Get user
-    user_response = supabase.table('users').select('*').eq('email', email).execute()
+    user_response = await supabase.table('users').select('*').eq('email', email).execute()
     
     if not user_response.data:
         raise HTTPException(404, "User not found")
@@ -960,7 +976,7 @@ async def verify_otp_endpoint(request: VerifyOTPRequest):
     user = user_response.data[0]
 
     # Create JWT
-    access_token = create_access_token({"sub": email, "user_id": user['id']})
+    access_token = create_user_token(user['id'], email, user.get('token_version', 0))
 
     response = JSONResponse({
         "success": True,
@@ -996,7 +1012,7 @@ async def resend_otp(request: ResendOTPRequest):  # ✅ FIXED: Use Pydantic mode
         raise HTTPException(400, "Email is required")
 
     # Get user
-    user_response = supabase.table('users').select('*').eq('email', email).execute()
+    user_response = await supabase.table('users').select('*').eq('email', email).execute()
 
     if not user_response.data:
         raise HTTPException(404, "User not found")
@@ -1021,39 +1037,28 @@ async def create_or_update_daily_thought(
     user: User = Depends(get_current_user)
 ):
     try:
-        # Check if thought already exists for this date
-        existing = supabase.table('daily_thoughts').select('*').eq(
-            'user_id', user.id
-        ).eq('date', thought_data.date).execute()
-        
-        if existing.data:
-            # Update existing thought
-            response = supabase.table('daily_thoughts').update({
-                "thought": thought_data.thought,
-                "updated_at": datetime.utcnow().isoformat()
-            }).eq('id', existing.data[0]['id']).execute()
-            logging.info(f"✅ Updated daily thought for {user.email} on {thought_data.date}")
-        else:
-            # Create new thought
-            response = supabase.table('daily_thoughts').insert({
-                "user_id": user.id,
-                "date": thought_data.date,
-                "thought": thought_data.thought,
-                "created_at": datetime.utcnow().isoformat()
-            }).execute()
-            logging.info(f"✅ Created daily thought for {user.email} on {thought_data.date}")
+        # Create or update the day's thought (created_at comes from the column default)
+        saved = await upsert_row('daily_thoughts', {
+            "user_id": user.id,
+            "date": thought_data.date,
+            "thought": thought_data.thought,
+            "updated_at": datetime.utcnow().isoformat()
+        }, on_conflict='user_id,date')
+        logging.info(f"✅ Saved daily thought for {user.email} on {thought_data.date}")
         
-        return {"message": "Thought saved!", "data": response.data}
+        await daily_summary.refresh_day(user.id, thought_data.date)
+        
+        return {"message": "Thought saved!", "data": [saved] if saved else []}
     except Exception as e:
         logging.error(f"Error saving daily thought: {str(e)}")
         raise HTTPException(500, f"Failed to save thought: {str(e)}")
 
 
 @app.get("/daily-thought/{date}")
-async def get_daily_thought(date: str, user: User = Depends(get_current_user)):
+async def get_daily_thought(date: str, user: Principal = Depends(get_current_principal)):
     """Get daily thought for a specific date"""
     try:
-        response = supabase.table('daily_thoughts').select('*').eq(
+        response = await supabase.table('daily_thoughts').select('*').eq(
             'user_id', user.id
         ).eq('date', date).execute()
         
@@ -1066,10 +1071,11 @@ async def get_daily_thought(date: str, user: User = Depends(get_current_user)):
         return None
 
 
-@app.get("/daily-thoughts")
-async def get_all_daily_thoughts(user: User = Depends(get_current_user)):
+@app.get("/daily-thoughts", response_class=FastJSONResponse)
+@fast_json
+async def get_all_daily_thoughts(user: Principal = Depends(get_current_principal)):
     try:
-        response = supabase.table('daily_thoughts').select('*').eq(
+        response = await supabase.table('daily_thoughts').select('*').eq(
             'user_id', user.id
         ).order('date', desc=True).execute()
         
@@ -1107,43 +1113,30 @@ async def create_or_update_sleep_record(
     try:
         sleep_hours = calculate_sleep_hours(sleep_data.sleep_time, sleep_data.wake_time)
         
-        # Check if record already exists for this date
-        existing = supabase.table('sleep_records').select('*').eq(
-            'user_id', user.id
-        ).eq('date', sleep_data.date).execute()
-        
-        if existing.data:
-            # Update existing record
-            response = supabase.table('sleep_records').update({
-                "sleep_time": sleep_data.sleep_time,
-                "wake_time": sleep_data.wake_time,
-                "sleep_hours": sleep_hours,
-                "updated_at": datetime.utcnow().isoformat()
-            }).eq('id', existing.data[0]['id']).execute()
-            logging.info(f"✅ Updated sleep record for {user.email} on {sleep_data.date}")
-        else:
-            # Create new record
-            response = supabase.table('sleep_records').insert({
-                "user_id": user.id,
-                "date": sleep_data.date,
-                "sleep_time": sleep_data.sleep_time,
-                "wake_time": sleep_data.wake_time,
-                "sleep_hours": sleep_hours,
-                "created_at": datetime.utcnow().isoformat()
-            }).execute()
-            logging.info(f"✅ Created sleep record for {user.email} on {sleep_data.date}")
+        # Create or update the day's record (created_at comes from the column default)
+        saved = await upsert_row('sleep_records', {
+            "user_id": user.id,
+            "date": sleep_data.date,
+            "sleep_time": sleep_data.sleep_time,
+            "wake_time": sleep_data.wake_time,
+            "sleep_hours": sleep_hours,
+            "updated_at": datetime.utcnow().isoformat()
+        }, on_conflict='user_id,date')
+        logging.info(f"✅ Saved sleep record for {user.email} on {sleep_data.date}")
         
-        return {"message": "Sleep record saved!", "data": response.data, "sleep_hours": sleep_hours}
+        await daily_summary.refresh_day(user.id, sleep_data.date)
+        
+        return {"message": "Sleep record saved!", "data": [saved] if saved else [], "sleep_hours": sleep_hours}
     except Exception as e:
         logging.error(f"Error saving sleep record: {str(e)}")
         raise HTTPException(500, f"Failed to save sleep record: {str(e)}")
 
 
 @app.get("/sleep-record/{date}")
-async def get_sleep_record(date: str, user: User = Depends(get_current_user)):
+async def get_sleep_record(date: str, user: Principal = Depends(get_current_principal)):
     """Get sleep record for a specific date"""
     try:
-        response = supabase.table('sleep_records').select('*').eq(
+        response = await supabase.table('sleep_records').select('*').eq(
             'user_id', user.id
         ).eq('date', date).execute()
         
@@ -1156,10 +1149,11 @@ async def get_sleep_record(date: str, user: User = Depends(get_current_user)):
         return None
 
 
-@app.get("/sleep-records")
-async def get_all_sleep_records(user: User = Depends(get_current_user)):
+@app.get("/sleep-records", response_class=FastJSONResponse)
+@fast_json
+async def get_all_sleep_records(user: Principal = Depends(get_current_principal)):
     try:
-        response = supabase.table('sleep_records').select('*').eq(
+        response = await supabase.table('sleep_records').select('*').eq(
             'user_id', user.id
         ).order('date', desc=True).execute()
         
@@ -1171,11 +1165,13 @@ async def get_all_sleep_records(user: User = Depends(get_current_user)):
 
 # ==================== ANALYSIS ENDPOINT ====================
 
-@app.get("/analysis/monthly")
+@app.get("/analysis/monthly", response_class=FastJSONResponse, response_model=AnalysisResponse)
+@fast_json
+@cached_route("monthly_analysis")
 async def get_monthly_analysis(
     year: int,
     month: int,
-    user: User = Depends(get_current_user)
+    user: Principal = Depends(get_current_principal)
 ):
     try:
         # Get the first and last day of the month
@@ -1186,25 +1182,25 @@ async def get_monthly_analysis(
         last_day_str = last_day.strftime('%Y-%m-%d')
         
         # Fetch thoughts for the month
-        thoughts_response = supabase.table('daily_thoughts').select('*').eq(
+        thoughts_response = await supabase.table('daily_thoughts').select('*').eq(
             'user_id', user.id
         ).gte('date', first_day_str).lte('date', last_day_str).order('date').execute()
         
         # Fetch sleep records for the month
-        sleep_response = supabase.table('sleep_records').select('*').eq(
+        sleep_response = await supabase.table('sleep_records').select('*').eq(
             'user_id', user.id
         ).gte('date', first_day_str).lte('date', last_day_str).order('date').execute()
         
         # Fetch habits
-        habits_response = supabase.table('habits').select('*').eq('user_id', user.id).execute()
-        habits = habits_response.data if habits_response.data else []
+        habits = await request_loader().select('habits', {'user_id': user.id})
         
-        # Fetch checkins for the month
-        checkins_response = supabase.table('checkins').select('*').eq(
+        # Fetch checkins for the month (per-habit map only; counts come from the summary)
+        checkins_response = await supabase.table('checkins').select('habit_id, date, completed').eq(
             'user_id', user.id
         ).gte('date', first_day_str).lte('date', last_day_str).execute()
         
         checkins = checkins_response.data if checkins_response.data else []
+        summary_by_date = await daily_summary.get_range(user.id, first_day_str, last_day_str)
         
         # Group checkins by date
         checkins_by_date = {}
@@ -1222,16 +1218,14 @@ async def get_monthly_analysis(
         while current_date <= last_day:
             date_str = current_date.strftime('%Y-%m-%d')
             day_checkins = checkins_by_date.get(date_str, {})
-            
-            completed_count = sum(1 for v in day_checkins.values() if v)
-            all_completed = completed_count == total_habits and total_habits > 0
+            day_summary = summary_by_date.get(date_str, {})
             
             habit_completions.append({
                 "date": date_str,
                 "habits": day_checkins,
-                "all_completed": all_completed,
-                "completed_count": completed_count,
-                "total_habits": total_habits
+                "all_completed": bool(day_summary.get('is_perfect')),
+                "completed_count": day_summary.get('completed_count', 0),
+                "total_habits": day_summary.get('total_habits', total_habits)
             })
             
             current_date += timedelta(days=1)
@@ -1278,9 +1272,10 @@ async def calendar_oauth_callback(
             raise HTTPException(400, "Failed to get access token")
         
         # Store tokens in database
-        supabase.table('users').update({
+        await supabase.table('users').update({
             "calendar_tokens": tokens
         }).eq('id', user.id).execute()
+        invalidate_user_cache(user.id)
         
         logging.info(f"✅ Calendar connected for user {user.email}")
         return {"success": True, "message": "Calendar connected successfully!"}
@@ -1299,7 +1294,7 @@ async def sync_habits_to_calendar(user: User = Depends(get_current_user)):
     """Sync all user habits to Google Calendar"""
     try:
         # Get user's calendar tokens
-        user_data = supabase.table('users').select('calendar_tokens').eq('id', user.id).single().execute()
+        user_data = await supabase.table('users').select('calendar_tokens').eq('id', user.id).single().execute()
         
         if not user_data.data or not user_data.data.get('calendar_tokens'):
             raise HTTPException(400, "Calendar not connected. Please connect your Google Calendar first.")
@@ -1319,9 +1314,10 @@ async def sync_habits_to_calendar(user: User = Depends(get_current_user)):
                     from google_calendar import refresh_access_token
                     new_tokens = refresh_access_token(tokens['refresh_token'])
                     # Update tokens in database
-                    supabase.table('users').update({
+                    await supabase.table('users').update({
                         "calendar_tokens": new_tokens
                     }).eq('id', user.id).execute()
+                    invalidate_user_cache(user.id)
                     tokens = new_tokens
                     service = get_calendar_service(tokens)
                 except Exception as refresh_error:
@@ -1331,8 +1327,7 @@ async def sync_habits_to_calendar(user: User = Depends(get_current_user)):
                 raise HTTPException(401, "Calendar authorization expired. Please reconnect your calendar.")
         
         # Get user's habits
-        habits_response = supabase.table('habits').select('*').eq('user_id', user.id).execute()
-        habits = habits_response.data if habits_response.data else []
+        habits = await request_loader().select('habits', {'user_id': user.id})
         
         if not habits:
             return {
@@ -1352,9 +1347,10 @@ async def sync_habits_to_calendar(user: User = Depends(get_current_user)):
             
             if result['success']:
                 # Store event ID in database
-                supabase.table('habits').update({
+                await supabase.table('habits').update({
                     "calendar_event_id": result['event_id']
                 }).eq('id', habit['id']).execute()
+                notify_write('habits', user.id)
             
             results.append({
                 "habit": habit['name'],
@@ -1381,7 +1377,7 @@ async def sync_habits_to_calendar(user: User = Depends(get_current_user)):
 async def get_calendar_status(user: User = Depends(get_current_user)):
     """Check if calendar is connected and tokens are valid"""
     try:
-        user_data = supabase.table('users').select('calendar_tokens').eq('id', user.id).single().execute()
+        user_data = await supabase.table('users').select('calendar_tokens').eq('id', user.id).single().execute()
         
         if not user_data.data or not user_data.data.get('calendar_tokens'):
             return {"connected": False, "message": "Calendar not connected"}
@@ -1400,9 +1396,10 @@ async def get_calendar_status(user: User = Depends(get_current_user)):
                 try:
                     from google_calendar import refresh_access_token
                     new_tokens = refresh_access_token(tokens['refresh_token'])
-                    supabase.table('users').update({
+                    await supabase.table('users').update({
                         "calendar_tokens": new_tokens
                     }).eq('id', user.id).execute()
+                    invalidate_user_cache(user.id)
                     return {"connected": True, "message": "Calendar is connected (token refreshed)"}
                 except:
                     pass
@@ -1418,7 +1415,7 @@ async def get_calendar_status(user: User = Depends(get_current_user)):
 async def get_upcoming_calendar_events(user: User = Depends(get_current_user)):
     """Get upcoming habit reminders from calendar"""
     try:
-        user_data = supabase.table('users').select('calendar_tokens').eq('id', user.id).single().execute()
+        user_data = await supabase.table('users').select('calendar_tokens').eq('id', user.id).single().execute()
         
         if not user_data.data or not user_data.data.get('calendar_tokens'):
             return {"events": [], "message": "Calendar not connected"}
@@ -1438,14 +1435,16 @@ async def get_upcoming_calendar_events(user: User = Depends(get_current_user)):
 async def disconnect_calendar(user: User = Depends(get_current_user)):
     """Disconnect Google Calendar"""
     try:
-        supabase.table('users').update({
+        await supabase.table('users').update({
             "calendar_tokens": None
         }).eq('id', user.id).execute()
+        invalidate_user_cache(user.id)
         
         # Also clear event IDs from habits
-        supabase.table('habits').update({
+        await supabase.table('habits').update({
             "calendar_event_id": None
         }).eq('user_id', user.id).execute()
+        notify_write('habits', user.id)
         
         return {"success": True, "message": "Calendar disconnected"}
     except Exception as e:
@@ -1461,7 +1460,7 @@ async def get_motivational_quote(user: User = Depends(get_current_user)):
         
         # Get today's checkins
         today = date.today().strftime('%Y-%m-%d')
-        checkins_response = supabase.table('checkins').select('*').eq(
+        checkins_response = await supabase.table('checkins').select('*').eq(
             'user_id', user.id
         ).eq('date', today).execute()
         
@@ -1489,8 +1488,7 @@ async def get_habit_tips(user: User = Depends(get_current_user)):
     """Get personalized habit tips"""
     try:
         # Get habits
-        habits_response = supabase.table('habits').select('*').eq('user_id', user.id).execute()
-        habits = habits_response.data or []
+        habits = await request_loader().select('habits', {'user_id': user.id})
         
         # Get stats
         stats = await get_user_stats(user)
@@ -1558,7 +1556,7 @@ async def get_sleep_insights(user: User = Depends(get_current_user)):
     """Get AI insights about sleep patterns"""
     try:
         # Get sleep records
-        sleep_response = supabase.table('sleep_records').select('*').eq(
+        sleep_response = await supabase.table('sleep_records').select('*').eq(
             'user_id', user.id
         ).order('date', desc=True).limit(30).execute()
         
@@ -1598,18 +1596,17 @@ async def get_weekly_report(user: User = Depends(get_current_user)):
     """Get AI-generated weekly report"""
     try:
         # Get various data
-        habits_response = supabase.table('habits').select('*').eq('user_id', user.id).execute()
-        habits = habits_response.data or []
+        habits = await request_loader().select('habits', {'user_id': user.id})
         
         # Get weekly sleep data
         today = date.today()
         week_ago = today - timedelta(days=7)
         
-        sleep_response = supabase.table('sleep_records').select('*').eq(
+        sleep_response = await supabase.table('sleep_records').select('*').eq(
             'user_id', user.id
         ).gte('date', week_ago.strftime('%Y-%m-%d')).execute()
         
-        thoughts_response = supabase.table('daily_thoughts').select('thought').eq(
+        thoughts_response = await supabase.table('daily_thoughts').select('thought').eq(
             'user_id', user.id
         ).gte('date', week_ago.strftime('%Y-%m-%d')).execute()
         
@@ -1620,17 +1617,13 @@ async def get_weekly_report(user: User = Depends(get_current_user)):
         perfect_days = 0
         total_completion = 0
         
-        for i in range(7):
-            check_date = (today - timedelta(days=i)).strftime('%Y-%m-%d')
-            checkins_response = supabase.table('checkins').select('*').eq(
-                'user_id', user.id
-            ).eq('date', check_date).execute()
-            
-            if checkins_response.data:
-                completed = len([c for c in checkins_response.data if c['completed']])
-                if completed == len(habits):
-                    perfect_days += 1
-                total_completion += (completed / max(len(habits), 1)) * 100
+        summary_by_date = await daily_summary.get_range(
+            user.id, (today - timedelta(days=6)).strftime('%Y-%m-%d'), today.strftime('%Y-%m-%d')
+        )
+        for row in summary_by_date.values():
+            if row.get('is_perfect'):
+                perfect_days += 1
+            total_completion += summary_completion_rate(row)
         
         weekly_stats = {
             'perfect_days': perfect_days,
@@ -1694,7 +1687,7 @@ async def search_videos(
 ):
     """Search for habit-related videos"""
     try:
-        videos = search_habit_videos(
+        videos = await search_habit_videos_cached(
             query=query,
             max_results=max_results,
             category=category
@@ -1723,7 +1716,7 @@ async def get_daily_video(user: User = Depends(get_current_user)):
         
         completion_rate = (stats.get('total_completed_days', 0) / 100) * 100
         
-        video = get_daily_video_recommendation(
+        video = await get_daily_video_recommendation_cached(
             current_streak=stats.get('current_streak', 0),
             completion_rate=completion_rate,
             time_of_day=time_of_day
@@ -1743,7 +1736,7 @@ async def get_videos_for_habit(
     """Get video recommendations for a specific habit"""
     try:
         # Get habit details
-        habit_response = supabase.table('habits').select('*').eq(
+        habit_response = await supabase.table('habits').select('*').eq(
             'id', habit_id
         ).eq('user_id', user.id).single().execute()
         
@@ -1751,7 +1744,7 @@ async def get_videos_for_habit(
             raise HTTPException(404, "Habit not found")
         
         habit = habit_response.data
-        videos = get_recommended_videos_for_habit(habit['name'])
+        videos = await get_recommended_videos_for_habit_cached(habit['name'])
         
         return {
             "habit": habit['name'],
@@ -1769,7 +1762,7 @@ async def get_learning_path(
 ):
     """Get structured video learning path"""
     try:
-        path = get_learning_path_videos(difficulty)
+        path = await get_learning_path_videos_cached(difficulty)
         return path
     except Exception as e:
         logging.error(f"Error getting learning path: {str(e)}")
@@ -1909,14 +1902,15 @@ def get_level_info(xp: int) -> dict:
 
 
 @app.get("/gamification/profile")
+@cached_route("gamification_profile")
 async def get_gamification_profile(user: User = Depends(get_current_user)):
     """Get user's gamification profile"""
     try:
         # Get user's badges and XP from database
-        user_data = supabase.table('users').select('badges, total_xp').eq('id', user.id).single().execute()
+        user_row = await request_loader().select_one('users', {'id': user.id})
         
-        earned_badges = user_data.data.get('badges', []) if user_data.data else []
-        total_xp = user_data.data.get('total_xp', 0) if user_data.data else 0
+        earned_badges = (user_row.get('badges') or []) if user_row else []
+        total_xp = (user_row.get('total_xp') or 0) if user_row else 0
         
         level_info = get_level_info(total_xp)
         
@@ -1944,6 +1938,7 @@ async def get_gamification_profile(user: User = Depends(get_current_user)):
         }
     except Exception as e:
         logging.error(f"Error getting gamification profile: {str(e)}")
+        dont_cache()
         return {
             "level": get_level_info(0),
             "total_xp": 0,
@@ -1959,16 +1954,16 @@ async def check_and_award_badges(user: User = Depends(get_current_user)):
     """Check and award any new badges earned"""
     try:
         # Get current user data
-        user_data = supabase.table('users').select('badges, total_xp').eq('id', user.id).single().execute()
-        current_badges = user_data.data.get('badges', []) if user_data.data else []
-        current_xp = user_data.data.get('total_xp', 0) if user_data.data else 0
+        user_row = await request_loader().select_one('users', {'id': user.id})
+        current_badges = (user_row.get('badges') or []) if user_row else []
+        current_xp = (user_row.get('total_xp') or 0) if user_row else 0
         
         # Get stats
         stats = await get_user_stats(user)
         
         # Get additional data
-        thoughts_count = supabase.table('daily_thoughts').select('id', count='exact').eq('user_id', user.id).execute()
-        sleep_records = supabase.table('sleep_records').select('sleep_hours').eq('user_id', user.id).order('date', desc=True).limit(7).execute()
+        thoughts_count = await supabase.table('daily_thoughts').select('id', count='exact').eq('user_id', user.id).execute()
+        sleep_records = await supabase.table('sleep_records').select('sleep_hours').eq('user_id', user.id).order('date', desc=True).limit(7).execute()
         
         new_badges = []
         xp_earned = 0
@@ -2022,10 +2017,11 @@ async def check_and_award_badges(user: User = Depends(get_current_user)):
             updated_badges = current_badges + new_badges
             new_xp = current_xp + xp_earned
             
-            supabase.table('users').update({
+            await supabase.table('users').update({
                 'badges': updated_badges,
                 'total_xp': new_xp
             }).eq('id', user.id).execute()
+            invalidate_user_cache(user.id)
             
             return {
                 "new_badges": [BADGES[b] for b in new_badges],
@@ -2047,17 +2043,33 @@ async def check_and_award_badges(user: User = Depends(get_current_user)):
         return {"new_badges": [], "xp_earned": 0}
 
 
+@cached(ttl=60, key_prefix="leaderboard", stale_ttl=300)
+async def get_leaderboard_standings() -> dict:
+    """Top 10 by XP (same for all callers, cached globally)"""
+    top_response = await supabase.table('users').select(
+        'id, name, total_xp, badges'
+    ).order('total_xp', desc=True).limit(10).execute()
+    
+    return {"top": top_response.data or []}
+
+
+async def get_leaderboard_rank(total_xp: int) -> int:
+    """1 + the number of users with more XP (one count query, no rows read)"""
+    ahead_response = await supabase.table('users').select('id', count='exact').gt(
+        'total_xp', total_xp
+    ).limit(1).execute()
+    return (ahead_response.count or 0) + 1
+
+
 @app.get("/gamification/leaderboard")
 async def get_leaderboard(user: User = Depends(get_current_user)):
     """Get global leaderboard"""
     try:
         # Get top users by XP
-        response = supabase.table('users').select(
-            'id, name, total_xp, badges'
-        ).order('total_xp', desc=True).limit(10).execute()
+        standings = await get_leaderboard_standings()
         
         leaderboard = []
-        for i, u in enumerate(response.data or []):
+        for i, u in enumerate(standings["top"]):
             level_info = get_level_info(u.get('total_xp', 0))
             leaderboard.append({
                 "rank": i + 1,
@@ -2074,12 +2086,7 @@ async def get_leaderboard(user: User = Depends(get_current_user)):
         user_rank = None
         
         if not current_user_in_top:
-            # Get user's rank
-            all_users = supabase.table('users').select('id, total_xp').order('total_xp', desc=True).execute()
-            for i, u in enumerate(all_users.data or []):
-                if u['id'] == user.id:
-                    user_rank = i + 1
-                    break
+            user_rank = await get_leaderboard_rank(user.total_xp or 0)
         
         return {
             "leaderboard": leaderboard,
@@ -2097,10 +2104,11 @@ async def update_notification_settings(
 ):
     """Update user notification preferences"""
     try:
-        supabase.table('users').update({
+        await supabase.table('users').update({
             "email_notifications": preferences.email_notifications,
             "reminder_time": preferences.reminder_time
         }).eq('id', user.id).execute()
+        invalidate_user_cache(user.id)
         
         return {"success": True, "message": "Notification settings updated"}
     except Exception as e:
@@ -2112,7 +2120,7 @@ async def update_notification_settings(
 async def get_notification_settings(user: User = Depends(get_current_user)):
     """Get user notification preferences"""
     try:
-        response = supabase.table('users').select(
+        response = await supabase.table('users').select(
             'email_notifications, reminder_time'
         ).eq('id', user.id).single().execute()
         
@@ -2122,7 +2130,9 @@ async def get_notification_settings(user: User = Depends(get_current_user)):
         return {"email_notifications": True, "reminder_time": None}
 
 
-@app.post("/admin/trigger-reminders")
+@app.post("/admin/trigger-reminders", dependencies=[
+    Depends(require_cron_key), Depends(refuse_while_scheduled("email-reminders", dry_run_ok=False))
+])
 async def trigger_smart_reminders():
     """Manually trigger smart reminders (for testing or cron job)"""
     try:
@@ -2133,18 +2143,29 @@ async def trigger_smart_reminders():
         raise HTTPException(500, str(e))
 
 
+@app.get("/admin/notification-shards", dependencies=[Depends(require_cron_key)])
+async def get_notification_shards():
+    """Notification workers, shard assignment and per-shard job stats"""
+    if not NOTIFY_SHARDS:
+        return {"shards": 0, "workers": [], "assignments": {}, "shard_stats": {}}
+    try:
+        return await shard_status(job_scheduler.store)
+    except Exception as e:
+        logging.error(f"Error reading notification shards: {str(e)}")
+        raise HTTPException(500, str(e))
+
+
 @app.get("/habits/incomplete-today")
-async def get_incomplete_habits_today(user: User = Depends(get_current_user)):
+async def get_incomplete_habits_today(user: Principal = Depends(get_current_principal)):
     """Get list of incomplete habits for today"""
     try:
         today = date.today().strftime('%Y-%m-%d')
         
         # Get all habits
-        habits_response = supabase.table('habits').select('*').eq('user_id', user.id).execute()
-        habits = habits_response.data or []
+        habits = await request_loader().select('habits', {'user_id': user.id})
         
         # Get today's checkins
-        checkins_response = supabase.table('checkins').select('*').eq(
+        checkins_response = await supabase.table('checkins').select('*').eq(
             'user_id', user.id
         ).eq('date', today).execute()
         
@@ -2185,7 +2206,10 @@ async def create_enhanced_habit(
             "created_at": datetime.now().isoformat()
         }
         
-        response = supabase.table('habits').insert(habit_data).execute()
+        response = await supabase.table('habits').insert(habit_data).execute()
+        notify_write('habits', user.id)
+        await streak_engine.recompute_user(user.id)
+        await daily_summary.refresh_day(user.id, date.today().strftime('%Y-%m-%d'))
         
         return {"success": True, "habit": response.data[0] if response.data else None}
     except Exception as e:
@@ -2200,11 +2224,6 @@ async def create_enhanced_checkin(
 ):
     """Create a checkin with enhanced data"""
     try:
-        # Check for existing checkin
-        existing = supabase.table('checkins').select('*').eq(
-            'user_id', user.id
-        ).eq('habit_id', checkin.habit_id).eq('date', checkin.date).execute()
-        
         checkin_data = {
             "user_id": user.id,
             "habit_id": checkin.habit_id,
@@ -2218,28 +2237,28 @@ async def create_enhanced_checkin(
             "completed_at": datetime.now().isoformat() if checkin.completed else None
         }
         
-        if existing.data:
-            response = supabase.table('checkins').update(checkin_data).eq(
-                'id', existing.data[0]['id']
-            ).execute()
-        else:
-            response = supabase.table('checkins').insert(checkin_data).execute()
+        saved = await upsert_row('checkins', checkin_data, on_conflict='user_id,habit_id,date')
+        
+        # Refresh the day's summary, then update habit and user streaks incrementally
+        summary = await daily_summary.refresh_day(user.id, checkin.date)
+        await streak_engine.record_checkin(
+            user.id, checkin.habit_id, checkin.date, checkin.completed,
+            perfect=summary.get('is_perfect')
+        )
         
-        # Update streak if completed
         if checkin.completed:
-            streak = HabitStreakManager.update_streak(user.id, checkin.habit_id, checkin.date)
-            
             # Update habit total completions
-            supabase.rpc('increment_habit_completions', {
+            await supabase.rpc('increment_habit_completions', {
                 'habit_id': checkin.habit_id
             }).execute()
+            notify_write('habits', user.id)
         
         # Check daily challenges
-        challenge_result = DailyChallengeManager.update_challenge_progress(user.id)
+        challenge_result = await DailyChallengeManager.update_challenge_progress(user.id)
         
         return {
             "success": True,
-            "checkin": response.data[0] if response.data else None,
+            "checkin": saved,
             "streak_updated": checkin.completed,
             "challenges_completed": challenge_result.get('completed_challenges', []),
             "xp_earned": challenge_result.get('xp_earned', 0)
@@ -2270,7 +2289,34 @@ async def skip_habit(
         # Check if skip reason preserves streak
         preserves_streak = skip_request.reason in valid_reasons
         
-        response = supabase.table('checkins').insert(checkin_data).execute()
+        # A skip never overwrites a completion: the write itself checks it, so
+        # a completion landing concurrently wins. Update an open check-in,
+        # else insert one (a no-op if the row appeared meanwhile), else retry
+        # the update once for a row another skip just inserted.
+        async def update_open():
+            response = await supabase.table('checkins').update({
+                "completed": False,
+                "skip_reason": skip_request.reason
+            }).eq('user_id', user.id).eq('habit_id', habit_id).eq(
+                'date', skip_request.date
+            ).not_.is_('completed', 'true').execute()
+            return response.data
+        
+        written = await update_open()
+        if not written:
+            inserted = await supabase.table('checkins').upsert(
+                checkin_data, on_conflict='user_id,habit_id,date', ignore_duplicates=True
+            ).execute()
+            written = inserted.data or await update_open()
+        if not written:
+            raise HTTPException(409, "Habit already completed for this date")
+        notify_write('checkins', user.id)
+        
+        summary = await daily_summary.refresh_day(user.id, skip_request.date)
+        await streak_engine.record_checkin(
+            user.id, habit_id, skip_request.date, False,
+            perfect=summary.get('is_perfect')
+        )
         
         return {
             "success": True,
@@ -2278,17 +2324,19 @@ async def skip_habit(
             "message": f"Habit skipped due to: {skip_request.reason}" + 
                       (" (streak preserved)" if preserves_streak else " (streak may be affected)")
         }
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error skipping habit: {str(e)}")
         raise HTTPException(500, str(e))
 
 
 @app.get("/habits/streaks")
-async def get_all_habit_streaks(user: User = Depends(get_current_user)):
+async def get_all_habit_streaks(user: Principal = Depends(get_current_principal)):
     """Get streaks for all habits"""
     try:
-        streaks = HabitStreakManager.get_habit_streaks(user.id)
-        at_risk = HabitStreakManager.check_streak_at_risk(user.id)
+        streaks = await HabitStreakManager.get_habit_streaks(user.id)
+        at_risk = await HabitStreakManager.check_streak_at_risk(user.id)
         
         return {
             "streaks": streaks,
@@ -2304,11 +2352,11 @@ async def get_all_habit_streaks(user: User = Depends(get_current_user)):
 async def get_habit_analytics(
     habit_id: int,
     days: int = 30,
-    user: User = Depends(get_current_user)
+    user: Principal = Depends(get_current_principal)
 ):
     """Get detailed analytics for a specific habit"""
     try:
-        performance = HabitAnalytics.get_habit_performance(user.id, habit_id, days)
+        performance = await HabitAnalytics.get_habit_performance(user.id, habit_id, days)
         return performance
     except Exception as e:
         logging.error(f"Error getting habit analytics: {str(e)}")
@@ -2318,24 +2366,16 @@ async def get_habit_analytics(
 # ==================== CHALLENGES & XP SYSTEM (SUPABASE VERSION) ====================
 
 @app.get("/user/xp")
-async def get_user_xp(current_user: User = Depends(get_current_user)):
+async def get_user_xp(current_user: Principal = Depends(get_current_principal)):
     """Get user XP and level info"""
     try:
-        # Try to get existing XP record
-        response = supabase.table('user_xp').select('*').eq(
-            'user_id', current_user.id
-        ).execute()
-        
-        if response.data and len(response.data) > 0:
-            user_xp = response.data[0]
-            total_xp = user_xp.get('total_xp', 0)
-        else:
-            # Create new XP record
-            supabase.table('user_xp').insert({
-                'user_id': current_user.id,
-                'total_xp': 0
-            }).execute()
-            total_xp = 0
+        # Read-only unless the XP record is missing (total_xp defaults to 0)
+        user_xp = await request_loader().select_one('user_xp', {'user_id': current_user.id})
+        if user_xp is None:
+            user_xp = await upsert_row('user_xp', {
+                'user_id': current_user.id
+            }, on_conflict='user_id')
+        total_xp = (user_xp or {}).get('total_xp') or 0
         
         level = (total_xp // 1000) + 1
         xp_for_current_level = (level - 1) * 1000
@@ -2365,30 +2405,23 @@ async def get_daily_challenges(current_user: User = Depends(get_current_user)):
         today_str = today.isoformat()
         
         # Get user's habits
-        habits_response = supabase.table('habits').select('*').eq(
-            'user_id', current_user.id
-        ).execute()
-        habits = habits_response.data or []
+        habits = await request_loader().select('habits', {'user_id': current_user.id})
         
         # Get today's checkins
-        checkins_response = supabase.table('checkins').select('*').eq(
-            'user_id', current_user.id
-        ).eq('date', today_str).execute()
-        checkins = checkins_response.data or []
+        loader = request_loader()
+        checkins = await loader.select('checkins', {'user_id': current_user.id, 'date': today_str})
         
         completed_habit_ids = [c['habit_id'] for c in checkins if c.get('completed')]
         
         # Get completed challenges for today
-        completed_response = supabase.table('challenge_completions').select('*').eq(
-            'user_id', current_user.id
-        ).eq('date', today_str).execute()
-        completed_challenge_ids = [c['challenge_id'] for c in (completed_response.data or [])]
+        completed = await loader.select(
+            'challenge_completions', {'user_id': current_user.id, 'date': today_str}
+        )
+        completed_challenge_ids = [c['challenge_id'] for c in completed]
         
-        # Get user stats for streak
-        user_response = supabase.table('users').select('current_streak').eq(
-            'id', current_user.id
-        ).single().execute()
-        current_streak = user_response.data.get('current_streak', 0) if user_response.data else 0
+        # Get user stats for streak (same row the auth dependency loaded)
+        user_row = await loader.select_one('users', {'id': current_user.id})
+        current_streak = effective_streak(user_row)
         
         # Generate challenges
         challenges = []
@@ -2521,7 +2554,7 @@ async def complete_challenge(
         today_str = today.isoformat()
         
         # Check if already completed
-        existing = supabase.table('challenge_completions').select('*').eq(
+        existing = await supabase.table('challenge_completions').select('*').eq(
             'user_id', current_user.id
         ).eq('challenge_id', challenge_id).eq('date', today_str).execute()
         
@@ -2544,7 +2577,7 @@ async def complete_challenge(
         xp_earned = challenge["xp_reward"]
         
         # Record completion
-        supabase.table('challenge_completions').insert({
+        await supabase.table('challenge_completions').insert({
             'user_id': current_user.id,
             'challenge_id': challenge_id,
             'date': today_str,
@@ -2554,7 +2587,7 @@ async def complete_challenge(
         
         # Update user XP
         # First, get current XP
-        xp_response = supabase.table('user_xp').select('*').eq(
+        xp_response = await supabase.table('user_xp').select('*').eq(
             'user_id', current_user.id
         ).execute()
         
@@ -2562,22 +2595,23 @@ async def complete_challenge(
             current_xp = xp_response.data[0].get('total_xp', 0)
             new_xp = current_xp + xp_earned
             
-            supabase.table('user_xp').update({
+            await supabase.table('user_xp').update({
                 'total_xp': new_xp,
                 'updated_at': datetime.now().isoformat()
             }).eq('user_id', current_user.id).execute()
         else:
             # Create new XP record
             new_xp = xp_earned
-            supabase.table('user_xp').insert({
+            await supabase.table('user_xp').insert({
                 'user_id': current_user.id,
                 'total_xp': new_xp
             }).execute()
         
         # Also update users table total_xp for leaderboard
-        supabase.table('users').update({
+        await supabase.table('users').update({
             'total_xp': new_xp
         }).eq('id', current_user.id).execute()
+        invalidate_user_cache(current_user.id)
         
         logging.info(f"✅ Challenge {challenge_id} completed by user {current_user.id}, earned {xp_earned} XP")
         
@@ -2600,14 +2634,14 @@ async def complete_challenge(
 @app.get("/challenges/history")
 async def get_challenge_history(
     days: int = 7,
-    user: User = Depends(get_current_user)
+    user: Principal = Depends(get_current_principal)
 ):
     """Get challenge completion history"""
     try:
         end_date = date.today()
         start_date = end_date - timedelta(days=days)
         
-        response = supabase.table('challenge_completions').select('*').eq(
+        response = await supabase.table('challenge_completions').select('*').eq(
             'user_id', user.id
         ).gte('date', start_date.strftime('%Y-%m-%d')).lte(
             'date', end_date.strftime('%Y-%m-%d')
@@ -2626,10 +2660,10 @@ async def get_challenge_history(
         return {"history": [], "total_xp_earned": 0, "days": days}
     
 @app.get("/challenges/weekly")
-async def get_weekly_challenges(user: User = Depends(get_current_user)):
+async def get_weekly_challenges(user: Principal = Depends(get_current_principal)):
     """Get this week's challenges"""
     try:
-        challenges = challenges_service.get_weekly_challenges(user.id)
+        challenges = await challenges_service.get_weekly_challenges(user.id)
         return challenges
     except Exception as e:
         logging.error(f"Error getting weekly challenges: {str(e)}")
@@ -2639,10 +2673,11 @@ async def get_weekly_challenges(user: User = Depends(get_current_user)):
 # ==================== STREAK ENDPOINTS ====================
 
 @app.get("/streak/details")
-async def get_streak_details(user: User = Depends(get_current_user)):
+@cached_route("streak_details")
+async def get_streak_details(user: Principal = Depends(get_current_principal)):
     """Get detailed streak information"""
     try:
-        details = streak_service.get_streak_details(user.id)
+        details = await streak_service.get_streak_details(user.id)
         return details
     except Exception as e:
         logging.error(f"Error getting streak details: {str(e)}")
@@ -2650,10 +2685,10 @@ async def get_streak_details(user: User = Depends(get_current_user)):
 
 
 @app.get("/streak/at-risk")
-async def check_streak_at_risk(user: User = Depends(get_current_user)):
+async def check_streak_at_risk(user: Principal = Depends(get_current_principal)):
     """Check if streak is at risk"""
     try:
-        result = streak_service.check_streak_at_risk(user.id)
+        result = await streak_service.check_streak_at_risk(user.id)
         return result
     except Exception as e:
         logging.error(f"Error checking streak risk: {str(e)}")
@@ -2661,10 +2696,10 @@ async def check_streak_at_risk(user: User = Depends(get_current_user)):
 
 
 @app.get("/streak/milestones")
-async def get_streak_milestones(user: User = Depends(get_current_user)):
+async def get_streak_milestones(user: Principal = Depends(get_current_principal)):
     """Get streak milestones"""
     try:
-        details = streak_service.get_streak_details(user.id)
+        details = await streak_service.get_streak_details(user.id)
         return {
             "milestones": details.get('milestones', []),
             "next_milestone": details.get('next_milestone'),
@@ -2675,18 +2710,75 @@ async def get_streak_milestones(user: User = Depends(get_current_user)):
         raise HTTPException(500, str(e))
 
 
+# ==================== DASHBOARD ====================
+
+DASHBOARD_SECTIONS = (
+    "me", "habits", "checkins", "stats", "challenges", "streak", "gamification", "push"
+)
+
+
+@app.get("/dashboard")
+async def get_dashboard(
+    sections: Optional[str] = None,
+    user: User = Depends(get_current_user)
+):
+    """
+    Everything the home screen loads, in one round trip. Sections run
+    concurrently and share the request's user, habits and check-in reads;
+    pass `sections=stats,streak` to fetch only some of them.
+    """
+    today_str = date.today().strftime('%Y-%m-%d')
+    
+    builders = {
+        "me": lambda: get_me(user),
+        "habits": lambda: get_habits(user),
+        "checkins": lambda: get_checkins(today_str, user),
+        "stats": lambda: get_user_stats(user),
+        "challenges": lambda: get_daily_challenges(user),
+        "streak": lambda: get_streak_details(user),
+        "gamification": lambda: get_gamification_profile(user),
+        "push": lambda: get_push_status(user),
+    }
+    
+    wanted = list(DASHBOARD_SECTIONS)
+    if sections:
+        wanted = list(dict.fromkeys(s.strip() for s in sections.split(',') if s.strip()))
+        unknown = [s for s in wanted if s not in builders]
+        if unknown:
+            raise HTTPException(400, f"Unknown sections: {', '.join(unknown)}")
+    
+    results = await asyncio.gather(
+        *(builders[name]() for name in wanted), return_exceptions=True
+    )
+    
+    payload = {"date": today_str}
+    errors = {}
+    for name, result in zip(wanted, results):
+        if isinstance(result, Exception):
+            logging.error(f"Dashboard section {name} failed: {str(result)}")
+            payload[name] = None
+            errors[name] = result.detail if isinstance(result, HTTPException) else str(result)
+        else:
+            payload[name] = result
+    
+    if errors:
+        payload["errors"] = errors
+    return payload
+
+
 # ==================== CACHE ENDPOINTS ====================
 
 @app.get("/cache/stats")
 async def get_cache_stats(user: User = Depends(get_current_user)):
     """Get cache statistics (admin only)"""
-    return cache.get_stats()
+    return {**cache.get_stats(), "user_cache": get_user_cache_stats()}
 
 
 @app.post("/cache/clear")
 async def clear_cache(user: User = Depends(get_current_user)):
     """Clear cache (admin only)"""
     cache.clear()
+    invalidate_user_cache()
     return {"message": "Cache cleared"}
 
 
@@ -2698,17 +2790,32 @@ async def health_check():
     return {
         "status": "healthy",
         "timestamp": datetime.now().isoformat(),
-        "cache_stats": cache.get_stats()
+        "cache_stats": cache.get_stats(),
+        "user_cache_stats": get_user_cache_stats(),
+        "rate_limiter_stats": rate_limiter.get_stats(),
+        "push_stats": push_service.dispatcher.get_stats(),
+        "reminder_queue_stats": reminder_queue.get_stats(),
+        "scheduler_stats": job_scheduler.get_stats()
     }
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics(request: Request):
+    """Latency histograms and call counters of every worker, in Prometheus text format"""
+    if METRICS_TOKEN:
+        expected = f"Bearer {METRICS_TOKEN}"
+        if not hmac.compare_digest(request.headers.get("authorization", ""), expected):
+            raise HTTPException(401, "Invalid metrics token")
+    return PlainTextResponse(render_metrics(await metrics.collect()), media_type=METRICS_CONTENT_TYPE)
+
+
 # ==================== ANALYTICS & INSIGHTS ====================
 
 @app.get("/analytics/correlations")
-async def get_correlation_insights(user: User = Depends(get_current_user)):
+async def get_correlation_insights(user: Principal = Depends(get_current_principal)):
     """Get correlation insights between sleep, habits, and mood"""
     try:
-        insights = HabitAnalytics.get_correlation_insights(user.id)
+        insights = await HabitAnalytics.get_correlation_insights(user.id)
         return insights
     except Exception as e:
         logging.error(f"Error getting correlations: {str(e)}")
@@ -2716,10 +2823,10 @@ async def get_correlation_insights(user: User = Depends(get_current_user)):
 
 
 @app.get("/analytics/prediction")
-async def get_today_prediction(user: User = Depends(get_current_user)):
+async def get_today_prediction(user: Principal = Depends(get_current_principal)):
     """Get prediction for today's habit completion"""
     try:
-        prediction = HabitAnalytics.get_prediction(user.id)
+        prediction = await HabitAnalytics.get_prediction(user.id)
         return prediction
     except Exception as e:
         logging.error(f"Error getting prediction: {str(e)}")
@@ -2731,57 +2838,66 @@ async def export_user_data(
     format: str = "json",
     user: User = Depends(get_current_user)
 ):
-    """Export all user data"""
-    try:
-        # Gather all data
-        habits = supabase.table('habits').select('*').eq('user_id', user.id).execute()
-        checkins = supabase.table('checkins').select('*').eq('user_id', user.id).execute()
-        thoughts = supabase.table('daily_thoughts').select('*').eq('user_id', user.id).execute()
-        sleep = supabase.table('sleep_records').select('*').eq('user_id', user.id).execute()
-        streaks = supabase.table('habit_streaks').select('*').eq('user_id', user.id).execute()
-        
-        data = {
+    """Export all user data (streamed page by page so large histories stay flat in memory)"""
+    sections = [
+        ("habits", "habits", ("id",)),
+        ("checkins", "checkins", ("date", "id")),
+        ("thoughts", "daily_thoughts", ("date", "id")),
+        ("sleep_records", "sleep_records", ("date", "id")),
+        ("streaks", "habit_streaks", ("id",)),
+    ]
+    
+    async def generate():
+        header = {
             "exported_at": datetime.now().isoformat(),
             "user": {
                 "id": user.id,
                 "name": user.name,
                 "email": user.email
-            },
-            "habits": habits.data or [],
-            "checkins": checkins.data or [],
-            "thoughts": thoughts.data or [],
-            "sleep_records": sleep.data or [],
-            "streaks": streaks.data or []
+            }
         }
+        yield dumps(header)[:-1]
         
-        if format == "csv":
-            # Would need to implement CSV conversion
-            pass
+        try:
+            for key, table, order_by in sections:
+                yield f', "{key}": ['
+                separator = b""
+                async for row in iter_rows(table, {'user_id': user.id}, order_by=order_by):
+                    yield separator + dumps(row)
+                    separator = b","
+                yield "]"
+        except Exception as e:
+            logging.error(f"Error exporting data: {str(e)}")
+            yield f'], "error": {json.dumps(str(e))}'
         
-        return data
-    except Exception as e:
-        logging.error(f"Error exporting data: {str(e)}")
-        raise HTTPException(500, str(e))
+        yield "}"
+    
+    return StreamingResponse(generate(), media_type="application/json")
 
 
 # ==================== HABIT TEMPLATES ====================
 
+@cached(ttl=3600, key_prefix="habit_templates", stale_ttl=24 * 3600)
+async def get_habit_template_rows(category: Optional[str] = None) -> list:
+    """Templates by popularity (shared catalog, cached globally)"""
+    query = supabase.table('habit_templates').select('*')
+    
+    if category:
+        query = query.eq('category', category)
+    
+    response = await query.order('popularity', desc=True).execute()
+    return response.data or []
+
+
 @app.get("/habits/templates")
 async def get_habit_templates(
     category: Optional[str] = None,
-    user: User = Depends(get_current_user)
+    user: Principal = Depends(get_current_principal)
 ):
     """Get habit templates"""
     try:
-        query = supabase.table('habit_templates').select('*')
-        
-        if category:
-            query = query.eq('category', category)
-        
-        response = query.order('popularity', desc=True).execute()
-        
         return {
-            "templates": response.data or [],
+            "templates": await get_habit_template_rows(category),
             "categories": ["health", "productivity", "mindfulness", "learning", "general"]
         }
     except Exception as e:
@@ -2796,7 +2912,7 @@ async def create_habit_from_template(
 ):
     """Create a habit from a template"""
     try:
-        template = supabase.table('habit_templates').select('*').eq(
+        template = await supabase.table('habit_templates').select('*').eq(
             'id', template_id
         ).single().execute()
         
@@ -2819,10 +2935,13 @@ async def create_habit_from_template(
             "created_at": datetime.now().isoformat()
         }
         
-        response = supabase.table('habits').insert(habit_data).execute()
+        response = await supabase.table('habits').insert(habit_data).execute()
+        notify_write('habits', user.id)
+        await streak_engine.recompute_user(user.id)
+        await daily_summary.refresh_day(user.id, date.today().strftime('%Y-%m-%d'))
         
         # Increment template popularity
-        supabase.table('habit_templates').update({
+        await supabase.table('habit_templates').update({
             'popularity': t['popularity'] + 1
         }).eq('id', template_id).execute()
         
@@ -2850,7 +2969,7 @@ async def subscribe_to_push(
     """Subscribe to push notifications"""
     try:
         # Get current subscriptions
-        user_data = supabase.table('users').select('push_subscriptions').eq(
+        user_data = await supabase.table('users').select('push_subscriptions').eq(
             'id', user.id
         ).single().execute()
         
@@ -2877,12 +2996,13 @@ async def subscribe_to_push(
         current_subs.append(new_sub)
         
         # Save to database
-        supabase.table('users').update({
+        await supabase.table('users').update({
             'push_subscriptions': current_subs
         }).eq('id', user.id).execute()
+        invalidate_user_cache(user.id)
         
         # Send welcome notification
-        push_service.send_notification(
+        await push_service.send_notification(
             subscription={"endpoint": subscription.endpoint, "keys": subscription.keys},
             title="🎉 Notifications Enabled!",
             body="You'll now receive reminders for your habits. Stay consistent!",
@@ -2905,7 +3025,7 @@ async def unsubscribe_from_push(
 ):
     """Unsubscribe from push notifications"""
     try:
-        user_data = supabase.table('users').select('push_subscriptions').eq(
+        user_data = await supabase.table('users').select('push_subscriptions').eq(
             'id', user.id
         ).single().execute()
         
@@ -2917,9 +3037,10 @@ async def unsubscribe_from_push(
             if s.get('endpoint') != subscription.endpoint
         ]
         
-        supabase.table('users').update({
+        await supabase.table('users').update({
             'push_subscriptions': updated_subs
         }).eq('id', user.id).execute()
+        invalidate_user_cache(user.id)
         
         logging.info(f"✅ Push subscription removed for user {user.email}")
         return {"success": True, "message": "Unsubscribed from push notifications"}
@@ -2933,12 +3054,10 @@ async def unsubscribe_from_push(
 async def get_push_status(user: User = Depends(get_current_user)):
     """Get push notification status for current user"""
     try:
-        user_data = supabase.table('users').select(
-            'push_subscriptions, notification_preferences'
-        ).eq('id', user.id).single().execute()
+        user_row = await request_loader().select_one('users', {'id': user.id}) or {}
         
-        subscriptions = user_data.data.get('push_subscriptions', []) or []
-        preferences = user_data.data.get('notification_preferences', {}) or {}
+        subscriptions = user_row.get('push_subscriptions', []) or []
+        preferences = user_row.get('notification_preferences', {}) or {}
         
         return {
             "subscribed": len(subscriptions) > 0,
@@ -2958,9 +3077,10 @@ async def update_notification_preferences(
 ):
     """Update notification preferences"""
     try:
-        supabase.table('users').update({
+        await supabase.table('users').update({
             'notification_preferences': preferences.dict()
         }).eq('id', user.id).execute()
+        invalidate_user_cache(user.id)
         
         return {"success": True, "message": "Preferences updated"}
         
@@ -2973,7 +3093,7 @@ async def update_notification_preferences(
 async def get_notification_preferences(user: User = Depends(get_current_user)):
     """Get notification preferences"""
     try:
-        user_data = supabase.table('users').select(
+        user_data = await supabase.table('users').select(
             'notification_preferences'
         ).eq('id', user.id).single().execute()
         
@@ -3002,7 +3122,7 @@ async def send_test_notification(
 ):
     """Send a test notification to the current user"""
     try:
-        user_data = supabase.table('users').select('push_subscriptions').eq(
+        user_data = await supabase.table('users').select('push_subscriptions').eq(
             'id', user.id
         ).single().execute()
         
@@ -3011,18 +3131,14 @@ async def send_test_notification(
         if not subscriptions:
             raise HTTPException(400, "No push subscriptions found. Please enable notifications first.")
         
-        results = []
-        for sub in subscriptions:
-            result = push_service.send_notification(
-                subscription={"endpoint": sub['endpoint'], "keys": sub['keys']},
-                title=request.title,
-                body=request.body,
-                tag="test",
-                data={"type": "test", "url": "/daily"}
-            )
-            results.append(result)
-        
-        success_count = sum(1 for r in results if r.get('success'))
+        results = await push_service.send_bulk_notifications(
+            [{"endpoint": sub['endpoint'], "keys": sub['keys']} for sub in subscriptions],
+            title=request.title,
+            body=request.body,
+            tag="test",
+            data={"type": "test", "url": "/daily"}
+        )
+        success_count = results["success"]
         
         return {
             "success": success_count > 0,
@@ -3044,7 +3160,7 @@ async def send_habit_reminder(
     """Manually trigger a habit reminder"""
     try:
         # Get habit
-        habit_response = supabase.table('habits').select('*').eq(
+        habit_response = await supabase.table('habits').select('*').eq(
             'id', habit_id
         ).eq('user_id', user.id).single().execute()
         
@@ -3054,25 +3170,30 @@ async def send_habit_reminder(
         habit = habit_response.data
         
         # Get user subscriptions and stats
-        user_data = supabase.table('users').select(
-            'push_subscriptions, current_streak'
+        user_data = await supabase.table('users').select(
+            'push_subscriptions, current_streak, last_perfect_date'
         ).eq('id', user.id).single().execute()
         
         subscriptions = user_data.data.get('push_subscriptions', []) or []
-        streak = user_data.data.get('current_streak', 0)
+        streak = effective_streak(user_data.data)
         
         if not subscriptions:
             raise HTTPException(400, "No push subscriptions found")
         
         results = []
-        for sub in subscriptions:
-            result = push_service.send_habit_reminder(
-                subscription={"endpoint": sub['endpoint'], "keys": sub['keys']},
-                habit_name=habit['name'],
-                habit_time=habit['time'],
-                streak=streak
-            )
-            results.append(result)
+        await push_service.dispatcher.dispatch(
+            (
+                push_service.habit_reminder_message(
+                    subscription={"endpoint": sub['endpoint'], "keys": sub['keys']},
+                    habit_name=habit['name'],
+                    habit_time=habit['time'],
+                    streak=streak
+                )
+                for sub in subscriptions
+            ),
+            on_result=lambda message, result: results.append(result),
+            name="habit-reminder"
+        )
         
         success_count = sum(1 for r in results if r.get('success'))
         
@@ -3089,20 +3210,19 @@ async def send_habit_reminder(
 
 
 # ==================== SCHEDULED NOTIFICATION TRIGGERS ====================
-# These endpoints should be called by a cron job or scheduler
+# The built-in scheduler runs these jobs (SCHEDULER_ENABLED, the default).
+# The endpoints stay for an external cron with the scheduler off; while a
+# job is scheduled here or on the notification workers, only dry runs are
+# accepted (refuse_while_scheduled).
 
-@app.post("/cron/check-reminders")
-async def trigger_reminder_check(
-    api_key: str = None  # Add API key authentication for cron jobs
-):
-    """Trigger smart reminder check (call every 5-10 minutes)"""
+@app.post("/cron/check-reminders", dependencies=[
+    Depends(require_cron_key), Depends(refuse_while_scheduled("check-reminders"))
+])
+async def trigger_reminder_check(dry_run: bool = False):
+    """Trigger smart reminder check (call every 1-10 minutes; only due habits are read; ?dry_run=true only counts)"""
     try:
-        # Optional: Verify API key for cron security
-        # if api_key != os.getenv("CRON_API_KEY"):
-        #     raise HTTPException(401, "Invalid API key")
-        
         scheduler = SmartNotificationScheduler(supabase)
-        results = await scheduler.check_and_send_reminders()
+        results = await scheduler.check_and_send_reminders(dry_run=dry_run)
         
         return results
         
@@ -3111,24 +3231,28 @@ async def trigger_reminder_check(
         raise HTTPException(500, str(e))
 
 
-@app.post("/cron/morning-motivation")
-async def trigger_morning_motivation():
-    """Trigger morning motivation (call at ~7 AM)"""
+@app.post("/cron/morning-motivation", dependencies=[
+    Depends(require_cron_key), Depends(refuse_while_scheduled("morning-motivation"))
+])
+async def trigger_morning_motivation(dry_run: bool = False):
+    """Trigger morning motivation (call at ~7 AM; a retry resumes the day's run; ?dry_run=true only counts)"""
     try:
         scheduler = SmartNotificationScheduler(supabase)
-        results = await scheduler.send_morning_motivation()
+        results = await scheduler.send_morning_motivation(dry_run=dry_run)
         return results
     except Exception as e:
         logging.error(f"Error in morning motivation: {str(e)}")
         raise HTTPException(500, str(e))
 
 
-@app.post("/cron/evening-reminder")
-async def trigger_evening_reminder():
-    """Trigger evening reminder (call at ~8 PM)"""
+@app.post("/cron/evening-reminder", dependencies=[
+    Depends(require_cron_key), Depends(refuse_while_scheduled("evening-reminder"))
+])
+async def trigger_evening_reminder(dry_run: bool = False):
+    """Trigger evening reminder (call at ~8 PM; a retry resumes the day's run; ?dry_run=true only counts)"""
     try:
         scheduler = SmartNotificationScheduler(supabase)
-        results = await scheduler.send_evening_reminder()
+        results = await scheduler.send_evening_reminder(dry_run=dry_run)
         return results
     except Exception as e:
         logging.error(f"Error in evening reminder: {str(e)}")
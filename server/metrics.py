@@ -0,0 +1,324 @@
+# server/metrics.py
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from dotenv import load_dotenv
+from cache_tiers import tiered_cache
+
+load_dotenv()
+
+# Each worker pushes its totals to the shared cache tier (CACHE_L2_URL) every
+# METRICS_PUSH_INTERVAL seconds; /metrics on any worker merges them. Without
+# an L2 the endpoint reports the worker that served it.
+METRICS_PUSH_INTERVAL = float(os.getenv("METRICS_PUSH_INTERVAL", "15"))
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")  # if set, /metrics requires "Bearer <token>"
+METRICS_NAMESPACE = "sankalp"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# name -> (type, help, label names)
+METRICS: Dict[str, Tuple[str, str, Tuple[str, ...]]] = {
+    "http_request_duration_seconds": (
+        "histogram", "Request latency by route template, method and status",
+        ("route", "method", "status")
+    ),
+    "db_requests_total": (
+        "counter", "PostgREST round trips by table, method and status class",
+        ("table", "method", "status")
+    ),
+    "external_calls_total": (
+        "counter", "Calls to third-party services by outcome",
+        ("service", "outcome")
+    ),
+    "external_call_duration_seconds": (
+        "histogram", "Latency of calls to third-party services",
+        ("service",)
+    ),
+    "cache_lookups_total": (
+        "counter", "Cache lookups by namespace and result",
+        ("namespace", "result")
+    ),
+    "cache_tier_lookups_total": (
+        "counter", "Two-tier cache lookups by tier and result",
+        ("tier", "result")
+    ),
+    "notification_shard_moves_total": (
+        "counter", "Notification shards handed to another worker by the coordinator",
+        ()
+    ),
+}
+
+Labels = Tuple[str, ...]
+
+
+class _Shard:
+    """One thread's counters; only that thread ever writes to it"""
+    __slots__ = ("counters", "histograms")
+
+    def __init__(self):
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        # (name, labels) -> [count per bucket..., count above the last bucket, sum]
+        self.histograms: Dict[Tuple[str, Labels], list] = {}
+
+
+class MetricsRegistry:
+    """
+    Counters and histograms for one worker.
+
+    Every thread records into its own shard, so the hot path is a dict
+    update with no lock. Readers copy each shard (a single C-level dict
+    copy) and add them up.
+
+    /metrics exposes each worker's totals as its own series (a `worker`
+    label; sum them in PromQL), all read from the snapshots pushed to L2,
+    the serving worker's included. Every series then only ever grows
+    between scrapes, whichever worker serves them, and a worker that exits
+    ends its series instead of shrinking a merged total (which Prometheus
+    would read as a counter reset).
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.instance_id = tiered_cache.instance_id
+        self.worker = self.instance_id[:12]
+        self._local = threading.local()
+        self._shards: List[_Shard] = []
+        self._collectors: List[Callable[[], Iterable[Tuple[str, Labels, float]]]] = []
+
+    def _shard(self) -> _Shard:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = _Shard()
+            self._shards.append(shard)
+            return shard
+
+    # ---------- recording ----------
+
+    def inc(self, name: str, labels: Labels = (), value: float = 1) -> None:
+        counters = self._shard().counters
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name: str, labels: Labels, seconds: float) -> None:
+        histograms = self._shard().histograms
+        key = (name, labels)
+        counts = histograms.get(key)
+        if counts is None:
+            counts = histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect_left(self.buckets, seconds)] += 1
+        counts[-1] += seconds
+
+    def add_collector(self, collector: Callable[[], Iterable[Tuple[str, Labels, float]]]) -> None:
+        """Register a callable yielding (counter name, labels, total) at scrape time"""
+        self._collectors.append(collector)
+
+    # ---------- reading ----------
+
+    def snapshot(self) -> Dict[str, list]:
+        """This worker's totals in a JSON-serializable form"""
+        counters: Dict[Tuple[str, Labels], float] = {}
+        histograms: Dict[Tuple[str, Labels], list] = {}
+        for shard in list(self._shards):
+            for key, value in dict(shard.counters).items():
+                counters[key] = counters.get(key, 0) + value
+            for key, counts in dict(shard.histograms).items():
+                _add_counts(histograms, key, list(counts))
+        for collector in self._collectors:
+            try:
+                for name, labels, value in collector():
+                    counters[(name, labels)] = counters.get((name, labels), 0) + value
+            except Exception as e:
+                logging.error(f"Error collecting metrics: {str(e)}")
+        return {
+            "worker": self.worker,
+            "buckets": list(self.buckets),
+            "counters": [[name, list(labels), value] for (name, labels), value in counters.items()],
+            "histograms": [[name, list(labels), counts] for (name, labels), counts in histograms.items()],
+        }
+
+    # ---------- cross-worker ----------
+
+    def _l2_key(self, instance_id: str) -> str:
+        return f"{tiered_cache.prefix}:metrics:{instance_id}"
+
+    async def push(self) -> None:
+        l2 = tiered_cache.l2
+        if l2 is None:
+            return
+        payload = json.dumps(self.snapshot()).encode()
+        await l2.set(self._l2_key(self.instance_id), payload, ttl=METRICS_PUSH_INTERVAL * 3)
+
+    async def collect(self) -> List[Dict[str, list]]:
+        """Each live worker's last pushed totals (this worker's fresh only if it hasn't pushed yet)"""
+        l2 = tiered_cache.l2
+        if l2 is None:
+            return [self.snapshot()]
+        snapshots = []
+        try:
+            keys = await l2.keys(self._l2_key(""))
+            for raw in await l2.mget(keys) if keys else []:
+                if raw is not None:
+                    snapshots.append(json.loads(raw))
+        except Exception as e:
+            logging.error(f"Error reading worker metrics: {str(e)}")
+        if not any(snapshot.get("worker") == self.worker for snapshot in snapshots):
+            snapshots.append(self.snapshot())
+        return snapshots
+
+    async def forget(self) -> None:
+        """Drop this worker's pushed totals (call on shutdown)"""
+        if tiered_cache.l2 is not None:
+            try:
+                await tiered_cache.l2.delete(self._l2_key(self.instance_id))
+            except Exception as e:
+                logging.error(f"Error removing worker metrics: {str(e)}")
+
+
+def _add_counts(into: Dict[Tuple[str, Labels], list], key: Tuple[str, Labels], counts: list) -> None:
+    current = into.get(key)
+    if current is None:
+        into[key] = counts
+    else:
+        for i, value in enumerate(counts):
+            current[i] += value
+
+
+# ============================================
+# PROMETHEUS TEXT FORMAT
+# ============================================
+
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_text(names: Iterable[str], values: Iterable[Any], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def render_metrics(snapshots: List[Dict[str, list]]) -> str:
+    """Prometheus exposition text: one series per worker (label `worker`)"""
+    by_name: Dict[str, list] = {}
+    for snapshot in snapshots:
+        worker = snapshot.get("worker", "")
+        buckets = snapshot["buckets"]
+        for name, labels, value in snapshot["counters"]:
+            by_name.setdefault(name, []).append((list(labels) + [worker], value, buckets))
+        for name, labels, counts in snapshot["histograms"]:
+            by_name.setdefault(name, []).append((list(labels) + [worker], counts, buckets))
+
+    lines = [
+        f"# HELP {METRICS_NAMESPACE}_workers Workers whose metrics are included",
+        f"# TYPE {METRICS_NAMESPACE}_workers gauge",
+        f"{METRICS_NAMESPACE}_workers {len(snapshots)}",
+    ]
+    for name, (kind, help_text, label_names) in METRICS.items():
+        samples = by_name.get(name)
+        if not samples:
+            continue
+        full = f"{METRICS_NAMESPACE}_{name}"
+        label_names = label_names + ("worker",)
+        lines.append(f"# HELP {full} {help_text}")
+        lines.append(f"# TYPE {full} {kind}")
+        for labels, value, buckets in sorted(samples, key=lambda sample: sample[0]):
+            if kind == "counter":
+                lines.append(f"{full}{_label_text(label_names, labels)} {_number(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(list(buckets) + ["+Inf"], value):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{full}_bucket{_label_text(label_names, labels, le)} {cumulative}")
+            lines.append(f"{full}_sum{_label_text(label_names, labels)} {_number(value[-1])}")
+            lines.append(f"{full}_count{_label_text(label_names, labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+# ============================================
+# INSTRUMENTATION HELPERS
+# ============================================
+
+@contextmanager
+def external_call(service: str):
+    """Count and time one call to a third-party service (sync or async code)"""
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        metrics.inc("external_calls_total", (service, outcome))
+        metrics.observe("external_call_duration_seconds", (service,), time.perf_counter() - started)
+
+
+async def count_db_response(response) -> None:
+    """httpx response hook for the PostgREST client: one count per round trip"""
+    path = response.request.url.path
+    table = path.split("/rest/v1/", 1)[1] if "/rest/v1/" in path else "<other>"
+    metrics.inc("db_requests_total", (table, response.request.method, f"{response.status_code // 100}xx"))
+
+
+def _cache_samples():
+    stats = tiered_cache.get_stats()
+    for namespace, counts in stats["namespaces"].items():
+        yield "cache_lookups_total", (namespace, "hit"), counts["hits"]
+        yield "cache_lookups_total", (namespace, "miss"), counts["misses"]
+    for tier, counts in stats["tiers"].items():
+        for result, field in (("hit", "hits"), ("miss", "misses"), ("error", "errors")):
+            yield "cache_tier_lookups_total", (tier, result), counts[field]
+
+
+# Singleton instance shared by middleware.py, database.py and the services
+metrics = MetricsRegistry()
+metrics.add_collector(_cache_samples)
+
+
+# ============================================
+# BACKGROUND PUSH
+# ============================================
+
+_pusher: Optional[asyncio.Task] = None
+
+
+async def _push_forever(interval: float):
+    while True:
+        try:
+            await metrics.push()
+        except Exception as e:
+            logging.error(f"Error pushing worker metrics: {str(e)}")
+        await asyncio.sleep(interval)
+
+
+def start_metrics_push(interval: float = METRICS_PUSH_INTERVAL):
+    """Share this worker's totals through the L2 (call from app startup)"""
+    global _pusher
+    if _pusher is None and tiered_cache.l2 is not None:
+        _pusher = asyncio.create_task(_push_forever(interval))
+
+
+async def stop_metrics_push():
+    global _pusher
+    if _pusher is not None:
+        _pusher.cancel()
+        try:
+            await _pusher
+        except asyncio.CancelledError:
+            pass
+        _pusher = None
+        await metrics.forget()
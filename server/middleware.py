@@ -1,15 +1,21 @@
 # server/middleware.py
 import os
 import time
+import inspect
+import hashlib
 import logging
-from typing import Callable, Dict, Any, Optional
+from typing import Callable, Dict, Any, Iterable, Optional
 from functools import wraps
-from datetime import datetime, timedelta
-from collections import defaultdict
+from datetime import date
 from fastapi import Request, Response, HTTPException
 from fastapi.responses import JSONResponse
-from starlette.middleware.base import BaseHTTPMiddleware
-from cachetools import TTLCache
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from cache_engine import cache_engine, table_tags
+from cache_tiers import tiered_cache
+from rate_limiter import rate_limiter, request_route, route_template
+from auth import user_id_from_token
+from metrics import metrics
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -21,59 +27,132 @@ logging.basicConfig(level=logging.INFO)
 # ============================================
 
 class InMemoryCache:
-    """Simple in-memory cache with TTL"""
+    """
+    Namespace view over the shared cache. The sync methods touch this
+    worker's L1 only; aget/aset go through both tiers (cache_tiers).
+    """
     
-    def __init__(self, maxsize: int = 1000, ttl: int = 300):
-        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
-        self.stats = {"hits": 0, "misses": 0}
+    def __init__(self, namespace: str = "http", ttl: int = 300):
+        self.namespace = namespace
+        self.default_ttl = ttl
     
     def get(self, key: str) -> Optional[Any]:
-        value = self.cache.get(key)
-        if value is not None:
-            self.stats["hits"] += 1
-            return value
-        self.stats["misses"] += 1
-        return None
+        return cache_engine.get(key, namespace=self.namespace)
     
-    def set(self, key: str, value: Any, ttl: Optional[int] = None) -> None:
-        self.cache[key] = value
+    def set(self, key: str, value: Any, ttl: Optional[int] = None, tags: Iterable[str] = ()) -> None:
+        cache_engine.set(
+            key, value,
+            ttl=ttl if ttl is not None else self.default_ttl,
+            namespace=self.namespace,
+            tags=tags
+        )
+    
+    async def aget(self, key: str) -> Optional[Any]:
+        return await tiered_cache.get(key, namespace=self.namespace)
+    
+    async def aset(self, key: str, value: Any, ttl: Optional[int] = None, tags: Iterable[str] = ()) -> None:
+        await tiered_cache.set(
+            key, value,
+            ttl=ttl if ttl is not None else self.default_ttl,
+            namespace=self.namespace,
+            tags=tags
+        )
     
     def delete(self, key: str) -> None:
-        self.cache.pop(key, None)
+        cache_engine.delete(key, namespace=self.namespace)
     
     def clear(self) -> None:
-        self.cache.clear()
+        cache_engine.clear(self.namespace)
     
-    def get_stats(self) -> Dict[str, int]:
-        return {
-            **self.stats,
-            "size": len(self.cache),
-            "hit_rate": self.stats["hits"] / max(1, self.stats["hits"] + self.stats["misses"]) * 100
-        }
+    def get_stats(self) -> Dict[str, Any]:
+        return tiered_cache.get_stats()
 
 
 # Global cache instance
-cache = InMemoryCache(maxsize=2000, ttl=300)  # 5 minutes default TTL
+cache = InMemoryCache(namespace="http", ttl=300)  # 5 minutes default TTL
 
 
-def cached(ttl: int = 300, key_prefix: str = ""):
-    """Decorator to cache function results"""
+def cached(ttl: int = 300, key_prefix: str = "", stale_ttl: int = 0):
+    """
+    Decorator to cache function results. Concurrent misses share one call;
+    with `stale_ttl` an expired result is served that much longer while
+    one background call refreshes it.
+    """
     def decorator(func: Callable):
         @wraps(func)
         async def wrapper(*args, **kwargs):
             # Build cache key
             cache_key = f"{key_prefix}:{func.__name__}:{str(args)}:{str(kwargs)}"
             
-            # Try to get from cache
-            cached_value = cache.get(cache_key)
-            if cached_value is not None:
-                return cached_value
+            return await tiered_cache.get_or_compute(
+                cache_key, lambda: func(*args, **kwargs),
+                ttl=ttl, namespace=cache.namespace, stale_ttl=stale_ttl
+            )
+        return wrapper
+    return decorator
+
+
+# ============================================
+# TABLE-AWARE RESPONSE CACHE
+# ============================================
+
+# What each cached route/function reads, per user. A write to any of
+# these tables for that user (database.notify_write, upsert_row,
+# auth.invalidate_user_cache) evicts exactly the dependent entries.
+CACHE_DEPENDENCIES: Dict[str, Dict[str, Any]] = {
+    "stats": {"tables": ("habits", "checkins", "users"), "ttl": 300},
+    "insights": {"tables": ("habits", "habit_streaks", "user_daily_summary", "users"), "ttl": 300},
+    "monthly_analysis": {
+        "tables": ("habits", "checkins", "daily_thoughts", "sleep_records", "user_daily_summary"),
+        "ttl": 600
+    },
+    "streak_details": {
+        "tables": ("habits", "habit_streaks", "checkins", "user_daily_summary", "users"),
+        "ttl": 300
+    },
+    "gamification_profile": {"tables": ("users",), "ttl": 600},
+}
+
+
+def _user_id_from(bound: inspect.BoundArguments) -> Optional[int]:
+    for name in ("user", "current_user"):
+        user = bound.arguments.get(name)
+        if user is not None:
+            return getattr(user, "id", None)
+    return None
+
+
+def cached_route(name: str):
+    """
+    Cache a per-user route/function as declared in CACHE_DEPENDENCIES.
+    Entries are keyed by user, call arguments and today's date (streaks
+    roll over at midnight) and tagged with their tables.
+    """
+    spec = CACHE_DEPENDENCIES[name]
+    
+    def decorator(func: Callable):
+        signature = inspect.signature(func)
+        
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            user_id = _user_id_from(bound)
+            if user_id is None:
+                return await func(*args, **kwargs)
             
-            # Call function and cache result
-            result = await func(*args, **kwargs)
-            cache.set(cache_key, result, ttl)
+            extra = {
+                k: v for k, v in bound.arguments.items()
+                if k not in ("user", "current_user")
+            }
+            cache_key = f"{name}:{user_id}:{date.today().isoformat()}:{sorted(extra.items())}"
             
-            return result
+            return await tiered_cache.get_or_compute(
+                cache_key, lambda: func(*args, **kwargs),
+                ttl=spec.get("ttl", cache.default_ttl),
+                namespace=cache.namespace,
+                tags=table_tags(spec["tables"], user_id),
+                stale_ttl=spec.get("stale_ttl", 0)
+            )
         return wrapper
     return decorator
 
@@ -83,106 +162,93 @@ def invalidate_cache(pattern: str = None):
     if pattern is None:
         cache.clear()
     else:
-        # Simple pattern matching (keys starting with pattern)
-        keys_to_delete = [k for k in cache.cache.keys() if k.startswith(pattern)]
-        for key in keys_to_delete:
-            cache.delete(key)
+        # Keys starting with pattern (prefer cache_engine.invalidate_tag)
+        cache_engine.delete_matching(lambda k: k.startswith(pattern), namespace=cache.namespace)
 
 
 # ============================================
-# RATE LIMITER
+# CONDITIONAL GET
 # ============================================
 
-class RateLimiter:
-    """Token bucket rate limiter"""
-    
-    def __init__(self):
-        self.requests: Dict[str, list] = defaultdict(list)
-        self.blocked_ips: Dict[str, datetime] = {}
-        
-        # Default limits
-        self.default_limit = 100  # requests
-        self.default_window = 60  # seconds
-        
-        # Endpoint-specific limits
-        self.endpoint_limits = {
-            "/auth/": {"limit": 10, "window": 60},
-            "/ai/": {"limit": 20, "window": 60},
-            "/push/": {"limit": 30, "window": 60},
-            "/checkins": {"limit": 60, "window": 60},
-        }
-    
-    def _get_limit_for_path(self, path: str) -> tuple:
-        """Get rate limit for a specific path"""
-        for prefix, limits in self.endpoint_limits.items():
-            if path.startswith(prefix):
-                return limits["limit"], limits["window"]
-        return self.default_limit, self.default_window
-    
-    def _clean_old_requests(self, key: str, window: int):
-        """Remove requests outside the window"""
-        now = time.time()
-        self.requests[key] = [
-            req_time for req_time in self.requests[key]
-            if now - req_time < window
-        ]
-    
-    def is_blocked(self, ip: str) -> bool:
-        """Check if IP is temporarily blocked"""
-        if ip in self.blocked_ips:
-            if datetime.now() < self.blocked_ips[ip]:
-                return True
-            else:
-                del self.blocked_ips[ip]
-        return False
-    
-    def block_ip(self, ip: str, duration_minutes: int = 15):
-        """Temporarily block an IP"""
-        self.blocked_ips[ip] = datetime.now() + timedelta(minutes=duration_minutes)
-    
-    def check_rate_limit(self, ip: str, path: str) -> tuple:
-        """
-        Check if request is within rate limit.
-        Returns (allowed: bool, remaining: int, reset_time: int)
-        """
-        if self.is_blocked(ip):
-            return False, 0, 900  # 15 minutes
-        
-        limit, window = self._get_limit_for_path(path)
-        key = f"{ip}:{path}"
-        
-        self._clean_old_requests(key, window)
-        
-        current_requests = len(self.requests[key])
-        
-        if current_requests >= limit:
-            # Check for abuse (hitting limit repeatedly)
-            if current_requests > limit * 2:
-                self.block_ip(ip)
-            return False, 0, window
-        
-        self.requests[key].append(time.time())
-        remaining = limit - current_requests - 1
-        
-        return True, remaining, window
+# Route template -> tables its (per-user) response is derived from. The
+# ETag is built from those tables' per-user versions (the cache tag
+# generations every write already bumps), so a matching If-None-Match is
+# answered with 304 without running the endpoint. Only done when the
+# versions are shared through the L2 cache: per-worker versions would let
+# a worker that never saw a write keep answering 304 with stale data. For
+# a single worker without Redis, set CACHE_L2_URL=local://.
+CONDITIONAL_ROUTES: Dict[str, Iterable[str]] = {
+    "/habits": ("habits",),
+    "/checkins/{date}": ("checkins",),
+    "/stats": CACHE_DEPENDENCIES["stats"]["tables"],
+    "/analysis/monthly": CACHE_DEPENDENCIES["monthly_analysis"]["tables"],
+    "/gamification/profile": CACHE_DEPENDENCIES["gamification_profile"]["tables"],
+}
+
+# Revalidate every time; the 304 is what makes polling cheap
+CONDITIONAL_CACHE_CONTROL = "private, no-cache"
+
+# Catalogs that are the same for every user
+CACHE_CONTROL_POLICIES: Dict[str, str] = {
+    "/habits/templates": "private, max-age=3600, stale-while-revalidate=86400",
+    "/videos/categories": "private, max-age=86400",
+    "/videos/learning-path": "private, max-age=3600",
+    "/push/vapid-public-key": "public, max-age=86400",
+}
 
 
-# Global rate limiter instance
-rate_limiter = RateLimiter()
+async def data_version_etag(scope: Scope, user_id: int, tables: Iterable[str]) -> str:
+    """Weak ETag for a user's view of `tables` at their current versions"""
+    versions = await tiered_cache.generations(table_tags(tables, user_id))
+    raw = "|".join([
+        tiered_cache.epoch,
+        scope["path"],
+        scope.get("query_string", b"").decode("latin-1"),
+        str(user_id),
+        date.today().isoformat(),  # day-relative fields (streaks) roll over
+        ",".join(map(str, versions)),
+    ])
+    return f'W/"{hashlib.blake2b(raw.encode(), digest_size=12).hexdigest()}"'
+
+
+def _etag_matches(etag: str, if_none_match: Optional[str]) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == opaque:
+            return True
+    return False
 
 
 # ============================================
 # MIDDLEWARES
 # ============================================
 
-class RateLimitMiddleware(BaseHTTPMiddleware):
+# Pure ASGI middlewares: no per-layer task or body re-streaming, so they
+# are cheap and leave streaming responses alone. Response headers are
+# added by wrapping `send` and editing the http.response.start message.
+
+class RateLimitMiddleware:
     """Middleware to enforce rate limiting"""
     
-    async def dispatch(self, request: Request, call_next: Callable) -> Response:
+    skip_paths = ("/docs", "/openapi.json", "/redoc", "/health", "/metrics")
+    
+    def __init__(self, app: ASGIApp):
+        self.app = app
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
         # Skip rate limiting for certain paths
-        skip_paths = ["/docs", "/openapi.json", "/redoc", "/health"]
-        if any(request.url.path.startswith(p) for p in skip_paths):
-            return await call_next(request)
+        if scope["type"] != "http" or scope["path"].startswith(self.skip_paths):
+            await self.app(scope, receive, send)
+            return
+        
+        request = Request(scope)
         
         # Get client IP
         client_ip = request.client.host if request.client else "unknown"
@@ -190,13 +256,17 @@ class RateLimitMiddleware(BaseHTTPMiddleware):
         if forwarded_for:
             client_ip = forwarded_for.split(",")[0].strip()
         
-        # Check rate limit
-        allowed, remaining, reset_time = rate_limiter.check_rate_limit(
-            client_ip, request.url.path
+        # Limit signed-in users by account (many users can share one IP)
+        user_id = user_id_from_token(request.cookies.get("access_token"))
+        client = f"user:{user_id}" if user_id else f"ip:{client_ip}"
+        
+        # Check rate limit (keyed by route template, not raw path)
+        allowed, remaining, reset_time = await rate_limiter.check_rate_limit(
+            client, request_route(request)
         )
         
         if not allowed:
-            return JSONResponse(
+            response = JSONResponse(
                 status_code=429,
                 content={
                     "error": "Too Many Requests",
@@ -209,59 +279,101 @@ class RateLimitMiddleware(BaseHTTPMiddleware):
                     "Retry-After": str(reset_time)
                 }
             )
+            await response(scope, receive, send)
+            return
         
-        # Process request
-        response = await call_next(request)
-        
-        # Add rate limit headers
-        response.headers["X-RateLimit-Remaining"] = str(remaining)
-        response.headers["X-RateLimit-Reset"] = str(reset_time)
+        async def send_with_headers(message: Message):
+            if message["type"] == "http.response.start":
+                # Add rate limit headers
+                headers = MutableHeaders(scope=message)
+                headers["X-RateLimit-Remaining"] = str(remaining)
+                headers["X-RateLimit-Reset"] = str(reset_time)
+            await send(message)
         
-        return response
+        await self.app(scope, receive, send_with_headers)
+
 
+def _scope_route(scope: Scope) -> str:
+    """Route template for metrics labels (raw paths would be unbounded)"""
+    route = scope.get("route")
+    if route is not None:
+        return route.path
+    return route_template(scope["app"], scope["path"])
 
-class LoggingMiddleware(BaseHTTPMiddleware):
-    """Middleware to log all requests"""
+
+class LoggingMiddleware:
+    """Middleware to log all requests and record per-route latency"""
+    
+    def __init__(self, app: ASGIApp):
+        self.app = app
     
-    async def dispatch(self, request: Request, call_next: Callable) -> Response:
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
         start_time = time.time()
+        status_code = None
         
         # Get client info
-        client_ip = request.client.host if request.client else "unknown"
+        client = scope.get("client")
+        client_ip = client[0] if client else "unknown"
+        method, path = scope["method"], scope["path"]
+        
+        async def send_timed(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                # Add timing header (time to first byte)
+                MutableHeaders(scope=message)["X-Response-Time"] = f"{time.time() - start_time:.3f}s"
+            await send(message)
         
         # Process request
         try:
-            response = await call_next(request)
-            
-            # Calculate duration
-            duration = time.time() - start_time
-            
-            # Log request
-            log_level = logging.WARNING if response.status_code >= 400 else logging.INFO
-            logging.log(
-                log_level,
-                f"{request.method} {request.url.path} - {response.status_code} - {duration:.3f}s - {client_ip}"
-            )
-            
-            # Add timing header
-            response.headers["X-Response-Time"] = f"{duration:.3f}s"
-            
-            return response
-            
+            await self.app(scope, receive, send_timed)
         except Exception as e:
             duration = time.time() - start_time
+            metrics.observe(
+                "http_request_duration_seconds", (_scope_route(scope), method, "500"), duration
+            )
             logging.error(
-                f"{request.method} {request.url.path} - ERROR - {duration:.3f}s - {client_ip} - {str(e)}"
+                f"{method} {path} - ERROR - {duration:.3f}s - {client_ip} - {str(e)}"
             )
             raise
+        
+        # Log request (full duration, including a streamed body)
+        duration = time.time() - start_time
+        metrics.observe(
+            "http_request_duration_seconds", (_scope_route(scope), method, str(status_code or 500)), duration
+        )
+        log_level = logging.WARNING if (status_code or 500) >= 400 else logging.INFO
+        logging.log(
+            log_level,
+            f"{method} {path} - {status_code} - {duration:.3f}s - {client_ip}"
+        )
 
 
-class ErrorHandlingMiddleware(BaseHTTPMiddleware):
+class ErrorHandlingMiddleware:
     """Global error handling middleware"""
     
-    async def dispatch(self, request: Request, call_next: Callable) -> Response:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        response_started = False
+        
+        async def send_tracked(message: Message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+        
         try:
-            return await call_next(request)
+            await self.app(scope, receive, send_tracked)
         except HTTPException:
             raise
         except Exception as e:
@@ -269,7 +381,11 @@ class ErrorHandlingMiddleware(BaseHTTPMiddleware):
             import traceback
             traceback.print_exc()
             
-            return JSONResponse(
+            # Too late for a JSON error once a (streamed) response has begun
+            if response_started:
+                raise
+            
+            response = JSONResponse(
                 status_code=500,
                 content={
                     "error": "Internal Server Error",
@@ -277,18 +393,100 @@ class ErrorHandlingMiddleware(BaseHTTPMiddleware):
                     "request_id": str(time.time())
                 }
             )
+            await response(scope, receive, send)
 
 
-class SecurityHeadersMiddleware(BaseHTTPMiddleware):
+class SecurityHeadersMiddleware:
     """Add security headers to all responses"""
     
-    async def dispatch(self, request: Request, call_next: Callable) -> Response:
-        response = await call_next(request)
+    def __init__(self, app: ASGIApp):
+        self.app = app
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        async def send_with_headers(message: Message):
+            if message["type"] == "http.response.start":
+                # Security headers
+                headers = MutableHeaders(scope=message)
+                headers["X-Content-Type-Options"] = "nosniff"
+                headers["X-Frame-Options"] = "DENY"
+                headers["X-XSS-Protection"] = "1; mode=block"
+                headers["Referrer-Policy"] = "strict-origin-when-cross-origin"
+            await send(message)
+        
+        await self.app(scope, receive, send_with_headers)
+
+
+class RequestLoaderMiddleware:
+    """Give every request its own memo for duplicated database reads"""
+    
+    def __init__(self, app: ASGIApp):
+        self.app = app
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        from database import begin_request_reads, end_request_reads, request_loader
+        
+        # Same task as the endpoint, so the ContextVar is visible all the way down
+        token = begin_request_reads()
+        try:
+            loader = request_loader()
+            Request(scope).state.loader = loader
+            await self.app(scope, receive, send)
+            if loader.hits:
+                logging.debug(
+                    f"{scope['path']}: {loader.hits} reads shared, {loader.misses} fetched"
+                )
+        finally:
+            end_request_reads(token)
+
+
+class ConditionalGetMiddleware:
+    """ETag / 304 for user-scoped reads and Cache-Control for catalogs"""
+    
+    def __init__(self, app: ASGIApp):
+        self.app = app
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["method"] not in ("GET", "HEAD"):
+            await self.app(scope, receive, send)
+            return
+        
+        route = route_template(scope["app"], scope["path"])
+        tables = CONDITIONAL_ROUTES.get(route)
+        cache_control = CACHE_CONTROL_POLICIES.get(route)
+        etag = None
+        
+        if tables is not None and tiered_cache.l2 is not None:
+            request = Request(scope)
+            user_id = user_id_from_token(request.cookies.get("access_token"))
+            if user_id:
+                etag = await data_version_etag(scope, user_id, tables)
+                cache_control = CONDITIONAL_CACHE_CONTROL
+                if _etag_matches(etag, request.headers.get("if-none-match")):
+                    response = Response(
+                        status_code=304,
+                        headers={"ETag": etag, "Cache-Control": cache_control}
+                    )
+                    await response(scope, receive, send)
+                    return
+        
+        if cache_control is None:
+            await self.app(scope, receive, send)
+            return
         
-        # Security headers
-        response.headers["X-Content-Type-Options"] = "nosniff"
-        response.headers["X-Frame-Options"] = "DENY"
-        response.headers["X-XSS-Protection"] = "1; mode=block"
-        response.headers["Referrer-Policy"] = "strict-origin-when-cross-origin"
+        async def send_with_validators(message: Message):
+            if message["type"] == "http.response.start" and message["status"] == 200:
+                headers = MutableHeaders(scope=message)
+                if etag is not None:
+                    headers["ETag"] = etag
+                headers.setdefault("Cache-Control", cache_control)
+            await send(message)
         
-        return response
\ No newline at end of file
+        await self.app(scope, receive, send_with_validators)
@@ -23,6 +23,7 @@ class User:
     email_notifications: bool = True
     reminder_time: Optional[str] = None
     created_at: Optional[str] = None
+    token_version: int = 0
     
     @classmethod
     def from_supabase(cls, data: dict) -> "User":
@@ -45,9 +46,18 @@ class User:
             email_notifications=data.get("email_notifications", True),
             reminder_time=data.get("reminder_time"),
             created_at=data.get("created_at"),
+            token_version=data.get("token_version") or 0,
         )
 
 
+@dataclass(frozen=True)
+class Principal:
+    """Authenticated identity taken from verified JWT claims (no DB row)"""
+    id: int
+    email: str
+    token_version: int = 0
+
+
 @dataclass
 class Habit:
     id: int
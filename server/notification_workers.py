@@ -0,0 +1,320 @@
+# server/notification_workers.py
+import os
+import sys
+import json
+import signal
+import asyncio
+import logging
+import multiprocessing
+from typing import Any, Dict, List, Optional
+from dotenv import load_dotenv
+from database import supabase, close_db
+from cache_tiers import tiered_cache, CACHE_L2_URL
+from metrics import metrics, start_metrics_push, stop_metrics_push
+from reminder_queue import reminder_queue
+from push_notification_service import push_service, SmartNotificationScheduler
+from fanout import shard_label
+from job_scheduler import JobScheduler, lease_store_from_backend, worker_id, SCHEDULER_LEASE_BACKEND
+
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO)
+
+# Push fan-out split by user id: NOTIFY_SHARDS=0 runs the reminder, morning
+# and evening jobs in the app's own scheduler; N > 0 leaves them to worker
+# processes (python notification_workers.py), each job once per shard
+# (user_id % N), spread over however many workers are alive.
+NOTIFY_SHARDS = int(os.getenv("NOTIFY_SHARDS", "0"))
+NOTIFY_WORKER_TICK = float(os.getenv("NOTIFY_WORKER_TICK", "5"))
+# A worker that hasn't checked in for this long is dead; its shards move
+NOTIFY_WORKER_TTL = int(os.getenv("NOTIFY_WORKER_TTL", "30"))
+
+# Daily notification times (server time)
+MORNING_MOTIVATION_AT = os.getenv("MORNING_MOTIVATION_AT", "07:00")
+EVENING_REMINDER_AT = os.getenv("EVENING_REMINDER_AT", "20:00")
+
+# Rows in the scheduler lease table (job_scheduler.py)
+COORDINATOR_LEASE = "shards:coordinator"
+WORKER_PREFIX = "shards:worker:"
+ASSIGN_PREFIX = "shards:assign:"
+STATS_PREFIX = "shards:stats:"
+STATS_TTL = 2 * 86400
+
+
+def plan_assignment(shards: int, workers: List[str], current: Dict[int, str]) -> Dict[int, str]:
+    """
+    Shard -> worker. Shards stay where they are while their worker is
+    alive; a dead worker's shards go to the least loaded workers, then
+    shards move off the busiest worker until no two workers differ by
+    more than one shard.
+    """
+    if not workers:
+        return {}
+    load: Dict[str, List[int]] = {worker: [] for worker in sorted(workers)}
+    orphans = []
+    for index in range(shards):
+        holder = current.get(index)
+        if holder in load:
+            load[holder].append(index)
+        else:
+            orphans.append(index)
+    for index in orphans:
+        load[min(load, key=lambda worker: len(load[worker]))].append(index)
+    while True:
+        busiest = max(load, key=lambda worker: len(load[worker]))
+        idlest = min(load, key=lambda worker: len(load[worker]))
+        if len(load[busiest]) - len(load[idlest]) <= 1:
+            break
+        load[idlest].append(load[busiest].pop())
+    return {index: worker for worker, indexes in load.items() for index in indexes}
+
+
+def _suffix(name: str, prefix: str) -> str:
+    return name[len(prefix):]
+
+
+async def shard_status(store) -> Dict[str, Any]:
+    """Live workers, the current assignment and every shard's last published job stats"""
+    workers = await store.list(WORKER_PREFIX)
+    assignments = await store.list(ASSIGN_PREFIX)
+    stats = await store.list(STATS_PREFIX)
+    coordinator = await store.list(COORDINATOR_LEASE)
+    return {
+        "shards": NOTIFY_SHARDS,
+        "coordinator": next((holder for holder, _ in coordinator.values()), None),
+        "workers": sorted(holder for holder, _ in workers.values()),
+        "assignments": {
+            int(_suffix(name, ASSIGN_PREFIX)): holder for name, (holder, _) in assignments.items()
+        },
+        "shard_stats": {
+            int(_suffix(name, STATS_PREFIX)): {"worker": holder, "jobs": data}
+            for name, (holder, data) in stats.items()
+        }
+    }
+
+
+class ShardWorker:
+    """
+    One notification worker process. Every tick it checks in, runs the
+    coordinator if it holds the coordinator lease, and runs the due jobs
+    of the shards assigned to it, each shard through its own
+    JobScheduler (daily jobs keep their per-day claim, now per shard).
+
+    The coordinator (any worker; the lease moves if it dies) assigns the
+    shards to the workers that checked in within NOTIFY_WORKER_TTL. A
+    lost shard's running job is left to finish; the new owner picks up
+    from the shard's checkpoint (fanout.py).
+    """
+
+    def __init__(
+        self,
+        store,
+        shards: int = NOTIFY_SHARDS,
+        tick: float = NOTIFY_WORKER_TICK,
+        ttl: float = NOTIFY_WORKER_TTL
+    ):
+        self.store = store
+        self.shards = max(1, shards)
+        self.tick = tick
+        self.ttl = ttl
+        self.holder = worker_id()
+        self.notifications = SmartNotificationScheduler(supabase)
+        self.owned: Dict[int, JobScheduler] = {}
+        self.draining: List[JobScheduler] = []
+        self.is_coordinator = False
+        self.moves = 0
+        self._published: Dict[int, str] = {}
+        self._loop_task: Optional[asyncio.Task] = None
+
+    def _scheduler_for(self, index: int) -> JobScheduler:
+        shard = (index, self.shards)
+        label = shard_label(shard)
+        scheduler = JobScheduler(self.store, lease_ttl=self.ttl, leader_lease=None, holder=self.holder)
+        scheduler.add_job(
+            f"check-reminders{label}", lambda: self.notifications.check_and_send_reminders(shard), every=60
+        )
+        scheduler.add_job(
+            f"morning-motivation{label}", lambda: self.notifications.send_morning_motivation(shard),
+            at=MORNING_MOTIVATION_AT
+        )
+        scheduler.add_job(
+            f"evening-reminder{label}", lambda: self.notifications.send_evening_reminder(shard),
+            at=EVENING_REMINDER_AT
+        )
+        return scheduler
+
+    # ---------- coordination ----------
+
+    async def _coordinate(self) -> None:
+        try:
+            coordinator = await self.store.acquire(COORDINATOR_LEASE, self.holder, self.ttl)
+        except Exception as e:
+            logging.error(f"Shard coordinator lease error: {str(e)}")
+            coordinator = False
+        if coordinator != self.is_coordinator:
+            logging.info(f"🧭 Worker {self.holder} {'is now' if coordinator else 'is no longer'} the shard coordinator")
+        self.is_coordinator = coordinator
+        if not coordinator:
+            return
+
+        workers = [holder for holder, _ in (await self.store.list(WORKER_PREFIX)).values()]
+        current = {
+            int(_suffix(name, ASSIGN_PREFIX)): holder
+            for name, (holder, _) in (await self.store.list(ASSIGN_PREFIX)).items()
+        }
+        plan = plan_assignment(self.shards, workers, current)
+        moved = sorted(index for index, worker in plan.items() if current.get(index) != worker)
+        if moved:
+            self.moves += len(moved)
+            metrics.inc("notification_shard_moves_total", (), len(moved))
+            logging.info(f"🧭 Assigned shards {moved} across {len(workers)} workers")
+        # Assignments outlive a coordinator failover, so shards keep running meanwhile
+        for index, worker in plan.items():
+            await self.store.put(f"{ASSIGN_PREFIX}{index}", worker, 2 * self.ttl)
+
+    async def _sync_owned(self) -> None:
+        assignments = await self.store.list(ASSIGN_PREFIX)
+        mine = {
+            int(_suffix(name, ASSIGN_PREFIX))
+            for name, (holder, _) in assignments.items() if holder == self.holder
+        }
+        for index in sorted(set(self.owned) - mine):
+            logging.info(f"🧭 Worker {self.holder} gave up shard {index}")
+            self.draining.append(self.owned.pop(index))
+            self._published.pop(index, None)
+        for index in sorted(mine - set(self.owned)):
+            if index < self.shards:
+                logging.info(f"🧭 Worker {self.holder} took shard {index}")
+                self.owned[index] = self._scheduler_for(index)
+        self.draining = [scheduler for scheduler in self.draining if scheduler.get_stats()["running"]]
+        for scheduler in self.draining:
+            # A lost shard's run still in progress keeps its day claimed until it settles
+            await scheduler.renew_claims()
+
+    async def _publish(self, index: int, scheduler: JobScheduler) -> None:
+        jobs = scheduler.get_stats()["jobs"]
+        encoded = json.dumps(jobs, sort_keys=True, default=str)
+        if self._published.get(index) == encoded:
+            return
+        await self.store.put(f"{STATS_PREFIX}{index}", self.holder, STATS_TTL, json.loads(encoded))
+        self._published[index] = encoded
+
+    async def run_tick(self) -> None:
+        """Check in, coordinate (if coordinator), run this worker's shards"""
+        await self.store.put(f"{WORKER_PREFIX}{self.holder}", self.holder, self.ttl)
+        await self._coordinate()
+        await self._sync_owned()
+        for index, scheduler in sorted(self.owned.items()):
+            try:
+                await scheduler.run_due_jobs()
+                await self._publish(index, scheduler)
+            except Exception as e:
+                logging.error(f"Error running notification shard {index}: {str(e)}")
+
+    async def _tick_forever(self) -> None:
+        while True:
+            try:
+                await self.run_tick()
+            except Exception as e:
+                logging.error(f"Notification worker tick error: {str(e)}")
+            await asyncio.sleep(self.tick)
+
+    # ---------- lifecycle ----------
+
+    def start(self) -> None:
+        if self._loop_task is None:
+            self._loop_task = asyncio.create_task(self._tick_forever())
+            logging.info(f"🧭 Notification worker {self.holder} started ({self.shards} shards, {self.store.name} lease)")
+
+    async def stop(self) -> None:
+        """Stop ticking, finish running jobs and hand this worker's shards back at once"""
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+            try:
+                await self._loop_task
+            except asyncio.CancelledError:
+                pass
+            self._loop_task = None
+        for scheduler in list(self.owned.values()) + self.draining:
+            await scheduler.stop()
+        names = [f"{ASSIGN_PREFIX}{index}" for index in self.owned] + [f"{WORKER_PREFIX}{self.holder}"]
+        if self.is_coordinator:
+            names.append(COORDINATOR_LEASE)
+        try:
+            for name in names:
+                await self.store.release(name, self.holder)
+        except Exception as e:
+            logging.error(f"Error releasing notification worker leases: {str(e)}")
+        self.owned.clear()
+        self.draining.clear()
+        self.is_coordinator = False
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "holder": self.holder,
+            "shards": self.shards,
+            "is_coordinator": self.is_coordinator,
+            "owned": sorted(self.owned),
+            "draining": len(self.draining),
+            "shard_moves": self.moves
+        }
+
+
+# ============================================
+# WORKER PROCESS
+# ============================================
+
+async def run_worker() -> None:
+    """One worker process: its own DB pool, push connections and reminder index"""
+    if tiered_cache.l2 is None:
+        raise RuntimeError("Notification workers need CACHE_L2_URL (a redis client must be installed)")
+    await tiered_cache.start()
+    start_metrics_push()
+    reminder_queue.start()
+    worker = ShardWorker(lease_store_from_backend(SCHEDULER_LEASE_BACKEND))
+    worker.start()
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
+    await stopping.wait()
+
+    await worker.stop()
+    await reminder_queue.stop()
+    await stop_metrics_push()
+    await push_service.dispatcher.close()
+    await tiered_cache.stop()
+    await close_db()
+
+
+def _process_main() -> None:
+    asyncio.run(run_worker())
+
+
+if __name__ == "__main__":
+    if NOTIFY_SHARDS < 1:
+        print("Set NOTIFY_SHARDS (> 0) to run notification workers")
+        sys.exit(1)
+    if not CACHE_L2_URL or CACHE_L2_URL.startswith("local://"):
+        # Habit writes reach a worker's reminder index only through the shared tier
+        print("Notification workers need a shared cache tier: set CACHE_L2_URL=redis://...")
+        sys.exit(1)
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    if processes > 1 and SCHEDULER_LEASE_BACKEND == "local":
+        print("SCHEDULER_LEASE_BACKEND=local can't coordinate separate processes")
+        sys.exit(1)
+
+    if processes == 1:
+        _process_main()
+    else:
+        # Spawned, not forked: each process builds its own connections
+        context = multiprocessing.get_context("spawn")
+        children = [context.Process(target=_process_main, name=f"notify-worker-{i}") for i in range(processes)]
+        for child in children:
+            child.start()
+        # Ctrl-C reaches the children directly; pass a SIGTERM on to them
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda *_: [child.terminate() for child in children])
+        for child in children:
+            child.join()
@@ -8,6 +8,8 @@ import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from database import supabase
+from fanout import FanoutRun
+from metrics import external_call
 
 load_dotenv()
 
@@ -68,7 +70,8 @@ class NotificationManager:
             with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as server:
                 server.starttls()
                 server.login(SMTP_EMAIL, SMTP_PASSWORD)
-                server.send_message(msg)
+                with external_call("smtp"):
+                    server.send_message(msg)
             
             return True
         except Exception as e:
@@ -76,7 +79,7 @@ class NotificationManager:
             return False
     
     @staticmethod
-    def create_in_app_notification(
+    async def create_in_app_notification(
         user_id: int,
         notification_type: str,
         title: str,
@@ -86,7 +89,7 @@ class NotificationManager:
     ):
         """Create in-app notification"""
         try:
-            supabase.table('notifications').insert({
+            await supabase.table('notifications').insert({
                 'user_id': user_id,
                 'type': notification_type,
                 'title': title,
@@ -100,7 +103,7 @@ class NotificationManager:
             logging.error(f"Error creating notification: {str(e)}")
     
     @staticmethod
-    def get_user_notifications(user_id: int, unread_only: bool = False) -> List[Dict]:
+    async def get_user_notifications(user_id: int, unread_only: bool = False) -> List[Dict]:
         """Get user's notifications"""
         try:
             query = supabase.table('notifications').select('*').eq('user_id', user_id)
@@ -108,17 +111,17 @@ class NotificationManager:
             if unread_only:
                 query = query.eq('read', False)
             
-            response = query.order('created_at', desc=True).limit(50).execute()
+            response = await query.order('created_at', desc=True).limit(50).execute()
             return response.data or []
         except Exception as e:
             logging.error(f"Error getting notifications: {str(e)}")
             return []
     
     @staticmethod
-    def mark_as_read(notification_id: int, user_id: int):
+    async def mark_as_read(notification_id: int, user_id: int):
         """Mark notification as read"""
         try:
-            supabase.table('notifications').update({
+            await supabase.table('notifications').update({
                 'read': True,
                 'read_at': datetime.now().isoformat()
             }).eq('id', notification_id).eq('user_id', user_id).execute()
@@ -130,14 +133,14 @@ class SmartReminderService:
     """Smart reminders that adapt to user behavior"""
     
     @staticmethod
-    def should_send_reminder(user_id: int, habit_id: int) -> Dict[str, Any]:
+    async def should_send_reminder(user_id: int, habit_id: int) -> Dict[str, Any]:
         """Determine if reminder should be sent based on user patterns"""
         try:
             today = date.today().strftime('%Y-%m-%d')
             now = datetime.now()
             
             # Check if already completed today
-            checkin = supabase.table('checkins').select('*').eq(
+            checkin = await supabase.table('checkins').select('*').eq(
                 'habit_id', habit_id
             ).eq('date', today).eq('completed', True).execute()
             
@@ -145,7 +148,7 @@ class SmartReminderService:
                 return {'send': False, 'reason': 'already_completed'}
             
             # Get habit details
-            habit = supabase.table('habits').select('*').eq('id', habit_id).single().execute()
+            habit = await supabase.table('habits').select('*').eq('id', habit_id).single().execute()
             if not habit.data:
                 return {'send': False, 'reason': 'habit_not_found'}
             
@@ -157,7 +160,7 @@ class SmartReminderService:
                 return {'send': False, 'reason': 'not_yet_time'}
             
             # Check if user is active (logged in recently)
-            activity = supabase.table('activity_log').select('*').eq(
+            activity = await supabase.table('activity_log').select('*').eq(
                 'user_id', user_id
             ).gte('created_at', (now - timedelta(hours=2)).isoformat()).execute()
             
@@ -166,7 +169,7 @@ class SmartReminderService:
                 return {'send': False, 'reason': 'user_active'}
             
             # Check streak
-            streak = supabase.table('habit_streaks').select('*').eq('habit_id', habit_id).execute()
+            streak = await supabase.table('habit_streaks').select('*').eq('habit_id', habit_id).execute()
             has_streak = streak.data and streak.data[0].get('current_streak', 0) > 0
             
             return {
@@ -181,63 +184,75 @@ class SmartReminderService:
             return {'send': False, 'reason': 'error'}
     
     @staticmethod
-    async def send_smart_reminders():
-        """Send reminders to all users who need them"""
+    async def send_smart_reminders(dry_run: bool = False):
+        """
+        Send reminders to all users who need them, a page of users at a
+        time. A second call the same day resumes after the last page done;
+        `dry_run` only counts the users who would get an email.
+        """
+        today = date.today().strftime('%Y-%m-%d')
+        run = FanoutRun(f"smart-reminders:{today}", dry_run=dry_run)
+        reminders_sent = 0
+        
         try:
-            # Get all users with enabled notifications
-            users = supabase.table('users').select('*').eq(
-                'email_notifications', True
-            ).execute()
+            await run.load()
+            if run.completed:
+                return {'reminders_sent': 0, 'skipped': 'already sent today', 'fanout': run.get_stats()}
             
-            reminders_sent = 0
-            
-            for user in (users.data or []):
-                # Get user's habits
-                habits = supabase.table('habits').select('*').eq(
-                    'user_id', user['id']
-                ).execute()
-                
-                pending_habits = []
-                
-                for habit in (habits.data or []):
-                    check = SmartReminderService.should_send_reminder(user['id'], habit['id'])
-                    if check.get('send'):
-                        pending_habits.append({
-                            'name': check.get('habit_name', habit['name']),
-                            'message': check.get('message'),
-                            'priority': check.get('priority')
-                        })
-                
-                if pending_habits:
-                    # Check if we already sent a reminder today
-                    today = date.today().strftime('%Y-%m-%d')
-                    existing = supabase.table('notification_log').select('*').eq(
+            # Users with enabled notifications
+            async for users in run.user_pages('id, email, name', filters={'email_notifications': True}):
+                for user in users:
+                    # Get user's habits
+                    habits = await supabase.table('habits').select('*').eq(
                         'user_id', user['id']
-                    ).eq('date', today).eq('type', 'smart_reminder').execute()
+                    ).execute()
                     
-                    if not existing.data:
-                        # Send email
-                        SmartReminderService._send_reminder_email(
-                            user['email'],
-                            user.get('name', 'Friend'),
-                            pending_habits
-                        )
-                        
-                        # Log notification
-                        supabase.table('notification_log').insert({
-                            'user_id': user['id'],
-                            'date': today,
-                            'type': 'smart_reminder',
-                            'data': {'habits': len(pending_habits)}
-                        }).execute()
+                    pending_habits = []
+                    
+                    for habit in (habits.data or []):
+                        check = await SmartReminderService.should_send_reminder(user['id'], habit['id'])
+                        if check.get('send'):
+                            pending_habits.append({
+                                'name': check.get('habit_name', habit['name']),
+                                'message': check.get('message'),
+                                'priority': check.get('priority')
+                            })
+                    
+                    if pending_habits:
+                        # Check if we already sent a reminder today
+                        existing = await supabase.table('notification_log').select('*').eq(
+                            'user_id', user['id']
+                        ).eq('date', today).eq('type', 'smart_reminder').execute()
                         
-                        reminders_sent += 1
+                        if not existing.data:
+                            reminders_sent += 1
+                            if dry_run:
+                                continue
+                            
+                            # Send email
+                            SmartReminderService._send_reminder_email(
+                                user['email'],
+                                user.get('name', 'Friend'),
+                                pending_habits
+                            )
+                            
+                            # Log notification
+                            await supabase.table('notification_log').insert({
+                                'user_id': user['id'],
+                                'date': today,
+                                'type': 'smart_reminder',
+                                'data': {'habits': len(pending_habits)}
+                            }).execute()
+                
+                await run.checkpoint()
             
-            return {'reminders_sent': reminders_sent}
+            await run.finish()
+            key = 'would_send' if dry_run else 'reminders_sent'
+            return {key: reminders_sent, 'fanout': run.get_stats()}
             
         except Exception as e:
             logging.error(f"Error sending smart reminders: {str(e)}")
-            return {'error': str(e)}
+            return {'error': str(e), 'reminders_sent': 0 if dry_run else reminders_sent, 'fanout': run.get_stats()}
     
     @staticmethod
     def _send_reminder_email(email: str, name: str, habits: List[Dict]):
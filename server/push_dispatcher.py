@@ -0,0 +1,320 @@
+# server/push_dispatcher.py
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Union
+from urllib.parse import urlparse
+import aiohttp
+from pywebpush import WebPusher, Vapid
+from dotenv import load_dotenv
+from metrics import metrics
+
+load_dotenv()
+
+# Concurrent sends allowed per push service (each service also gets its own
+# keep-alive connection pool of the same size)
+PUSH_CONCURRENCY = {
+    "fcm": int(os.getenv("PUSH_CONCURRENCY_FCM", "200")),
+    "mozilla": int(os.getenv("PUSH_CONCURRENCY_MOZILLA", "100")),
+    "apple": int(os.getenv("PUSH_CONCURRENCY_APPLE", "100")),
+    "wns": int(os.getenv("PUSH_CONCURRENCY_WNS", "50")),
+    "other": int(os.getenv("PUSH_CONCURRENCY_OTHER", "50")),
+}
+PUSH_TIMEOUT = float(os.getenv("PUSH_TIMEOUT", "10"))
+PUSH_TTL = 86400  # 24 hours
+PUSH_RUN_HISTORY = 20
+
+# VAPID tokens may live up to 24h; sign for 12h and re-sign an hour early
+VAPID_TOKEN_LIFETIME = 12 * 3600
+VAPID_REFRESH_MARGIN = 3600
+
+PUSH_SERVICE_HOSTS = (
+    ("fcm.googleapis.com", "fcm"),
+    ("android.googleapis.com", "fcm"),
+    ("push.services.mozilla.com", "mozilla"),
+    ("push.apple.com", "apple"),
+    ("notify.windows.com", "wns"),
+)
+
+
+def push_service_for(endpoint: str) -> str:
+    """Push service family of a subscription endpoint (pool / limit key)"""
+    host = urlparse(endpoint).hostname or ""
+    for suffix, service in PUSH_SERVICE_HOSTS:
+        if host == suffix or host.endswith("." + suffix):
+            return service
+    return "other"
+
+
+@dataclass
+class PushMessage:
+    """One encrypted push to one subscription; `context` is passed back to callbacks"""
+    subscription: Dict[str, Any]
+    payload: Dict[str, Any]
+    urgency: str = "normal"
+    ttl: int = PUSH_TTL
+    context: Dict[str, Any] = field(default_factory=dict)
+
+
+ResultCallback = Callable[[PushMessage, Dict[str, Any]], Union[None, Awaitable[None]]]
+
+
+class _RunStats:
+    """Throughput of one dispatch run"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self.latencies: List[float] = []
+        self.sent = 0
+        self.failed = 0
+        self.expired = 0
+        self.failures_by_status: Counter = Counter()
+        self.by_service: Counter = Counter()
+
+    def observe(self, service: str, result: Dict[str, Any], elapsed: float) -> None:
+        self.latencies.append(elapsed)
+        self.by_service[service] += 1
+        if result["success"]:
+            self.sent += 1
+            return
+        self.failed += 1
+        if result.get("should_remove"):
+            self.expired += 1
+        self.failures_by_status[str(result.get("status_code") or result.get("error"))] += 1
+
+    def as_dict(self) -> Dict[str, Any]:
+        duration = time.perf_counter() - self.started
+        latencies = sorted(self.latencies)
+        total = len(latencies)
+
+        def percentile(p: float) -> float:
+            if not latencies:
+                return 0.0
+            return round(latencies[min(total - 1, int(p * total))] * 1000, 1)
+
+        return {
+            "name": self.name,
+            "started_at": self.started_at,
+            "total": total,
+            "sent": self.sent,
+            "failed": self.failed,
+            "expired": self.expired,
+            "duration_s": round(duration, 3),
+            "sends_per_sec": round(total / duration, 1) if duration > 0 else 0.0,
+            "latency_ms": {
+                "avg": round(sum(latencies) / max(1, total) * 1000, 1),
+                "p50": percentile(0.50),
+                "p95": percentile(0.95),
+                "max": round(latencies[-1] * 1000, 1) if latencies else 0.0
+            },
+            "failures_by_status": dict(self.failures_by_status),
+            "by_service": dict(self.by_service)
+        }
+
+
+def combine_reports(name: str, reports: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    One report for a run sent in several dispatches (a paged fan-out).
+    Latency percentiles can't be merged exactly: p50/p95 are the worst
+    page's.
+    """
+    total = sum(report["total"] for report in reports)
+    duration = sum(report["duration_s"] for report in reports)
+    failures_by_status: Counter = Counter()
+    by_service: Counter = Counter()
+    for report in reports:
+        failures_by_status.update(report["failures_by_status"])
+        by_service.update(report["by_service"])
+    return {
+        "name": name,
+        "started_at": reports[0]["started_at"] if reports else time.time(),
+        "dispatches": len(reports),
+        "total": total,
+        "sent": sum(report["sent"] for report in reports),
+        "failed": sum(report["failed"] for report in reports),
+        "expired": sum(report["expired"] for report in reports),
+        "duration_s": round(duration, 3),
+        "sends_per_sec": round(total / duration, 1) if duration > 0 else 0.0,
+        "latency_ms": {
+            "avg": round(sum(r["latency_ms"]["avg"] * r["total"] for r in reports) / max(1, total), 1),
+            "p50": max((r["latency_ms"]["p50"] for r in reports), default=0.0),
+            "p95": max((r["latency_ms"]["p95"] for r in reports), default=0.0),
+            "max": max((r["latency_ms"]["max"] for r in reports), default=0.0)
+        },
+        "failures_by_status": dict(failures_by_status),
+        "by_service": dict(by_service)
+    }
+
+
+class PushDispatcher:
+    """
+    Sends web pushes concurrently. Each push service (FCM, Mozilla, Apple,
+    ...) gets its own pooled aiohttp session and semaphore, so a slow
+    service can't starve the others. VAPID headers are signed once per
+    origin and reused until close to expiry; only the payload encryption
+    is done per message.
+    """
+
+    def __init__(
+        self,
+        private_key: Optional[str],
+        claims_email: str,
+        concurrency: Dict[str, int] = PUSH_CONCURRENCY,
+        timeout: float = PUSH_TIMEOUT
+    ):
+        self.private_key = private_key
+        self.claims_email = claims_email
+        self.concurrency = dict(concurrency)
+        self.timeout = timeout
+        self._vapid: Optional[Vapid] = None
+        self._vapid_headers: Dict[str, tuple] = {}  # origin -> (headers, expires_at)
+        self._sessions: Dict[str, aiohttp.ClientSession] = {}
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.runs: deque = deque(maxlen=PUSH_RUN_HISTORY)
+
+    # ---------- per-service resources ----------
+
+    def _limit(self, service: str) -> int:
+        return max(1, self.concurrency.get(service, self.concurrency.get("other", 50)))
+
+    def _session(self, service: str) -> aiohttp.ClientSession:
+        session = self._sessions.get(service)
+        if session is None or session.closed:
+            limit = self._limit(service)
+            session = self._sessions[service] = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=limit, ttl_dns_cache=300, keepalive_timeout=30),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return session
+
+    def _semaphore(self, service: str) -> asyncio.Semaphore:
+        semaphore = self._semaphores.get(service)
+        if semaphore is None:
+            semaphore = self._semaphores[service] = asyncio.Semaphore(self._limit(service))
+        return semaphore
+
+    def _vapid_for(self, endpoint: str) -> Dict[str, str]:
+        url = urlparse(endpoint)
+        origin = f"{url.scheme}://{url.netloc}"
+        now = time.time()
+        cached = self._vapid_headers.get(origin)
+        if cached is not None and cached[1] - VAPID_REFRESH_MARGIN > now:
+            return cached[0]
+
+        if self._vapid is None:
+            if os.path.isfile(self.private_key):
+                self._vapid = Vapid.from_file(self.private_key)
+            else:
+                self._vapid = Vapid.from_string(private_key=self.private_key)
+        expires_at = int(now) + VAPID_TOKEN_LIFETIME
+        headers = self._vapid.sign({"sub": self.claims_email, "aud": origin, "exp": expires_at})
+        self._vapid_headers[origin] = (headers, expires_at)
+        return headers
+
+    # ---------- sending ----------
+
+    async def _deliver(self, message: PushMessage, service: str) -> Dict[str, Any]:
+        endpoint = message.subscription.get("endpoint", "")
+        headers = {
+            **self._vapid_for(endpoint),
+            "Urgency": message.urgency,
+            "TTL": str(message.ttl)
+        }
+        pusher = WebPusher(message.subscription, aiohttp_session=self._session(service))
+        response = await pusher.send_async(
+            data=json.dumps(message.payload), headers=headers, ttl=message.ttl, timeout=self.timeout
+        )
+        if response.status < 400:
+            return {"success": True, "status_code": response.status}
+        if response.status in (404, 410):
+            return {"success": False, "error": "subscription_expired", "status_code": response.status, "should_remove": True}
+        return {"success": False, "error": f"Push service responded {response.status}", "status_code": response.status}
+
+    async def send(self, message: PushMessage) -> Dict[str, Any]:
+        """Send one message; never raises (errors are returned like send_notification's)"""
+        if not self.private_key:
+            return {"success": False, "error": "VAPID keys not configured"}
+
+        service = push_service_for(message.subscription.get("endpoint", ""))
+        async with self._semaphore(service):
+            started = time.perf_counter()
+            outcome = "error"
+            try:
+                result = await self._deliver(message, service)
+                if result["success"]:
+                    outcome = "ok"
+            except asyncio.TimeoutError:
+                result = {"success": False, "error": "timeout"}
+            except Exception as e:
+                logging.error(f"Push notification error: {str(e)}")
+                result = {"success": False, "error": str(e)}
+            elapsed = time.perf_counter() - started
+        metrics.inc("external_calls_total", ("webpush", outcome))
+        metrics.observe("external_call_duration_seconds", ("webpush",), elapsed)
+        result["service"] = service
+        result["latency_ms"] = round(elapsed * 1000, 1)
+        return result
+
+    async def dispatch(
+        self,
+        messages: Iterable[PushMessage],
+        on_result: Optional[ResultCallback] = None,
+        name: str = "push"
+    ) -> Dict[str, Any]:
+        """
+        Send every message concurrently (bounded per push service) and
+        return the run's throughput report. `on_result(message, result)`
+        is called as each send completes and may be a coroutine function.
+        """
+        stats = _RunStats(name)
+
+        async def send_one(message: PushMessage):
+            result = await self.send(message)
+            stats.observe(result["service"], result, result["latency_ms"] / 1000)
+            if on_result is not None:
+                try:
+                    outcome = on_result(message, result)
+                    if asyncio.iscoroutine(outcome):
+                        await outcome
+                except Exception as e:
+                    logging.error(f"Error in push result callback: {str(e)}")
+
+        # Semaphores bound the sends in flight; cap the waiting tasks too so
+        # a 50k-device run doesn't hold 50k coroutines at once
+        pending: set = set()
+        backlog = sum(self._limit(service) for service in self.concurrency) * 2
+        for message in messages:
+            if len(pending) >= backlog:
+                _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            pending.add(asyncio.create_task(send_one(message)))
+        if pending:
+            await asyncio.wait(pending)
+
+        report = stats.as_dict()
+        self.runs.append(report)
+        if report["total"]:
+            logging.info(
+                f"📨 Push run '{name}': {report['sent']}/{report['total']} sent, "
+                f"{report['sends_per_sec']}/s, p95 {report['latency_ms']['p95']}ms"
+            )
+        return report
+
+    async def close(self) -> None:
+        """Close the pooled connections (call on app shutdown)"""
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions.clear()
+        self._semaphores.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "concurrency": self.concurrency,
+            "open_pools": sorted(service for service, session in self._sessions.items() if not session.closed),
+            "recent_runs": list(self.runs)
+        }
@@ -1,11 +1,14 @@
 # server/push_notification_service.py
 import os
-import json
 import logging
 from datetime import datetime, date, timedelta
 from typing import List, Dict, Any, Optional
-from pywebpush import webpush, WebPushException
 from dotenv import load_dotenv
+from streak_engine import effective_streak
+from push_dispatcher import PushDispatcher, PushMessage, ResultCallback, combine_reports
+from reminder_queue import reminder_queue, REMINDER_MAX_CATCHUP_MINUTES
+from fanout import FanoutRun, Shard, in_shard, shard_label
+from database import iter_rows
 
 load_dotenv()
 
@@ -18,17 +21,23 @@ logging.basicConfig(level=logging.INFO)
 
 
 class PushNotificationService:
-    """Web Push Notification Service"""
+    """
+    Web Push Notification Service. The `*_message` methods build a
+    PushMessage; the `send_*` methods send one through the dispatcher.
+    Fan-outs should build messages and hand them all to
+    `self.dispatcher.dispatch` (or `send_bulk_notifications`).
+    """
     
     def __init__(self):
         self.public_key = VAPID_PUBLIC_KEY
         self.private_key = VAPID_PRIVATE_KEY
         self.claims_email = VAPID_CLAIMS_EMAIL
+        self.dispatcher = PushDispatcher(self.private_key, self.claims_email)
         
         if not self.public_key or not self.private_key:
             logging.warning("⚠️ VAPID keys not configured! Push notifications will not work.")
     
-    def send_notification(
+    def notification_message(
         self,
         subscription: Dict[str, Any],
         title: str,
@@ -40,69 +49,51 @@ class PushNotificationService:
         actions: List[Dict] = None,
         require_interaction: bool = False,
         silent: bool = False,
-        urgency: str = "normal"  # "very-low", "low", "normal", "high"
-    ) -> Dict[str, Any]:
-        """Send a push notification to a single subscription"""
+        urgency: str = "normal",  # "very-low", "low", "normal", "high"
+        context: Dict = None
+    ) -> PushMessage:
+        """Build a push notification for a single subscription"""
         
-        if not self.public_key or not self.private_key:
-            return {"success": False, "error": "VAPID keys not configured"}
+        payload = {
+            "title": title,
+            "body": body,
+            "icon": icon,
+            "badge": badge,
+            "timestamp": datetime.now().isoformat(),
+            "requireInteraction": require_interaction,
+            "silent": silent,
+        }
         
-        try:
-            payload = {
-                "title": title,
-                "body": body,
-                "icon": icon,
-                "badge": badge,
-                "timestamp": datetime.now().isoformat(),
-                "requireInteraction": require_interaction,
-                "silent": silent,
-            }
-            
-            if tag:
-                payload["tag"] = tag
-            if data:
-                payload["data"] = data
-            if actions:
-                payload["actions"] = actions
-            
-            vapid_claims = {
-                "sub": self.claims_email
-            }
-            
-            response = webpush(
-                subscription_info=subscription,
-                data=json.dumps(payload),
-                vapid_private_key=self.private_key,
-                vapid_claims=vapid_claims,
-                headers={
-                    "Urgency": urgency,
-                    "TTL": str(86400)  # 24 hours
-                }
-            )
-            
-            logging.info(f"✅ Push notification sent: {title}")
-            return {"success": True, "status_code": response.status_code}
-            
-        except WebPushException as e:
-            logging.error(f"Push notification failed: {str(e)}")
-            
-            # Check if subscription is expired/invalid
-            if e.response and e.response.status_code in [404, 410]:
-                return {"success": False, "error": "subscription_expired", "should_remove": True}
-            
-            return {"success": False, "error": str(e)}
-        except Exception as e:
-            logging.error(f"Push notification error: {str(e)}")
-            return {"success": False, "error": str(e)}
+        if tag:
+            payload["tag"] = tag
+        if data:
+            payload["data"] = data
+        if actions:
+            payload["actions"] = actions
+        
+        return PushMessage(subscription, payload, urgency=urgency, context=context or {})
     
-    def send_bulk_notifications(
+    async def send_notification(
+        self,
+        subscription: Dict[str, Any],
+        title: str,
+        body: str,
+        **kwargs
+    ) -> Dict[str, Any]:
+        """Send a push notification to a single subscription"""
+        return await self.dispatcher.send(
+            self.notification_message(subscription, title, body, **kwargs)
+        )
+    
+    async def send_bulk_notifications(
         self,
         subscriptions: List[Dict[str, Any]],
         title: str,
         body: str,
+        on_result: Optional[ResultCallback] = None,
         **kwargs
     ) -> Dict[str, Any]:
-        """Send notifications to multiple subscriptions"""
+        """Send the same notification to multiple subscriptions concurrently"""
         
         results = {
             "total": len(subscriptions),
@@ -111,32 +102,38 @@ class PushNotificationService:
             "expired": []
         }
         
-        for subscription in subscriptions:
-            result = self.send_notification(subscription, title, body, **kwargs)
-            
+        def collect(message: PushMessage, result: Dict[str, Any]):
             if result.get("success"):
                 results["success"] += 1
             else:
                 results["failed"] += 1
                 if result.get("should_remove"):
-                    results["expired"].append(subscription)
+                    results["expired"].append(message.subscription)
+            if on_result is not None:
+                return on_result(message, result)
         
+        results["report"] = await self.dispatcher.dispatch(
+            (self.notification_message(subscription, title, body, **kwargs) for subscription in subscriptions),
+            on_result=collect,
+            name=kwargs.get("tag") or "bulk"
+        )
         return results
     
-    def send_habit_reminder(
+    def habit_reminder_message(
         self,
         subscription: Dict[str, Any],
         habit_name: str,
         habit_time: str,
-        streak: int = 0
-    ) -> Dict[str, Any]:
-        """Send habit reminder notification"""
+        streak: int = 0,
+        context: Dict = None
+    ) -> PushMessage:
+        """Build a habit reminder notification"""
         
         body = f"Time for: {habit_name}"
         if streak > 0:
             body += f" 🔥 {streak} day streak!"
         
-        return self.send_notification(
+        return self.notification_message(
             subscription=subscription,
             title="🎯 Habit Reminder",
             body=body,
@@ -152,18 +149,24 @@ class PushNotificationService:
                 {"action": "snooze", "title": "⏰ Snooze 10min"}
             ],
             require_interaction=True,
-            urgency="high"
+            urgency="high",
+            context=context
         )
     
-    def send_streak_alert(
+    async def send_habit_reminder(self, subscription: Dict[str, Any], *args, **kwargs) -> Dict[str, Any]:
+        """Send habit reminder notification"""
+        return await self.dispatcher.send(self.habit_reminder_message(subscription, *args, **kwargs))
+    
+    def streak_alert_message(
         self,
         subscription: Dict[str, Any],
         current_streak: int,
-        incomplete_count: int
-    ) -> Dict[str, Any]:
-        """Send streak at risk notification"""
+        incomplete_count: int,
+        context: Dict = None
+    ) -> PushMessage:
+        """Build a streak at risk notification"""
         
-        return self.send_notification(
+        return self.notification_message(
             subscription=subscription,
             title="⚠️ Streak at Risk!",
             body=f"You have {incomplete_count} habits left today. Don't lose your {current_streak}-day streak!",
@@ -178,18 +181,24 @@ class PushNotificationService:
                 {"action": "dismiss", "title": "Dismiss"}
             ],
             require_interaction=True,
-            urgency="high"
+            urgency="high",
+            context=context
         )
     
-    def send_daily_motivation(
+    async def send_streak_alert(self, subscription: Dict[str, Any], *args, **kwargs) -> Dict[str, Any]:
+        """Send streak at risk notification"""
+        return await self.dispatcher.send(self.streak_alert_message(subscription, *args, **kwargs))
+    
+    def daily_motivation_message(
         self,
         subscription: Dict[str, Any],
         message: str,
-        day_number: int
-    ) -> Dict[str, Any]:
-        """Send daily motivational notification"""
+        day_number: int,
+        context: Dict = None
+    ) -> PushMessage:
+        """Build a daily motivational notification"""
         
-        return self.send_notification(
+        return self.notification_message(
             subscription=subscription,
             title=f"💪 Day {day_number} of 100",
             body=message,
@@ -199,19 +208,25 @@ class PushNotificationService:
                 "day": day_number,
                 "url": "/daily"
             },
-            urgency="normal"
+            urgency="normal",
+            context=context
         )
     
-    def send_achievement(
+    async def send_daily_motivation(self, subscription: Dict[str, Any], *args, **kwargs) -> Dict[str, Any]:
+        """Send daily motivational notification"""
+        return await self.dispatcher.send(self.daily_motivation_message(subscription, *args, **kwargs))
+    
+    def achievement_message(
         self,
         subscription: Dict[str, Any],
         badge_name: str,
         badge_icon: str,
-        xp_earned: int
-    ) -> Dict[str, Any]:
-        """Send achievement unlocked notification"""
+        xp_earned: int,
+        context: Dict = None
+    ) -> PushMessage:
+        """Build an achievement unlocked notification"""
         
-        return self.send_notification(
+        return self.notification_message(
             subscription=subscription,
             title="🏆 Achievement Unlocked!",
             body=f"{badge_icon} {badge_name} - +{xp_earned} XP",
@@ -223,17 +238,23 @@ class PushNotificationService:
                 "url": "/badges"
             },
             require_interaction=True,
-            urgency="normal"
+            urgency="normal",
+            context=context
         )
     
-    def send_perfect_day(
+    async def send_achievement(self, subscription: Dict[str, Any], *args, **kwargs) -> Dict[str, Any]:
+        """Send achievement unlocked notification"""
+        return await self.dispatcher.send(self.achievement_message(subscription, *args, **kwargs))
+    
+    def perfect_day_message(
         self,
         subscription: Dict[str, Any],
-        streak: int
-    ) -> Dict[str, Any]:
-        """Send perfect day celebration notification"""
+        streak: int,
+        context: Dict = None
+    ) -> PushMessage:
+        """Build a perfect day celebration notification"""
         
-        return self.send_notification(
+        return self.notification_message(
             subscription=subscription,
             title="🎉 Perfect Day!",
             body=f"All habits completed! Your streak is now {streak} days! 🔥",
@@ -243,17 +264,23 @@ class PushNotificationService:
                 "streak": streak,
                 "url": "/daily"
             },
-            urgency="normal"
+            urgency="normal",
+            context=context
         )
     
-    def send_sleep_reminder(
+    async def send_perfect_day(self, subscription: Dict[str, Any], *args, **kwargs) -> Dict[str, Any]:
+        """Send perfect day celebration notification"""
+        return await self.dispatcher.send(self.perfect_day_message(subscription, *args, **kwargs))
+    
+    def sleep_reminder_message(
         self,
         subscription: Dict[str, Any],
-        suggested_bedtime: str = "22:00"
-    ) -> Dict[str, Any]:
-        """Send sleep reminder notification"""
+        suggested_bedtime: str = "22:00",
+        context: Dict = None
+    ) -> PushMessage:
+        """Build a sleep reminder notification"""
         
-        return self.send_notification(
+        return self.notification_message(
             subscription=subscription,
             title="😴 Time to Wind Down",
             body=f"For optimal rest, start your bedtime routine now. Target: {suggested_bedtime}",
@@ -266,8 +293,13 @@ class PushNotificationService:
                 {"action": "track", "title": "📝 Log Sleep"},
                 {"action": "snooze", "title": "⏰ Remind Later"}
             ],
-            urgency="low"
+            urgency="low",
+            context=context
         )
+    
+    async def send_sleep_reminder(self, subscription: Dict[str, Any], *args, **kwargs) -> Dict[str, Any]:
+        """Send sleep reminder notification"""
+        return await self.dispatcher.send(self.sleep_reminder_message(subscription, *args, **kwargs))
 
 
 # Singleton instance
@@ -282,13 +314,33 @@ class SmartNotificationScheduler:
         self.supabase = supabase_client
         self.push_service = push_service
     
-    async def check_and_send_reminders(self) -> Dict[str, Any]:
-        """Check all users and send appropriate reminders"""
+    @staticmethod
+    def _count_sent(results: Dict) -> ResultCallback:
+        """Dispatch callback: count each delivered push under its context's "counter" key"""
+        def count(message: PushMessage, result: Dict[str, Any]):
+            if result.get('success'):
+                results[message.context.get("counter", "sent")] += 1
+        return count
+    
+    @staticmethod
+    def _report(results: Dict, run: FanoutRun, reports: List[Dict], name: str) -> Dict[str, Any]:
+        if reports:
+            results["dispatch"] = combine_reports(name, reports)
+        results["fanout"] = run.get_stats()
+        return results
+    
+    async def check_and_send_reminders(self, shard: Optional[Shard] = None, dry_run: bool = False) -> Dict[str, Any]:
+        """
+        Send the habit reminders and streak alerts that came due since the
+        last check (call every 1-10 minutes). Only due habits are looked
+        at, their users in pages of FANOUT_PAGE_SIZE: one query each per
+        page for the users, their check-ins and the streak alert log.
         
-        today = date.today().strftime('%Y-%m-%d')
-        current_time = datetime.now()
-        current_hour = current_time.hour
-        current_minute = current_time.minute
+        The tick's window of minutes and the last user sent are
+        checkpointed, so a tick that dies part-way is finished by the next
+        one. With `shard`, only that slice of the users is handled; with
+        `dry_run`, nothing is sent and the cursor doesn't move.
+        """
         
         results = {
             "checked_users": 0,
@@ -296,140 +348,193 @@ class SmartNotificationScheduler:
             "streak_alerts_sent": 0,
             "errors": []
         }
+        if dry_run:
+            results["would_send"] = 0
+        label = shard_label(shard)
+        consumer = f"push{label}"
+        name = f"check-reminders{label}"
+        run = FanoutRun(name, dry_run=dry_run)
+        reports: List[Dict] = []
         
         try:
-            # Get all users with push subscriptions
-            users_response = self.supabase.table('users').select(
-                'id, name, push_subscriptions, notification_preferences'
-            ).not_.is_('push_subscriptions', 'null').execute()
+            checkpoint = await run.load()
+            await reminder_queue.refresh()
             
-            users = users_response.data or []
-            results["checked_users"] = len(users)
+            window = checkpoint.get("window")
+            stale_before = datetime.now() - timedelta(minutes=REMINDER_MAX_CATCHUP_MINUTES)
+            if window and datetime.fromisoformat(window[1]) >= stale_before:
+                start, end = (datetime.fromisoformat(moment) for moment in window)
+                if not dry_run:
+                    # A restarted worker carries on from the last window, not from now
+                    reminder_queue.resume_cursor(consumer, end)
+            else:
+                window = None
             
-            for user in users:
-                try:
-                    await self._process_user_notifications(
-                        user, today, current_hour, current_minute, results
-                    )
-                except Exception as e:
-                    results["errors"].append(f"User {user['id']}: {str(e)}")
+            if window is None or run.completed:
+                start, end = reminder_queue.claim_window(consumer, peek=dry_run)
+                run.position = run.resumed_from = None
+                await run.save(window=[start.isoformat(), end.isoformat()], after=None, done=False)
             
-            return results
+            due = [
+                entry for entry in reminder_queue.due_between(start, end, ("habit", "streak_alert"))
+                if in_shard(entry[2]['user_id'], shard)
+                and (run.position is None or entry[2]['user_id'] > run.position)
+            ]
+            if not dry_run:
+                reminder_queue.count_fired(due)
+            
+            user_ids = sorted({habit['user_id'] for _, _, habit in due})
+            days = sorted({day for day, _, _ in due})
+            
+            for i in range(0, len(user_ids), run.page_size):
+                page_ids = user_ids[i:i + run.page_size]
+                page_due = [entry for entry in due if page_ids[0] <= entry[2]['user_id'] <= page_ids[-1]]
+                pushes: List[PushMessage] = []
+                
+                users_response = await self.supabase.table('users').select(
+                    'id, name, push_subscriptions, notification_preferences, current_streak, last_perfect_date'
+                ).in_('id', page_ids).not_.is_('push_subscriptions', 'null').execute()
+                users = {user['id']: user for user in (users_response.data or [])}
+                results["checked_users"] += len(users)
+                
+                completed = set()
+                already_alerted = set()
+                if users:
+                    # Keyset paged: the page's check-ins can exceed the max-rows cap
+                    completed = {
+                        (str(c['date']), c['habit_id']) async for c in iter_rows(
+                            'checkins', {'user_id': list(users), 'date': days, 'completed': True},
+                            columns='habit_id, date'
+                        )
+                    }
+                    
+                    alert_keys = {
+                        f"streak_alert_{habit['user_id']}_{day}"
+                        for day, kind, habit in page_due if kind == "streak_alert"
+                    }
+                    if alert_keys:
+                        log_response = await self.supabase.table('notification_log').select('key').in_(
+                            'key', sorted(alert_keys)
+                        ).execute()
+                        already_alerted = {row['key'] for row in (log_response.data or [])}
+                
+                alert_log = []
+                for day, kind, habit in page_due:
+                    user = users.get(habit['user_id'])
+                    if user is None or (day, habit['id']) in completed:
+                        continue
+                    try:
+                        alert = self._queue_user_notification(
+                            user, day, kind, habit, completed, already_alerted, pushes
+                        )
+                        if alert:
+                            alert_log.append(alert)
+                    except Exception as e:
+                        results["errors"].append(f"User {user['id']}: {str(e)}")
+                
+                run.position = page_ids[-1]
+                if dry_run:
+                    results["would_send"] += len(pushes)
+                    continue
+                
+                if alert_log:
+                    # Log the alerts so each user gets at most one per day
+                    await self.supabase.table('notification_log').insert(alert_log).execute()
+                
+                # The page's pushes go out together, concurrently
+                reports.append(await self.push_service.dispatcher.dispatch(
+                    pushes, on_result=self._count_sent(results), name=name
+                ))
+                await run.checkpoint()
+            
+            await run.finish()
             
         except Exception as e:
             logging.error(f"Error in check_and_send_reminders: {str(e)}")
             results["errors"].append(str(e))
-            return results
+        
+        return self._report(results, run, reports, name)
     
-    async def _process_user_notifications(
+    def _queue_user_notification(
         self,
         user: Dict,
-        today: str,
-        current_hour: int,
-        current_minute: int,
-        results: Dict
-    ):
-        """Process notifications for a single user"""
+        day: str,
+        kind: str,
+        habit: Dict,
+        completed: set,
+        already_alerted: set,
+        pushes: List[PushMessage]
+    ) -> Optional[Dict]:
+        """Queue one due, incomplete habit's push; returns a notification_log row for a new streak alert"""
         
         user_id = user['id']
-        subscriptions = user.get('push_subscriptions', [])
-        preferences = user.get('notification_preferences', {})
-        
-        if not subscriptions:
-            return
+        subscriptions = user.get('push_subscriptions') or []
+        preferences = user.get('notification_preferences') or {}
         
-        # Check notification preferences
-        if not preferences.get('push_enabled', True):
-            return
+        if not subscriptions or not preferences.get('push_enabled', True):
+            return None
         
-        # Get user's habits
-        habits_response = self.supabase.table('habits').select('*').eq(
-            'user_id', user_id
-        ).execute()
-        habits = habits_response.data or []
+        current_streak = effective_streak(user)
         
-        if not habits:
-            return
+        # Reminder at habit time
+        if kind == "habit":
+            for subscription in subscriptions:
+                pushes.append(self.push_service.habit_reminder_message(
+                    subscription=subscription,
+                    habit_name=habit['name'],
+                    habit_time=habit['time'],
+                    streak=current_streak,
+                    context={"counter": "reminders_sent"}
+                ))
+            return None
         
-        # Get today's checkins
-        checkins_response = self.supabase.table('checkins').select('*').eq(
-            'user_id', user_id
-        ).eq('date', today).execute()
-        
-        completed_habit_ids = set(
-            c['habit_id'] for c in (checkins_response.data or []) if c['completed']
-        )
+        # Streak alert once a habit is 2 hours overdue, at most once a day
+        if not preferences.get('streak_alerts', True):
+            return None
+        alert_key = f"streak_alert_{user_id}_{day}"
+        if alert_key in already_alerted:
+            return None
+        already_alerted.add(alert_key)
         
-        # Get user stats for streak info
-        stats_response = self.supabase.table('users').select(
-            'current_streak'
-        ).eq('id', user_id).single().execute()
+        habit_ids = [h['id'] for h in reminder_queue.user_habits(user_id)]
+        incomplete_count = sum(1 for habit_id in habit_ids if (day, habit_id) not in completed)
         
-        current_streak = stats_response.data.get('current_streak', 0) if stats_response.data else 0
+        for subscription in subscriptions:
+            pushes.append(self.push_service.streak_alert_message(
+                subscription=subscription,
+                current_streak=current_streak,
+                incomplete_count=incomplete_count,
+                context={"counter": "streak_alerts_sent"}
+            ))
         
-        # Process each habit
-        for habit in habits:
-            if habit['id'] in completed_habit_ids:
-                continue  # Already completed
-            
-            habit_time = habit.get('time', '09:00')
-            try:
-                habit_hour, habit_minute = map(int, habit_time.split(':'))
-            except:
-                continue
-            
-            # Check if it's time for the habit reminder
-            time_diff_minutes = (current_hour * 60 + current_minute) - (habit_hour * 60 + habit_minute)
-            
-            # Send reminder at habit time
-            if 0 <= time_diff_minutes <= 5:
-                for subscription in subscriptions:
-                    result = self.push_service.send_habit_reminder(
-                        subscription=subscription,
-                        habit_name=habit['name'],
-                        habit_time=habit_time,
-                        streak=current_streak
-                    )
-                    if result.get('success'):
-                        results["reminders_sent"] += 1
-            
-            # Send streak alert if habit is 2+ hours overdue
-            elif time_diff_minutes >= 120 and preferences.get('streak_alerts', True):
-                # Check if we already sent an alert today for this user
-                alert_key = f"streak_alert_{user_id}_{today}"
-                existing_alert = self.supabase.table('notification_log').select('id').eq(
-                    'key', alert_key
-                ).execute()
-                
-                if not existing_alert.data:
-                    incomplete_count = len(habits) - len(completed_habit_ids)
-                    
-                    for subscription in subscriptions:
-                        result = self.push_service.send_streak_alert(
-                            subscription=subscription,
-                            current_streak=current_streak,
-                            incomplete_count=incomplete_count
-                        )
-                        if result.get('success'):
-                            results["streak_alerts_sent"] += 1
-                    
-                    # Log that we sent the alert
-                    self.supabase.table('notification_log').insert({
-                        'key': alert_key,
-                        'user_id': user_id,
-                        'type': 'streak_alert',
-                        'sent_at': datetime.now().isoformat()
-                    }).execute()
+        return {
+            'key': alert_key,
+            'user_id': user_id,
+            'type': 'streak_alert',
+            'sent_at': datetime.now().isoformat()
+        }
     
-    async def send_morning_motivation(self) -> Dict[str, Any]:
-        """Send morning motivational messages (call at ~7 AM)"""
+    async def send_morning_motivation(self, shard: Optional[Shard] = None, dry_run: bool = False) -> Dict[str, Any]:
+        """
+        Send morning motivational messages (call at ~7 AM), a page of
+        users at a time. A second call the same day resumes after the last
+        page sent; with `shard`, only that slice of the users; with
+        `dry_run`, only counts what would be sent.
+        """
         
-        results = {"sent": 0, "errors": []}
+        today = date.today().strftime('%Y-%m-%d')
+        name = f"morning-motivation{shard_label(shard)}"
+        results = {"sent": 0, "checked_users": 0, "errors": []}
+        if dry_run:
+            results["would_send"] = 0
+        run = FanoutRun(f"{name}:{today}", dry_run=dry_run)
+        reports: List[Dict] = []
         
         try:
-            users_response = self.supabase.table('users').select(
-                'id, name, push_subscriptions, notification_preferences, total_completed_days'
-            ).not_.is_('push_subscriptions', 'null').execute()
+            await run.load()
+            if run.completed:
+                results["skipped"] = "already sent today"
+                return self._report(results, run, reports, name)
             
             messages = [
                 "Rise and shine! Today is another step toward your goals. 🌅",
@@ -441,82 +546,124 @@ class SmartNotificationScheduler:
             
             import random
             
-            for user in (users_response.data or []):
-                preferences = user.get('notification_preferences', {})
-                if not preferences.get('morning_motivation', True):
-                    continue
-                
-                subscriptions = user.get('push_subscriptions', [])
-                day_number = (user.get('total_completed_days', 0) or 0) + 1
-                
-                message = random.choice(messages)
+            async for users in run.user_pages(
+                'id, name, push_subscriptions, notification_preferences, total_completed_days',
+                shard=shard, subscribed=True
+            ):
+                results["checked_users"] += len(users)
+                pushes: List[PushMessage] = []
+                for user in users:
+                    preferences = user.get('notification_preferences') or {}
+                    if not preferences.get('morning_motivation', True):
+                        continue
+                    
+                    subscriptions = user.get('push_subscriptions') or []
+                    day_number = (user.get('total_completed_days', 0) or 0) + 1
+                    
+                    message = random.choice(messages)
+                    
+                    for subscription in subscriptions:
+                        pushes.append(self.push_service.daily_motivation_message(
+                            subscription=subscription,
+                            message=message,
+                            day_number=min(day_number, 100)
+                        ))
                 
-                for subscription in subscriptions:
-                    result = self.push_service.send_daily_motivation(
-                        subscription=subscription,
-                        message=message,
-                        day_number=min(day_number, 100)
-                    )
-                    if result.get('success'):
-                        results["sent"] += 1
+                if dry_run:
+                    results["would_send"] += len(pushes)
+                    continue
+                reports.append(await self.push_service.dispatcher.dispatch(
+                    pushes, on_result=self._count_sent(results), name=name
+                ))
+                await run.checkpoint()
             
-            return results
+            await run.finish()
             
         except Exception as e:
             results["errors"].append(str(e))
-            return results
+        
+        return self._report(results, run, reports, name)
     
-    async def send_evening_reminder(self) -> Dict[str, Any]:
-        """Send evening reminder for incomplete habits (call at ~8 PM)"""
+    async def send_evening_reminder(self, shard: Optional[Shard] = None, dry_run: bool = False) -> Dict[str, Any]:
+        """
+        Send evening reminder for incomplete habits (call at ~8 PM), a page
+        of users at a time. Resumable, sharded and dry-run like
+        send_morning_motivation.
+        """
         
         today = date.today().strftime('%Y-%m-%d')
-        results = {"sent": 0, "errors": []}
+        name = f"evening-reminder{shard_label(shard)}"
+        results = {"sent": 0, "checked_users": 0, "errors": []}
+        if dry_run:
+            results["would_send"] = 0
+        run = FanoutRun(f"{name}:{today}", dry_run=dry_run)
+        reports: List[Dict] = []
         
         try:
-            users_response = self.supabase.table('users').select(
-                'id, name, push_subscriptions, notification_preferences'
-            ).not_.is_('push_subscriptions', 'null').execute()
+            await run.load()
+            if run.completed:
+                results["skipped"] = "already sent today"
+                return self._report(results, run, reports, name)
             
-            for user in (users_response.data or []):
-                preferences = user.get('notification_preferences', {})
-                if not preferences.get('evening_reminder', True):
-                    continue
-                
-                user_id = user['id']
-                subscriptions = user.get('push_subscriptions', [])
-                
-                # Check incomplete habits
-                habits_response = self.supabase.table('habits').select('id').eq(
-                    'user_id', user_id
-                ).execute()
-                total_habits = len(habits_response.data or [])
-                
-                checkins_response = self.supabase.table('checkins').select('habit_id').eq(
-                    'user_id', user_id
-                ).eq('date', today).eq('completed', True).execute()
-                completed = len(checkins_response.data or [])
+            async for users in run.user_pages(
+                'id, name, push_subscriptions, notification_preferences',
+                shard=shard, subscribed=True
+            ):
+                results["checked_users"] += len(users)
+                pushes: List[PushMessage] = []
+                if users:
+                    user_ids = [user['id'] for user in users]
+                    
+                    # Habit and check-in counts for the whole page (keyset paged:
+                    # a page of users can have more rows than the max-rows cap)
+                    total_habits: Dict[int, int] = {}
+                    async for habit in iter_rows(
+                        'habits', {'user_id': user_ids}, columns='user_id', order_by=('id',)
+                    ):
+                        total_habits[habit['user_id']] = total_habits.get(habit['user_id'], 0) + 1
+                    
+                    completed: Dict[int, int] = {}
+                    async for checkin in iter_rows(
+                        'checkins', {'user_id': user_ids, 'date': today, 'completed': True},
+                        columns='user_id', order_by=('id',)
+                    ):
+                        completed[checkin['user_id']] = completed.get(checkin['user_id'], 0) + 1
                 
-                incomplete = total_habits - completed
+                for user in users:
+                    preferences = user.get('notification_preferences') or {}
+                    if not preferences.get('evening_reminder', True):
+                        continue
+                    
+                    user_id = user['id']
+                    subscriptions = user.get('push_subscriptions') or []
+                    incomplete = total_habits.get(user_id, 0) - completed.get(user_id, 0)
+                    
+                    if incomplete > 0:
+                        for subscription in subscriptions:
+                            pushes.append(self.push_service.notification_message(
+                                subscription=subscription,
+                                title="🌙 Evening Check-in",
+                                body=f"You have {incomplete} habit{'s' if incomplete > 1 else ''} left today. There's still time!",
+                                tag="evening-reminder",
+                                data={"type": "evening_reminder", "url": "/daily"},
+                                actions=[
+                                    {"action": "open", "title": "Complete Now"},
+                                    {"action": "dismiss", "title": "Dismiss"}
+                                ],
+                                urgency="normal"
+                            ))
                 
-                if incomplete > 0:
-                    for subscription in subscriptions:
-                        result = self.push_service.send_notification(
-                            subscription=subscription,
-                            title="🌙 Evening Check-in",
-                            body=f"You have {incomplete} habit{'s' if incomplete > 1 else ''} left today. There's still time!",
-                            tag="evening-reminder",
-                            data={"type": "evening_reminder", "url": "/daily"},
-                            actions=[
-                                {"action": "open", "title": "Complete Now"},
-                                {"action": "dismiss", "title": "Dismiss"}
-                            ],
-                            urgency="normal"
-                        )
-                        if result.get('success'):
-                            results["sent"] += 1
+                if dry_run:
+                    results["would_send"] += len(pushes)
+                    continue
+                reports.append(await self.push_service.dispatcher.dispatch(
+                    pushes, on_result=self._count_sent(results), name=name
+                ))
+                await run.checkpoint()
             
-            return results
+            await run.finish()
             
         except Exception as e:
             results["errors"].append(str(e))
-            return results
\ No newline at end of file
+        
+        return self._report(results, run, reports, name)
@@ -1,46 +1,397 @@
 # server/rate_limiter.py
+import os
 import time
-from typing import Dict, Tuple
+import asyncio
+import logging
+from collections import Counter
+from functools import lru_cache, wraps
+from typing import Dict, List, Optional, Tuple
 from fastapi import HTTPException, Request
-from functools import wraps
+from starlette.routing import Match
+from dotenv import load_dotenv
+from cache_tiers import redis_asyncio
 
-# In-memory rate limit storage (use Redis in production)
-_rate_limits: Dict[str, list] = {}
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO)
+
+RATE_LIMIT_SWEEP_INTERVAL = int(os.getenv("RATE_LIMIT_SWEEP_INTERVAL", "60"))
+ROUTE_TEMPLATE_CACHE_SIZE = 4096
+
+# Requests that match no route share one key, so scanners can't grow state
+UNMATCHED_ROUTE = "<unmatched>"
 
 
 class RateLimiter:
-    """Simple rate limiter"""
-    
-    def __init__(self, requests: int = 100, window: int = 60):
+    """
+    GCRA rate limiter: `requests` per `window` seconds with bursts of up to
+    `requests`. Each key holds one theoretical arrival time (TAT) plus a
+    rejection count; a key whose TAT has passed is indistinguishable from a
+    new key, so the sweeper drops it.
+    """
+
+    def __init__(self, requests: int = 100, window: int = 60, name: str = "default"):
         self.requests = requests
         self.window = window  # seconds
-    
+        self.name = name
+        self.interval = window / requests
+        self._state: Dict[str, List[float]] = {}  # key -> [tat, rejections]
+        self.allowed = 0
+        self.rejected = 0
+        self.evicted = 0
+        _limiters.append(self)
+
+    def check(self, key: str, now: Optional[float] = None) -> Tuple[bool, int, int]:
+        """
+        Count one request for `key`.
+        Returns (allowed, remaining, seconds until reset or retry)
+        """
+        now = time.monotonic() if now is None else now
+        state = self._state.get(key)
+        tat = max(state[0], now) if state else now
+        new_tat = tat + self.interval
+        allow_at = new_tat - self.window
+
+        if now < allow_at:
+            state[1] += 1
+            self.rejected += 1
+            return False, 0, max(1, int(allow_at - now + 0.999))
+
+        if state:
+            state[0] = new_tat
+            state[1] = 0
+        else:
+            self._state[key] = [new_tat, 0]
+        self.allowed += 1
+        remaining = int((self.window - (new_tat - now)) / self.interval)
+        return True, remaining, max(1, int(new_tat - now + 0.999))
+
     def is_allowed(self, key: str) -> Tuple[bool, int]:
-        """Check if request is allowed"""
-        now = time.time()
-        
-        if key not in _rate_limits:
-            _rate_limits[key] = []
-        
-        # Clean old entries
-        _rate_limits[key] = [t for t in _rate_limits[key] if now - t < self.window]
-        
-        if len(_rate_limits[key]) >= self.requests:
-            # Rate limited
-            oldest = _rate_limits[key][0]
-            retry_after = int(self.window - (now - oldest))
-            return False, retry_after
-        
-        # Allow request
-        _rate_limits[key].append(now)
-        remaining = self.requests - len(_rate_limits[key])
-        return True, remaining
+        """Returns (True, remaining) or (False, retry_after)"""
+        allowed, remaining, reset = self.check(key)
+        return (True, remaining) if allowed else (False, reset)
+
+    def rejections(self, key: str) -> int:
+        """Requests rejected for `key` since its last allowed one"""
+        state = self._state.get(key)
+        return int(state[1]) if state else 0
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        """Drop keys whose bucket has fully refilled"""
+        now = time.monotonic() if now is None else now
+        idle = [key for key, (tat, _) in self._state.items() if tat <= now]
+        for key in idle:
+            del self._state[key]
+        self.evicted += len(idle)
+        return len(idle)
+
+    def get_stats(self) -> Dict:
+        return {
+            "limit": self.requests,
+            "window": self.window,
+            "tracked_keys": len(self._state),
+            "allowed": self.allowed,
+            "rejected": self.rejected,
+            "evicted": self.evicted
+        }
+
+
+# Every limiter, for the background sweeper
+_limiters: List[RateLimiter] = []
+_sweeper: Optional[asyncio.Task] = None
+
+
+def sweep_all() -> int:
+    """Evict idle keys from every limiter and lift expired IP blocks"""
+    rate_limiter.sweep()
+    return sum(limiter.sweep() for limiter in _limiters)
+
+
+async def _sweep_forever(interval: int):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            evicted = sweep_all()
+            if evicted:
+                logging.debug(f"Rate limiter evicted {evicted} idle keys")
+        except Exception as e:
+            logging.error(f"Error sweeping rate limiter keys: {str(e)}")
+
+
+def start_sweeper(interval: int = RATE_LIMIT_SWEEP_INTERVAL):
+    """Expire idle keys in the background (call from app startup)"""
+    global _sweeper
+    if _sweeper is None:
+        _sweeper = asyncio.create_task(_sweep_forever(interval))
+
+
+async def stop_sweeper():
+    global _sweeper
+    if _sweeper is not None:
+        _sweeper.cancel()
+        try:
+            await _sweeper
+        except asyncio.CancelledError:
+            pass
+        _sweeper = None
+
+
+@lru_cache(maxsize=ROUTE_TEMPLATE_CACHE_SIZE)
+def route_template(app, path: str) -> str:
+    """Route path for a raw path, e.g. /checkins/2025-01-01 -> /checkins/{date}"""
+    scope = {"type": "http", "path": path, "method": "GET"}
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match != Match.NONE:
+            return route.path
+    return UNMATCHED_ROUTE
+
+
+def request_route(request: Request) -> str:
+    """Template of the route serving `request` (resolved once routed)"""
+    route = request.scope.get("route")
+    if route is not None:
+        return route.path
+    return route_template(request.app, request.url.path)
+
+
+# ============================================
+# STATE BACKENDS
+# ============================================
+# Where RateLimitMiddleware keeps its counters and blocks:
+#   RATE_LIMIT_STORE_URL=                     -> this process only (default)
+#   RATE_LIMIT_STORE_URL=redis://host:6379/1  -> shared by every worker / replica
+#   RATE_LIMIT_STORE_URL=local://             -> in-process stand-in for the shared store
+RATE_LIMIT_STORE_URL = os.getenv("RATE_LIMIT_STORE_URL", "")
+RATE_LIMIT_STORE_PREFIX = os.getenv("RATE_LIMIT_STORE_PREFIX", "sankalp:ratelimit")
+RATE_LIMIT_STORE_TIMEOUT = float(os.getenv("RATE_LIMIT_STORE_TIMEOUT", "0.1"))
+RATE_LIMIT_BLOCK_SECONDS = 15 * 60
+
+
+class LocalRateLimitBackend:
+    """
+    In-process GCRA counters and client blocks. Stand-in for the shared
+    store in tests and single-worker setups, and the fallback whenever the
+    shared store is unreachable.
+    """
+
+    name = "local"
+
+    def __init__(self):
+        self._limiters: Dict[Tuple[int, int], RateLimiter] = {}
+        self.blocked: Dict[str, float] = {}
+
+    def _limiter(self, requests: int, window: int) -> RateLimiter:
+        limiter = self._limiters.get((requests, window))
+        if limiter is None:
+            limiter = RateLimiter(requests, window, name=f"{requests}/{window}s")
+            self._limiters[(requests, window)] = limiter
+        return limiter
+
+    async def hit(
+        self, key: str, client: str, requests: int, window: int, block_seconds: int
+    ) -> Tuple[bool, int, int, bool]:
+        """Returns (allowed, remaining, seconds until reset or retry, client blocked)"""
+        now = time.monotonic()
+        until = self.blocked.get(client)
+        if until is not None:
+            if now < until:
+                return False, 0, max(1, int(until - now + 0.999)), True
+            del self.blocked[client]
+
+        limiter = self._limiter(requests, window)
+        allowed, remaining, reset_time = limiter.check(key, now)
 
+        # Abuse: kept hammering through a whole window of rejections
+        if not allowed and limiter.rejections(key) > requests:
+            self.blocked[client] = now + block_seconds
+            return False, 0, block_seconds, True
+
+        return allowed, remaining, reset_time, False
+
+    def sweep(self) -> int:
+        """Lift expired blocks (idle keys are swept with every RateLimiter)"""
+        now = time.monotonic()
+        expired = [client for client, until in self.blocked.items() if until <= now]
+        for client in expired:
+            del self.blocked[client]
+        return len(expired)
+
+    def get_stats(self) -> Dict:
+        return {
+            "tracked_keys": sum(len(l._state) for l in self._limiters.values()),
+            "blocked_clients": len(self.blocked),
+            "limits": {l.name: l.get_stats() for l in self._limiters.values()}
+        }
+
+    async def close(self):
+        pass
+
+
+# Same contract as LocalRateLimitBackend.hit, atomically on the server.
+# The server clock is used so replicas agree on time (Redis >= 5).
+# KEYS[1] = limiter hash {tat, rej}, KEYS[2] = client block flag
+# ARGV    = interval_ms, window_ms, limit, block_ms
+GCRA_SCRIPT = """
+local blocked_ms = redis.call('PTTL', KEYS[2])
+if blocked_ms > 0 then
+    return {0, 0, blocked_ms, 1}
+end
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local interval = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local tat = tonumber(redis.call('HGET', KEYS[1], 'tat')) or now
+if tat < now then
+    tat = now
+end
+local new_tat = tat + interval
+if now < new_tat - window then
+    local rejections = redis.call('HINCRBY', KEYS[1], 'rej', 1)
+    if rejections > tonumber(ARGV[3]) then
+        redis.call('SET', KEYS[2], 1, 'PX', ARGV[4])
+        return {0, 0, tonumber(ARGV[4]), 1}
+    end
+    return {0, 0, new_tat - window - now, 0}
+end
+redis.call('HSET', KEYS[1], 'tat', new_tat, 'rej', 0)
+redis.call('PEXPIRE', KEYS[1], new_tat - now)
+return {1, math.floor((window - (new_tat - now)) / interval), new_tat - now, 0}
+"""
+
+
+class RedisRateLimitBackend:
+    """GCRA state on any server speaking the Redis protocol, one script call per request"""
+
+    name = "redis"
+
+    def __init__(self, url: str, prefix: str = RATE_LIMIT_STORE_PREFIX):
+        self.client = redis_asyncio.from_url(url)
+        self.prefix = prefix
+        self.script = self.client.register_script(GCRA_SCRIPT)
+
+    async def hit(
+        self, key: str, client: str, requests: int, window: int, block_seconds: int
+    ) -> Tuple[bool, int, int, bool]:
+        allowed, remaining, reset_ms, blocked = await self.script(
+            keys=[f"{self.prefix}:{key}", f"{self.prefix}:block:{client}"],
+            args=[int(window * 1000 / requests), window * 1000, requests, block_seconds * 1000]
+        )
+        return bool(allowed), int(remaining), max(1, int((int(reset_ms) + 999) / 1000)), bool(blocked)
+
+    async def close(self):
+        await self.client.close()
+
+
+def rate_limit_backend_from_url(url: str):
+    """
+    Build the backend for RATE_LIMIT_STORE_URL (None = in-process). A
+    store that is configured but can't be used refuses to start: limiting
+    per worker would silently multiply every limit by the worker count.
+    """
+    if not url or url.startswith("local://"):
+        return None
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        if redis_asyncio is None:
+            raise RuntimeError("RATE_LIMIT_STORE_URL is set but redis is not installed (pip install 'redis>=4.2')")
+        return RedisRateLimitBackend(url)
+    raise RuntimeError(f"Unsupported RATE_LIMIT_STORE_URL scheme: {url.split('://')[0]}")
+
+
+# ============================================
+# ENDPOINT LIMITS (used by RateLimitMiddleware)
+# ============================================
+
+class EndpointRateLimiter:
+    """Per-client limits by route template, with temporary blocks for abuse"""
+
+    def __init__(self, backend=None):
+        self.local = LocalRateLimitBackend()
+        self.backend = backend or self.local
+        self.allowed = 0
+        self.rejected = 0
+        self.blocked = 0
+        self.fallbacks = 0
+        self.rejected_by_route: Counter = Counter()
+        self._fallback_logged_at = 0.0
+
+        # Default limits (requests, window)
+        self.default_limit = (100, 60)
+
+        # Endpoint-specific limits (matched against the route template)
+        self.endpoint_limits = {
+            "/auth/": (10, 60),
+            "/ai/": (20, 60),
+            "/push/": (30, 60),
+            "/checkins": (60, 60),
+        }
+
+    def _get_limit_for_path(self, path: str) -> Tuple[int, int]:
+        for prefix, limit in self.endpoint_limits.items():
+            if path.startswith(prefix):
+                return limit
+        return self.default_limit
+
+    async def check_rate_limit(self, client: str, route: str) -> tuple:
+        """
+        Check if a client's request is within rate limit.
+        Returns (allowed: bool, remaining: int, reset_time: int)
+        """
+        requests, window = self._get_limit_for_path(route)
+        args = (f"{client}:{route}", client, requests, window, RATE_LIMIT_BLOCK_SECONDS)
+
+        if self.backend is self.local:
+            result = await self.local.hit(*args)
+        else:
+            try:
+                result = await asyncio.wait_for(self.backend.hit(*args), RATE_LIMIT_STORE_TIMEOUT)
+            except Exception as e:
+                # Store down or slow: limit per worker rather than not at all
+                self.fallbacks += 1
+                now = time.monotonic()
+                if now - self._fallback_logged_at > 60:
+                    self._fallback_logged_at = now
+                    logging.warning(f"Rate limit store unavailable, limiting locally: {str(e)}")
+                result = await self.local.hit(*args)
+
+        allowed, remaining, reset_time, blocked = result
+        if allowed:
+            self.allowed += 1
+        else:
+            self.rejected += 1
+            self.rejected_by_route[route] += 1
+            if blocked:
+                self.blocked += 1
+
+        return allowed, remaining, reset_time
+
+    def sweep(self) -> int:
+        return self.local.sweep()
+
+    async def close(self):
+        if self.backend is not self.local:
+            await self.backend.close()
+
+    def get_stats(self) -> Dict:
+        return {
+            "backend": self.backend.name,
+            "allowed": self.allowed,
+            "rejected": self.rejected,
+            "rejected_while_blocked": self.blocked,
+            "fallbacks": self.fallbacks,
+            "local": self.local.get_stats(),
+            "top_rejected_routes": dict(self.rejected_by_route.most_common(10)),
+            "route_templates_cached": route_template.cache_info().currsize
+        }
+
+
+# Global rate limiter instance (RateLimitMiddleware)
+rate_limiter = EndpointRateLimiter(rate_limit_backend_from_url(RATE_LIMIT_STORE_URL))
 
 # Rate limiters for different endpoints
-default_limiter = RateLimiter(requests=100, window=60)
-auth_limiter = RateLimiter(requests=10, window=60)
-ai_limiter = RateLimiter(requests=20, window=60)
+default_limiter = RateLimiter(requests=100, window=60, name="decorator_default")
+auth_limiter = RateLimiter(requests=10, window=60, name="decorator_auth")
+ai_limiter = RateLimiter(requests=20, window=60, name="decorator_ai")
 
 
 def rate_limit(limiter: RateLimiter = default_limiter):
@@ -55,21 +406,21 @@ def rate_limit(limiter: RateLimiter = default_limiter):
                     if isinstance(arg, Request):
                         request = arg
                         break
-            
+
             if request:
-                # Use IP + endpoint as key
+                # Use IP + route template as key
                 client_ip = request.client.host if request.client else "unknown"
-                key = f"{client_ip}:{request.url.path}"
-                
+                key = f"{client_ip}:{request_route(request)}"
+
                 allowed, value = limiter.is_allowed(key)
-                
+
                 if not allowed:
                     raise HTTPException(
                         status_code=429,
                         detail=f"Rate limit exceeded. Retry after {value} seconds.",
                         headers={"Retry-After": str(value)}
                     )
-            
+
             return await func(*args, **kwargs)
         return wrapper
-    return decorator
\ No newline at end of file
+    return decorator
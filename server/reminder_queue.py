@@ -0,0 +1,261 @@
+# server/reminder_queue.py
+import os
+import time
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+from dotenv import load_dotenv
+from cache_engine import cache_engine
+from cache_tiers import tiered_cache
+from database import supabase, iter_rows
+
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO)
+
+# A tick that runs late still fires the minutes it skipped, up to this many
+# (the reminder cron runs every 5-10 minutes)
+REMINDER_MAX_CATCHUP_MINUTES = int(os.getenv("REMINDER_MAX_CATCHUP_MINUTES", "15"))
+
+# Without a shared cache tier (CACHE_L2_URL unset) habit writes served by
+# other workers are never broadcast, so the index is rebuilt this often
+REMINDER_REBUILD_SECONDS = int(os.getenv("REMINDER_REBUILD_SECONDS", "300"))
+
+MINUTES_PER_DAY = 24 * 60
+
+# Reminder kind -> minutes after the habit's time it fires. A fire time past
+# midnight is dropped: habits only count as overdue on their own day.
+REMINDER_OFFSETS = {
+    "habit": 0,           # push: "Time for: ..."
+    "email": 30,          # email digest of incomplete habits
+    "streak_alert": 120,  # push: streak at risk
+}
+
+HABIT_COLUMNS = "id, user_id, name, time"
+
+# (day "YYYY-MM-DD", kind, habit row)
+DueReminder = Tuple[str, str, Dict[str, Any]]
+
+
+def minute_of_day(time_str: Optional[str]) -> Optional[int]:
+    """'07:30' / '07:30:00' -> 450; None for a missing or malformed time"""
+    try:
+        hour, minute = time_str.split(":")[:2]
+        value = int(hour) * 60 + int(minute)
+    except (AttributeError, ValueError):
+        return None
+    return value if 0 <= value < MINUTES_PER_DAY else None
+
+
+class ReminderQueue:
+    """
+    Time-bucketed index of habit reminders: minute of day -> the
+    (kind, habit id) pairs firing then. A tick reads only the buckets
+    between its consumer's cursor and now, instead of scanning every
+    user's habits.
+
+    Built from the habits table on first use and kept current from table
+    change events: `notify_write('habits', user_id)` here or in another
+    worker marks that user for a reload (one query per refresh covers
+    every marked user), and an unscoped change or a missed broadcast
+    triggers a full rebuild. Other workers' writes only arrive through
+    the L2 tier; without one, the index is rebuilt every
+    REMINDER_REBUILD_SECONDS instead.
+    """
+
+    def __init__(self):
+        self._buckets: Dict[int, Set[Tuple[str, int]]] = defaultdict(set)
+        self._habits: Dict[int, Dict[str, Any]] = {}
+        self._by_user: Dict[int, Set[int]] = defaultdict(set)
+        self._cursors: Dict[str, datetime] = {}
+        self._dirty_users: Set[int] = set()
+        self._stale = True  # needs a full rebuild
+        self._lock = asyncio.Lock()
+        self._rebuilds = 0
+        self._built_at = 0.0
+        self._reloads = 0
+        self._fired: Dict[str, int] = defaultdict(int)
+        self._warmup: Optional[asyncio.Task] = None
+        cache_engine.add_invalidation_listener(self._on_change)
+        tiered_cache.add_remote_invalidation_listener(self._on_change)
+
+    # ---------- index maintenance ----------
+
+    def _add(self, habit: Dict[str, Any]) -> None:
+        minute = minute_of_day(habit.get("time"))
+        if minute is None:
+            return
+        entry = {key: habit.get(key) for key in ("id", "user_id", "name", "time")}
+        self._habits[habit["id"]] = entry
+        self._by_user[habit["user_id"]].add(habit["id"])
+        for kind, offset in REMINDER_OFFSETS.items():
+            if minute + offset < MINUTES_PER_DAY:
+                self._buckets[minute + offset].add((kind, habit["id"]))
+
+    def _remove(self, habit_id: int) -> None:
+        habit = self._habits.pop(habit_id, None)
+        if habit is None:
+            return
+        self._by_user[habit["user_id"]].discard(habit_id)
+        minute = minute_of_day(habit["time"])
+        for kind, offset in REMINDER_OFFSETS.items():
+            bucket = self._buckets.get(minute + offset)
+            if bucket is not None:
+                bucket.discard((kind, habit_id))
+                if not bucket:
+                    del self._buckets[minute + offset]
+
+    def replace_user(self, user_id: int, habits: Iterable[Dict[str, Any]]) -> None:
+        for habit_id in list(self._by_user.pop(user_id, ())):
+            self._remove(habit_id)
+        for habit in habits:
+            self._add(habit)
+
+    def _on_change(self, tags: tuple) -> None:
+        """Invalidation hook (this worker's writes and other workers')"""
+        for tag in tags:
+            if tag in ("*", "table:habits"):
+                self._stale = True
+            elif tag.startswith("table:habits:user:"):
+                try:
+                    self._dirty_users.add(int(tag.rsplit(":", 1)[1]))
+                except ValueError:
+                    pass
+
+    async def rebuild(self) -> None:
+        """Re-read every habit (keyset paged)"""
+        self._stale = False
+        self._dirty_users.clear()
+        buckets, habits, by_user = self._buckets, self._habits, self._by_user
+        self._buckets, self._habits, self._by_user = defaultdict(set), {}, defaultdict(set)
+        try:
+            async for habit in iter_rows("habits", columns=HABIT_COLUMNS, order_by=("id",)):
+                self._add(habit)
+        except Exception:
+            self._buckets, self._habits, self._by_user = buckets, habits, by_user
+            self._stale = True
+            raise
+        self._rebuilds += 1
+        self._built_at = time.monotonic()
+        logging.info(f"⏰ Reminder index rebuilt: {len(self._habits)} habits in {len(self._buckets)} minute buckets")
+
+    async def refresh(self) -> None:
+        """Apply pending habit changes (call before reading due reminders)"""
+        async with self._lock:
+            if tiered_cache.l2 is None and time.monotonic() - self._built_at >= REMINDER_REBUILD_SECONDS:
+                self._stale = True
+            if self._stale:
+                await self.rebuild()
+                return
+            if not self._dirty_users:
+                return
+
+            user_ids = sorted(self._dirty_users)
+            self._dirty_users.clear()
+            try:
+                response = await supabase.table("habits").select(HABIT_COLUMNS).in_(
+                    "user_id", user_ids
+                ).execute()
+            except Exception:
+                self._dirty_users.update(user_ids)
+                raise
+            rows_by_user: Dict[int, list] = defaultdict(list)
+            for habit in response.data or []:
+                rows_by_user[habit["user_id"]].append(habit)
+            for user_id in user_ids:
+                self.replace_user(user_id, rows_by_user.get(user_id, ()))
+            self._reloads += 1
+
+    # ---------- lifecycle ----------
+
+    async def _warm(self) -> None:
+        try:
+            await self.refresh()
+        except Exception as e:
+            logging.error(f"Error building reminder index: {str(e)}")
+
+    def start(self) -> None:
+        """Build the index in the background (call from app startup)"""
+        if self._warmup is None:
+            self._warmup = asyncio.create_task(self._warm())
+
+    async def stop(self) -> None:
+        if self._warmup is not None:
+            self._warmup.cancel()
+            try:
+                await self._warmup
+            except asyncio.CancelledError:
+                pass
+            self._warmup = None
+
+    # ---------- reading ----------
+
+    def claim_window(
+        self,
+        consumer: str,
+        now: Optional[datetime] = None,
+        peek: bool = False
+    ) -> Tuple[datetime, datetime]:
+        """
+        The minutes [start, end] `consumer` hasn't read yet, moving its
+        cursor to the end (unless `peek`). A consumer's first window is
+        the current minute only.
+        """
+        now = (now or datetime.now()).replace(second=0, microsecond=0)
+        earliest = now - timedelta(minutes=REMINDER_MAX_CATCHUP_MINUTES - 1)
+        cursor = self._cursors.get(consumer)
+        start = now if cursor is None else max(cursor + timedelta(minutes=1), earliest)
+        if not peek:
+            self._cursors[consumer] = now
+        return start, now
+
+    def commit_window(self, consumer: str, end: datetime) -> None:
+        """Move `consumer`'s cursor past a window claimed with `peek` once it was handled"""
+        end = end.replace(second=0, microsecond=0)
+        cursor = self._cursors.get(consumer)
+        if cursor is None or end > cursor:
+            self._cursors[consumer] = end
+
+    def resume_cursor(self, consumer: str, moment: datetime) -> None:
+        """Seed a consumer's cursor (e.g. from a checkpoint) if this process has none yet"""
+        if consumer not in self._cursors:
+            self._cursors[consumer] = moment.replace(second=0, microsecond=0)
+
+    def due_between(self, start: datetime, end: datetime, kinds: Iterable[str]) -> List[DueReminder]:
+        """Reminders of `kinds` firing in the minutes [start, end]"""
+        kinds = set(kinds)
+        due: List[DueReminder] = []
+        moment = start
+        while moment <= end:
+            day = moment.strftime("%Y-%m-%d")
+            for kind, habit_id in self._buckets.get(moment.hour * 60 + moment.minute, ()):
+                if kind in kinds:
+                    due.append((day, kind, self._habits[habit_id]))
+            moment += timedelta(minutes=1)
+        return due
+
+    def count_fired(self, due: List[DueReminder]) -> None:
+        for _, kind, _ in due:
+            self._fired[kind] += 1
+
+    def user_habits(self, user_id: int) -> List[Dict[str, Any]]:
+        """Indexed habits of one user"""
+        return [self._habits[habit_id] for habit_id in self._by_user.get(user_id, ())]
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "habits": len(self._habits),
+            "buckets": len(self._buckets),
+            "stale": self._stale,
+            "pending_users": len(self._dirty_users),
+            "rebuilds": self._rebuilds,
+            "user_reloads": self._reloads,
+            "fired": dict(self._fired),
+            "cursors": {consumer: cursor.isoformat() for consumer, cursor in self._cursors.items()}
+        }
+
+
+# Singleton instance shared by the push and email reminder ticks
+reminder_queue = ReminderQueue()
@@ -0,0 +1,47 @@
+# server/responses.py
+import json
+from functools import wraps
+from typing import Any, Callable
+from fastapi.responses import JSONResponse
+from starlette.responses import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(content: Any) -> bytes:
+    """
+    One-pass JSON encoding of our own dicts/lists: orjson when installed,
+    compact stdlib json otherwise. Int dict keys become strings and
+    dates/datetimes ISO strings, like the default FastAPI path.
+    """
+    if orjson is not None:
+        return orjson.dumps(content, default=str, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(
+        content, default=str, ensure_ascii=False, separators=(",", ":")
+    ).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse without the jsonable_encoder walk (see `dumps`)"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def fast_json(func: Callable):
+    """
+    Return the route's result as a FastJSONResponse. FastAPI passes a
+    Response through untouched, so the payload we built is neither
+    re-validated against a response_model nor walked by jsonable_encoder.
+    Goes above @cached_route so the cache keeps plain data.
+    """
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        result = await func(*args, **kwargs)
+        if isinstance(result, Response):
+            return result
+        return FastJSONResponse(result)
+    return wrapper
@@ -1,12 +1,16 @@
 # server/smart_notifications.py
 import os
+import asyncio
 import logging
-from datetime import datetime, date, timedelta
+from collections import defaultdict
+from datetime import datetime, timedelta
 from typing import List, Dict, Any, Optional
 from dotenv import load_dotenv
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+from reminder_queue import reminder_queue
+from database import iter_rows
 
 load_dotenv()
 
@@ -18,6 +22,10 @@ SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
 SMTP_EMAIL = os.getenv("SMTP_EMAIL")
 SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
 
+# Due users looked up per query by the reminder tick (keeps each read under
+# the PostgREST max-rows cap)
+REMINDER_USER_BATCH = 200
+
 
 def send_reminder_email(to_email: str, user_name: str, incomplete_habits: List[Dict]) -> bool:
     """Send reminder email for incomplete habits"""
@@ -87,57 +95,77 @@ def send_reminder_email(to_email: str, user_name: str, incomplete_habits: List[D
 
 
 async def check_and_send_reminders(supabase) -> Dict[str, Any]:
-    """Check all users and send reminders for incomplete habits"""
+    """
+    Email users whose habits went 30 minutes past their time without a
+    check-in (at most one email per user per day). Only users with a
+    habit due since the last check are looked at. The window is only
+    marked as read once every batch went out, so a failed tick is retried
+    by the next one (the notifications keys keep that from re-sending).
+    """
     try:
-        today = date.today().strftime('%Y-%m-%d')
-        current_time = datetime.now().strftime('%H:%M')
+        await reminder_queue.refresh()
+        start, end = reminder_queue.claim_window("email", peek=True)
+        due = reminder_queue.due_between(start, end, ("email",))
+        reminders_sent = 0
         
-        # Get all users with notification preferences
-        users_response = supabase.table('users').select('*').execute()
-        users = users_response.data or []
+        user_ids = sorted({habit['user_id'] for _, _, habit in due})
+        days = sorted({day for day, _, _ in due})
+        if not user_ids:
+            reminder_queue.commit_window("email", end)
+            return {
+                "success": True,
+                "reminders_sent": 0,
+                "checked_at": datetime.now().isoformat()
+            }
         
-        reminders_sent = 0
+        due_days = defaultdict(set)
+        for day, _, habit in due:
+            due_days[habit['user_id']].add(day)
         
-        for user in users:
-            # Check if user wants notifications
-            if not user.get('email_notifications', True):
-                continue
-            
-            # Get user's habits
-            habits_response = supabase.table('habits').select('*').eq('user_id', user['id']).execute()
-            habits = habits_response.data or []
+        checked_users = 0
+        for i in range(0, len(user_ids), REMINDER_USER_BATCH):
+            batch = user_ids[i:i + REMINDER_USER_BATCH]
             
-            if not habits:
-                continue
+            users_response = await supabase.table('users').select('*').in_('id', batch).execute()
+            users = users_response.data or []
+            checked_users += len(users)
             
-            # Get today's checkins
-            checkins_response = supabase.table('checkins').select('*').eq(
-                'user_id', user['id']
-            ).eq('date', today).execute()
+            # Keyset paged: the batch's check-ins can exceed the max-rows cap
+            completed = {
+                (str(c['date']), c['habit_id']) async for c in iter_rows(
+                    'checkins', {'user_id': batch, 'date': days, 'completed': True},
+                    columns='habit_id, date'
+                )
+            }
             
-            completed_habit_ids = set(
-                c['habit_id'] for c in (checkins_response.data or []) if c['completed']
-            )
+            reminder_keys = [f"reminder_{user_id}_{day}" for user_id in batch for day in days]
+            sent_response = await supabase.table('notifications').select('key').in_(
+                'key', reminder_keys
+            ).execute()
+            already_sent = {row['key'] for row in (sent_response.data or [])}
             
-            # Find incomplete habits whose time has passed
-            incomplete_habits = []
-            for habit in habits:
-                if habit['id'] not in completed_habit_ids:
-                    habit_time = habit.get('time', '09:00')
-                    # Check if habit time has passed (with 30 min buffer)
-                    if is_time_passed(habit_time, buffer_minutes=30):
-                        incomplete_habits.append(habit)
-            
-            # Send reminder if there are incomplete habits
-            if incomplete_habits:
-                # Check if we already sent a reminder today
-                reminder_key = f"reminder_{user['id']}_{today}"
-                last_reminder = supabase.table('notifications').select('*').eq(
-                    'key', reminder_key
-                ).execute()
+            for user in users:
+                # Check if user wants notifications
+                if not user.get('email_notifications', True):
+                    continue
                 
-                if not last_reminder.data:
-                    success = send_reminder_email(
+                for day in sorted(due_days[user['id']]):
+                    reminder_key = f"reminder_{user['id']}_{day}"
+                    if reminder_key in already_sent:
+                        continue
+                    
+                    # Every incomplete habit of that day whose time has passed (with 30 min buffer)
+                    incomplete_habits = [
+                        habit for habit in reminder_queue.user_habits(user['id'])
+                        if (day, habit['id']) not in completed
+                        and is_time_passed(habit['time'], buffer_minutes=30)
+                    ]
+                    if not incomplete_habits:
+                        continue
+                    
+                    # smtplib blocks; keep it off the event loop
+                    success = await asyncio.to_thread(
+                        send_reminder_email,
                         to_email=user['email'],
                         user_name=user.get('name', 'Champion'),
                         incomplete_habits=incomplete_habits
@@ -145,17 +173,21 @@ async def check_and_send_reminders(supabase) -> Dict[str, Any]:
                     
                     if success:
                         # Record that we sent a reminder
-                        supabase.table('notifications').insert({
+                        await supabase.table('notifications').insert({
                             'key': reminder_key,
                             'user_id': user['id'],
                             'type': 'habit_reminder',
                             'sent_at': datetime.now().isoformat()
                         }).execute()
+                        already_sent.add(reminder_key)
                         reminders_sent += 1
         
+        reminder_queue.commit_window("email", end)
+        reminder_queue.count_fired(due)
         return {
             "success": True,
             "reminders_sent": reminders_sent,
+            "checked_users": checked_users,
             "checked_at": datetime.now().isoformat()
         }
         
@@ -11,11 +11,11 @@ class FriendshipManager:
     """Manage friendships and accountability partners"""
     
     @staticmethod
-    def send_friend_request(from_user_id: int, to_email: str) -> Dict[str, Any]:
+    async def send_friend_request(from_user_id: int, to_email: str) -> Dict[str, Any]:
         """Send a friend request"""
         try:
             # Find target user
-            target = supabase.table('users').select('id, name, email').eq(
+            target = await supabase.table('users').select('id, name, email').eq(
                 'email', to_email
             ).single().execute()
             
@@ -26,7 +26,7 @@ class FriendshipManager:
                 return {'success': False, 'error': 'Cannot add yourself'}
             
             # Check if already friends or pending
-            existing = supabase.table('friendships').select('*').or_(
+            existing = await supabase.table('friendships').select('*').or_(
                 f"and(user1_id.eq.{from_user_id},user2_id.eq.{target.data['id']})",
                 f"and(user1_id.eq.{target.data['id']},user2_id.eq.{from_user_id})"
             ).execute()
@@ -39,7 +39,7 @@ class FriendshipManager:
                     return {'success': False, 'error': 'Request already pending'}
             
             # Create friend request
-            supabase.table('friendships').insert({
+            await supabase.table('friendships').insert({
                 'user1_id': from_user_id,
                 'user2_id': target.data['id'],
                 'status': 'pending',
@@ -48,7 +48,7 @@ class FriendshipManager:
             
             # Create notification
             from notifications import NotificationManager
-            NotificationManager.create_in_app_notification(
+            await NotificationManager.create_in_app_notification(
                 user_id=target.data['id'],
                 notification_type='friend_request',
                 title='👥 New Friend Request',
@@ -63,10 +63,10 @@ class FriendshipManager:
             return {'success': False, 'error': str(e)}
     
     @staticmethod
-    def respond_to_request(friendship_id: int, user_id: int, accept: bool) -> Dict[str, Any]:
+    async def respond_to_request(friendship_id: int, user_id: int, accept: bool) -> Dict[str, Any]:
         """Accept or reject friend request"""
         try:
-            friendship = supabase.table('friendships').select('*').eq(
+            friendship = await supabase.table('friendships').select('*').eq(
                 'id', friendship_id
             ).eq('user2_id', user_id).eq('status', 'pending').single().execute()
             
@@ -75,7 +75,7 @@ class FriendshipManager:
             
             new_status = 'accepted' if accept else 'rejected'
             
-            supabase.table('friendships').update({
+            await supabase.table('friendships').update({
                 'status': new_status,
                 'responded_at': datetime.now().isoformat()
             }).eq('id', friendship_id).execute()
@@ -83,7 +83,7 @@ class FriendshipManager:
             if accept:
                 # Notify the requester
                 from notifications import NotificationManager
-                NotificationManager.create_in_app_notification(
+                await NotificationManager.create_in_app_notification(
                     user_id=friendship.data['user1_id'],
                     notification_type='friend_accepted',
                     title='🎉 Friend Request Accepted',
@@ -98,10 +98,10 @@ class FriendshipManager:
             return {'success': False, 'error': str(e)}
     
     @staticmethod
-    def get_friends(user_id: int) -> List[Dict[str, Any]]:
+    async def get_friends(user_id: int) -> List[Dict[str, Any]]:
         """Get user's friends with their stats"""
         try:
-            friendships = supabase.table('friendships').select('*').eq(
+            friendships = await supabase.table('friendships').select('*').eq(
                 'status', 'accepted'
             ).or_(
                 f"user1_id.eq.{user_id}",
@@ -113,13 +113,13 @@ class FriendshipManager:
                 friend_id = f['user2_id'] if f['user1_id'] == user_id else f['user1_id']
                 
                 # Get friend info
-                friend = supabase.table('users').select(
+                friend = await supabase.table('users').select(
                     'id, name, email, total_xp'
                 ).eq('id', friend_id).single().execute()
                 
                 if friend.data:
                     # Get their streak
-                    streaks = supabase.table('habit_streaks').select(
+                    streaks = await supabase.table('habit_streaks').select(
                         'current_streak'
                     ).eq('user_id', friend_id).execute()
                     
@@ -127,8 +127,8 @@ class FriendshipManager:
                     
                     # Get today's progress
                     today = date.today().strftime('%Y-%m-%d')
-                    habits = supabase.table('habits').select('id').eq('user_id', friend_id).execute()
-                    checkins = supabase.table('checkins').select('*').eq(
+                    habits = await supabase.table('habits').select('id').eq('user_id', friend_id).execute()
+                    checkins = await supabase.table('checkins').select('*').eq(
                         'user_id', friend_id
                     ).eq('date', today).eq('completed', True).execute()
                     
@@ -149,10 +149,10 @@ class FriendshipManager:
             return []
     
     @staticmethod
-    def get_pending_requests(user_id: int) -> List[Dict[str, Any]]:
+    async def get_pending_requests(user_id: int) -> List[Dict[str, Any]]:
         """Get pending friend requests"""
         try:
-            requests = supabase.table('friendships').select(
+            requests = await supabase.table('friendships').select(
                 '*, users!friendships_user1_id_fkey(name, email)'
             ).eq('user2_id', user_id).eq('status', 'pending').execute()
             
@@ -166,7 +166,7 @@ class AccountabilityChallenge:
     """Create challenges between friends"""
     
     @staticmethod
-    def create_challenge(
+    async def create_challenge(
         creator_id: int,
         friend_id: int,
         habit_name: str,
@@ -176,7 +176,7 @@ class AccountabilityChallenge:
         """Create a challenge between friends"""
         try:
             # Verify friendship
-            friendship = supabase.table('friendships').select('*').eq(
+            friendship = await supabase.table('friendships').select('*').eq(
                 'status', 'accepted'
             ).or_(
                 f"and(user1_id.eq.{creator_id},user2_id.eq.{friend_id})",
@@ -189,7 +189,7 @@ class AccountabilityChallenge:
             start_date = date.today()
             end_date = start_date + timedelta(days=duration_days)
             
-            challenge = supabase.table('challenges').insert({
+            challenge = await supabase.table('challenges').insert({
                 'creator_id': creator_id,
                 'participant_id': friend_id,
                 'habit_name': habit_name,
@@ -204,7 +204,7 @@ class AccountabilityChallenge:
             
             # Notify friend
             from notifications import NotificationManager
-            NotificationManager.create_in_app_notification(
+            await NotificationManager.create_in_app_notification(
                 user_id=friend_id,
                 notification_type='challenge_invite',
                 title='⚔️ Challenge Received!',
@@ -219,10 +219,10 @@ class AccountabilityChallenge:
             return {'success': False, 'error': str(e)}
     
     @staticmethod
-    def update_challenge_progress(challenge_id: int, user_id: int):
+    async def update_challenge_progress(challenge_id: int, user_id: int):
         """Update progress for a challenge"""
         try:
-            challenge = supabase.table('challenges').select('*').eq(
+            challenge = await supabase.table('challenges').select('*').eq(
                 'id', challenge_id
             ).single().execute()
             
@@ -234,7 +234,7 @@ class AccountabilityChallenge:
             
             new_progress = challenge.data[field] + 1
             
-            supabase.table('challenges').update({
+            await supabase.table('challenges').update({
                 field: new_progress
             }).eq('id', challenge_id).execute()
             
@@ -247,13 +247,13 @@ class AccountabilityChallenge:
                 # This user completed the challenge
                 loser_id = challenge.data['participant_id'] if is_creator else challenge.data['creator_id']
                 
-                supabase.table('challenges').update({
+                await supabase.table('challenges').update({
                     'status': 'completed',
                     'winner_id': user_id
                 }).eq('id', challenge_id).execute()
                 
                 # Award XP
-                supabase.rpc('add_user_xp', {'user_id': user_id, 'xp': 500}).execute()
+                await supabase.rpc('add_user_xp', {'user_id': user_id, 'xp': 500}).execute()
                 
         except Exception as e:
             logging.error(f"Error updating challenge: {str(e)}")
\ No newline at end of file
@@ -0,0 +1,382 @@
+# server/streak_engine.py
+import sys
+import asyncio
+import logging
+from dataclasses import dataclass
+from datetime import datetime, date, timedelta
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+from dotenv import load_dotenv
+from database import supabase, iter_rows, upsert_row, request_loader, invalidate_reads
+from auth import invalidate_user_cache
+
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO)
+
+# Streak state is persisted on existing rows:
+#   users:         current_streak, longest_streak, longest_streak_end,
+#                  last_perfect_date, total_completed_days
+#   habit_streaks: current_streak, best_streak, best_streak_end,
+#                  last_completed_date, streak_started_date, total_completed_days
+# Run once in the Supabase SQL editor:
+#   ALTER TABLE users ADD COLUMN IF NOT EXISTS longest_streak INTEGER DEFAULT 0;
+#   ALTER TABLE users ADD COLUMN IF NOT EXISTS longest_streak_end DATE;
+#   ALTER TABLE users ADD COLUMN IF NOT EXISTS last_perfect_date DATE;
+#   ALTER TABLE users ADD COLUMN IF NOT EXISTS total_completed_days INTEGER DEFAULT 0;
+#   ALTER TABLE habit_streaks ADD COLUMN IF NOT EXISTS best_streak_end DATE;
+#   ALTER TABLE habit_streaks ADD COLUMN IF NOT EXISTS total_completed_days INTEGER DEFAULT 0;
+# Then, BEFORE deploying the write path that uses them, backfill every user
+# from check-in history (existing rows would otherwise read a streak of 0
+# and restart at 1 on the next check-in):
+#   python streak_engine.py recompute [user_id ...]
+
+HABIT_STREAK_COLUMNS = 'id, habit_id, current_streak, best_streak, best_streak_end, last_completed_date, total_completed_days'
+
+
+@dataclass(frozen=True)
+class StreakState:
+    """
+    Run-length streak state. `current_streak` is the length of the run
+    ending on `last_perfect_date`; use `effective_current` for display.
+    """
+    current_streak: int = 0
+    longest_streak: int = 0
+    longest_streak_end: Optional[str] = None
+    last_perfect_date: Optional[str] = None
+    total_perfect_days: int = 0
+
+    def effective_current(self, today: Optional[date] = None) -> int:
+        """Current streak as of today (a run ending yesterday is still alive)"""
+        if not self.last_perfect_date:
+            return 0
+        today = today or date.today()
+        last = date.fromisoformat(str(self.last_perfect_date))
+        return self.current_streak if (today - last).days <= 1 else 0
+
+    def current_start(self, today: Optional[date] = None) -> Optional[str]:
+        """First day of the live streak, if any"""
+        if not self.effective_current(today):
+            return None
+        last = date.fromisoformat(str(self.last_perfect_date))
+        return (last - timedelta(days=self.current_streak - 1)).strftime('%Y-%m-%d')
+
+    def longest_start(self) -> Optional[str]:
+        """First day of the longest run, if any"""
+        if not self.longest_streak_end:
+            return None
+        end = date.fromisoformat(str(self.longest_streak_end))
+        return (end - timedelta(days=self.longest_streak - 1)).strftime('%Y-%m-%d')
+
+
+def advance_state(state: StreakState, day: str, perfect: bool) -> Optional[StreakState]:
+    """
+    Apply a change to `day` in O(1). Returns the new state, or None when
+    the change rewrites history (backfill or un-completing the last
+    perfect day) and a full recompute is needed.
+    """
+    last = str(state.last_perfect_date) if state.last_perfect_date else None
+
+    if last is None or day > last:
+        if not perfect:
+            return state
+
+        gap = (date.fromisoformat(day) - date.fromisoformat(last)).days if last else None
+        current = state.current_streak + 1 if gap == 1 else 1
+
+        longest, longest_end = state.longest_streak, state.longest_streak_end
+        if current > longest:
+            longest, longest_end = current, day
+
+        return StreakState(
+            current_streak=current,
+            longest_streak=longest,
+            longest_streak_end=longest_end,
+            last_perfect_date=day,
+            total_perfect_days=state.total_perfect_days + 1
+        )
+
+    if day == last and perfect:
+        return state
+
+    return None
+
+
+def compute_state(perfect_days: Iterable[str]) -> StreakState:
+    """Build state from scratch from ascending perfect-day dates"""
+    state = StreakState()
+    for day in perfect_days:
+        state = advance_state(state, day, True) or state
+    return state
+
+
+def user_state_from_row(row: Optional[Dict[str, Any]]) -> StreakState:
+    row = row or {}
+    return StreakState(
+        current_streak=row.get('current_streak') or 0,
+        longest_streak=row.get('longest_streak') or 0,
+        longest_streak_end=row.get('longest_streak_end'),
+        last_perfect_date=row.get('last_perfect_date'),
+        total_perfect_days=row.get('total_completed_days') or 0
+    )
+
+
+def habit_state_from_row(row: Optional[Dict[str, Any]]) -> StreakState:
+    row = row or {}
+    return StreakState(
+        current_streak=row.get('current_streak') or 0,
+        longest_streak=row.get('best_streak') or 0,
+        longest_streak_end=row.get('best_streak_end'),
+        last_perfect_date=row.get('last_completed_date'),
+        total_perfect_days=row.get('total_completed_days') or 0
+    )
+
+
+def effective_streak(row: Optional[Dict[str, Any]], today: Optional[date] = None) -> int:
+    """Live streak from a `users` or `habit_streaks` row (select the date column too)"""
+    row = row or {}
+    return StreakState(
+        current_streak=row.get('current_streak') or 0,
+        last_perfect_date=row.get('last_perfect_date') or row.get('last_completed_date')
+    ).effective_current(today)
+
+
+class StreakEngine:
+    """Single source of truth for user and per-habit streaks"""
+
+    def __init__(self, supabase_client):
+        self.supabase = supabase_client
+
+    # ---------- reads ----------
+
+    async def get_user_state(self, user_id: int) -> StreakState:
+        # Full row via the request loader: usually already fetched by auth
+        row = await request_loader().select_one('users', {'id': user_id})
+        return user_state_from_row(row)
+
+    async def get_habit_states(self, user_id: int) -> Dict[int, StreakState]:
+        response = await self.supabase.table('habit_streaks').select(HABIT_STREAK_COLUMNS).eq(
+            'user_id', user_id
+        ).execute()
+        return {
+            row['habit_id']: habit_state_from_row(row)
+            for row in (response.data or [])
+        }
+
+    # ---------- writes ----------
+
+    async def record_checkin(
+        self, user_id: int, habit_id: int, date_str: str, completed: bool,
+        perfect: Optional[bool] = None
+    ) -> StreakState:
+        """
+        Update habit and user streaks after a check-in changed. Pass
+        `perfect` (e.g. from the day's summary row) to skip re-querying it.
+        """
+        await self.record_habit_checkin(user_id, habit_id, date_str, completed)
+        return await self.record_user_day(user_id, date_str, perfect)
+
+    async def record_user_day(
+        self, user_id: int, date_str: str, perfect: Optional[bool] = None
+    ) -> StreakState:
+        """Re-evaluate one day for the user-level streak"""
+        state = await self.get_user_state(user_id)
+        if perfect is None:
+            perfect = await self._is_perfect_day(user_id, date_str)
+
+        new_state = advance_state(state, date_str, perfect)
+        if new_state is None:
+            return await self.recompute_user(user_id)
+
+        if new_state != state:
+            await self._save_user_state(user_id, new_state)
+        return new_state
+
+    async def record_habit_checkin(
+        self, user_id: int, habit_id: int, date_str: str, completed: bool
+    ) -> StreakState:
+        """Re-evaluate one day for a single habit's streak"""
+        row_id, state = await self._get_habit_row(user_id, habit_id)
+
+        new_state = advance_state(state, date_str, completed)
+        if new_state is None:
+            return await self.recompute_habit(user_id, habit_id)
+
+        if new_state != state or row_id is None:
+            await self._save_habit_state(user_id, habit_id, new_state)
+        return new_state
+
+    async def record_batch(
+        self,
+        user_id: int,
+        checkins: Iterable[Tuple[int, str, bool]],
+        perfect_by_date: Dict[str, bool]
+    ) -> StreakState:
+        """
+        Apply many (habit_id, date, completed) changes at once: state is
+        read once, folded in date order, and only changed rows are saved.
+        """
+        habit_rows = await self._get_habit_rows(user_id)
+
+        by_habit: Dict[int, list] = {}
+        for habit_id, date_str, completed in checkins:
+            by_habit.setdefault(habit_id, []).append((date_str, completed))
+
+        for habit_id, changes in by_habit.items():
+            row_id, state = habit_rows.get(habit_id, (None, StreakState()))
+            new_state = state
+            for date_str, completed in sorted(changes):
+                new_state = advance_state(new_state, date_str, completed)
+                if new_state is None:
+                    break
+
+            if new_state is None:
+                await self.recompute_habit(user_id, habit_id)
+            elif new_state != state or row_id is None:
+                await self._save_habit_state(user_id, habit_id, new_state)
+
+        state = await self.get_user_state(user_id)
+        new_state = state
+        for date_str, perfect in sorted(perfect_by_date.items()):
+            new_state = advance_state(new_state, date_str, perfect)
+            if new_state is None:
+                return await self.recompute_user(user_id)
+
+        if new_state != state:
+            await self._save_user_state(user_id, new_state)
+        return new_state
+
+    async def recompute_user(self, user_id: int) -> StreakState:
+        """Full rebuild from check-in history (backfills, habit set changes)"""
+        habits_response = await self.supabase.table('habits').select('id').eq(
+            'user_id', user_id
+        ).execute()
+        habit_ids = {h['id'] for h in (habits_response.data or [])}
+
+        completed_by_date: Dict[str, set] = {}
+        if habit_ids:
+            async for checkin in iter_rows(
+                'checkins', {'user_id': user_id, 'completed': True}, columns='habit_id, date'
+            ):
+                completed_by_date.setdefault(str(checkin['date']), set()).add(checkin['habit_id'])
+
+        state = compute_state(
+            d for d, completed_ids in sorted(completed_by_date.items())
+            if habit_ids <= completed_ids
+        )
+        await self._save_user_state(user_id, state)
+        logging.info(f"Recomputed streak for user {user_id}: {state.current_streak} (longest {state.longest_streak})")
+        return state
+
+    async def recompute_habit(self, user_id: int, habit_id: int) -> StreakState:
+        """Full rebuild of one habit's streak from its check-ins"""
+        completed_days = []
+        async for checkin in iter_rows(
+            'checkins',
+            {'user_id': user_id, 'habit_id': habit_id, 'completed': True},
+            columns='date'
+        ):
+            completed_days.append(str(checkin['date']))
+
+        state = compute_state(sorted(set(completed_days)))
+        await self._save_habit_state(user_id, habit_id, state)
+        return state
+
+    async def recompute_all(self, user_ids: Optional[List[int]] = None) -> Dict[str, Any]:
+        """Recompute user and habit streaks for the given users (default: everyone)"""
+        results = {"users": 0, "habits": 0, "errors": []}
+
+        if user_ids is None:
+            user_ids = [u['id'] async for u in iter_rows('users', columns='id', order_by=('id',))]
+
+        for user_id in user_ids:
+            try:
+                await self.recompute_user(user_id)
+                habits_response = await self.supabase.table('habits').select('id').eq(
+                    'user_id', user_id
+                ).execute()
+                for habit in (habits_response.data or []):
+                    await self.recompute_habit(user_id, habit['id'])
+                    results["habits"] += 1
+                results["users"] += 1
+            except Exception as e:
+                logging.error(f"Error recomputing streaks for user {user_id}: {str(e)}")
+                results["errors"].append(f"User {user_id}: {str(e)}")
+
+        return results
+
+    # ---------- helpers ----------
+
+    async def _is_perfect_day(self, user_id: int, date_str: str) -> bool:
+        habits_response = await self.supabase.table('habits').select('id').eq(
+            'user_id', user_id
+        ).execute()
+        habit_ids = set(h['id'] for h in (habits_response.data or []))
+        if not habit_ids:
+            return False
+
+        checkins_response = await self.supabase.table('checkins').select('habit_id').eq(
+            'user_id', user_id
+        ).eq('date', date_str).eq('completed', True).execute()
+        completed_ids = set(c['habit_id'] for c in (checkins_response.data or []))
+
+        # Every current habit done; check-ins of deleted habits don't count
+        return habit_ids <= completed_ids
+
+    async def _get_habit_row(self, user_id: int, habit_id: int) -> Tuple[Optional[int], StreakState]:
+        response = await self.supabase.table('habit_streaks').select(HABIT_STREAK_COLUMNS).eq(
+            'user_id', user_id
+        ).eq('habit_id', habit_id).execute()
+        row = response.data[0] if response.data else None
+        return (row['id'] if row else None), habit_state_from_row(row)
+
+    async def _get_habit_rows(self, user_id: int) -> Dict[int, Tuple[int, StreakState]]:
+        response = await self.supabase.table('habit_streaks').select(HABIT_STREAK_COLUMNS).eq(
+            'user_id', user_id
+        ).execute()
+        return {
+            row['habit_id']: (row['id'], habit_state_from_row(row))
+            for row in (response.data or [])
+        }
+
+    async def _save_user_state(self, user_id: int, state: StreakState):
+        await self.supabase.table('users').update({
+            'current_streak': state.current_streak,
+            'longest_streak': state.longest_streak,
+            'longest_streak_end': state.longest_streak_end,
+            'last_perfect_date': state.last_perfect_date,
+            'total_completed_days': state.total_perfect_days
+        }).eq('id', user_id).execute()
+        invalidate_user_cache(user_id)
+        invalidate_reads('users')
+
+    async def _save_habit_state(self, user_id: int, habit_id: int, state: StreakState):
+        last = state.last_perfect_date
+        data = {
+            'current_streak': state.current_streak,
+            'best_streak': state.longest_streak,
+            'best_streak_end': state.longest_streak_end,
+            'last_completed_date': last,
+            'streak_started_date': (
+                date.fromisoformat(str(last)) - timedelta(days=state.current_streak - 1)
+            ).strftime('%Y-%m-%d') if last else None,
+            'total_completed_days': state.total_perfect_days,
+            'updated_at': datetime.now().isoformat()
+        }
+        await upsert_row('habit_streaks', {
+            'user_id': user_id,
+            'habit_id': habit_id,
+            **data
+        }, on_conflict='user_id,habit_id', client=self.supabase)
+
+
+# Singleton instance
+streak_engine = StreakEngine(supabase)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "recompute":
+        print("Usage: python streak_engine.py recompute [user_id ...]")
+        sys.exit(1)
+
+    ids = [int(arg) for arg in sys.argv[2:]] or None
+    print(asyncio.run(streak_engine.recompute_all(ids)))
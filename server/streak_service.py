@@ -3,6 +3,8 @@ import logging
 from datetime import datetime, date, timedelta
 from typing import Dict, Any, List, Optional
 from dotenv import load_dotenv
+from streak_engine import streak_engine
+from cache_tiers import dont_cache
 
 load_dotenv()
 
@@ -15,11 +17,11 @@ class StreakService:
     def __init__(self, supabase_client):
         self.supabase = supabase_client
     
-    def get_streak_details(self, user_id: int) -> Dict[str, Any]:
+    async def get_streak_details(self, user_id: int) -> Dict[str, Any]:
         """Get detailed streak information for a user"""
         try:
             # Get habits
-            habits_response = self.supabase.table('habits').select('*').eq(
+            habits_response = await self.supabase.table('habits').select('*').eq(
                 'user_id', user_id
             ).execute()
             habits = habits_response.data or []
@@ -28,84 +30,32 @@ class StreakService:
             if total_habits == 0:
                 return self._empty_streak_response()
             
-            # Get all checkins
-            checkins_response = self.supabase.table('checkins').select('*').eq(
-                'user_id', user_id
-            ).order('date', desc=True).execute()
-            checkins = checkins_response.data or []
-            
-            # Group checkins by date
-            checkins_by_date = {}
-            for checkin in checkins:
-                date_str = str(checkin['date'])
-                if date_str not in checkins_by_date:
-                    checkins_by_date[date_str] = {'completed': [], 'missed': []}
-                
-                habit = next((h for h in habits if h['id'] == checkin['habit_id']), None)
-                habit_name = habit['name'] if habit else f"Habit {checkin['habit_id']}"
-                
-                if checkin['completed']:
-                    checkins_by_date[date_str]['completed'].append(habit_name)
-                else:
-                    checkins_by_date[date_str]['missed'].append(habit_name)
-            
-            # Calculate current streak
             today = date.today()
-            current_streak = 0
-            streak_start_date = None
-            current_date = today
+            window_start = today - timedelta(days=29)
             
-            while True:
-                date_str = current_date.strftime('%Y-%m-%d')
-                
-                if date_str in checkins_by_date:
-                    completed_count = len(checkins_by_date[date_str]['completed'])
-                    if completed_count == total_habits:
-                        current_streak += 1
-                        streak_start_date = current_date
-                        current_date -= timedelta(days=1)
-                    else:
-                        break
-                else:
-                    if current_streak == 0 and current_date == today:
-                        # Today not completed yet, check yesterday
-                        current_date -= timedelta(days=1)
-                    else:
-                        break
+            # Streaks come from the incremental engine
+            streak = await streak_engine.get_user_state(user_id)
+            habit_states = await streak_engine.get_habit_states(user_id)
+            current_streak = streak.effective_current(today)
+            longest_streak = streak.longest_streak
             
-            # Calculate longest streak
-            longest_streak = 0
-            longest_streak_start = None
-            longest_streak_end = None
-            current_run = 0
-            run_start = None
+            # Only the 30-day window is read for history and rates
+            checkins_response = await self.supabase.table('checkins').select(
+                'habit_id, date, completed'
+            ).eq('user_id', user_id).gte(
+                'date', window_start.strftime('%Y-%m-%d')
+            ).lte('date', today.strftime('%Y-%m-%d')).execute()
             
-            if checkins_by_date:
-                all_dates = sorted(checkins_by_date.keys())
-                first_date = datetime.strptime(all_dates[0], '%Y-%m-%d').date()
-                last_date = datetime.strptime(all_dates[-1], '%Y-%m-%d').date()
+            checkins_by_date = {}
+            checkins_by_habit = {}
+            for checkin in (checkins_response.data or []):
+                date_str = str(checkin['date'])
+                if date_str not in checkins_by_date:
+                    checkins_by_date[date_str] = {'completed': set(), 'missed': set()}
+                checkins_by_habit.setdefault(checkin['habit_id'], []).append(checkin)
                 
-                check_date = first_date
-                while check_date <= last_date:
-                    date_str = check_date.strftime('%Y-%m-%d')
-                    
-                    if date_str in checkins_by_date:
-                        completed_count = len(checkins_by_date[date_str]['completed'])
-                        if completed_count == total_habits:
-                            if current_run == 0:
-                                run_start = check_date
-                            current_run += 1
-                            
-                            if current_run > longest_streak:
-                                longest_streak = current_run
-                                longest_streak_start = run_start
-                                longest_streak_end = check_date
-                        else:
-                            current_run = 0
-                    else:
-                        current_run = 0
-                    
-                    check_date += timedelta(days=1)
+                key = 'completed' if checkin['completed'] else 'missed'
+                checkins_by_date[date_str][key].add(checkin['habit_id'])
             
             # Calculate streak history (last 30 days)
             streak_history = []
@@ -133,26 +83,25 @@ class StreakService:
                 
                 streak_history.append(day_data)
             
-            # Calculate completion rate
-            total_possible = 0
-            total_completed = 0
-            
-            for date_str, data in checkins_by_date.items():
-                total_possible += total_habits
-                total_completed += len(data['completed'])
-            
+            # Calculate completion rate over the tracked days in the window
+            total_possible = len(checkins_by_date) * total_habits
+            total_completed = sum(len(d['completed']) for d in checkins_by_date.values())
             completion_rate = (total_completed / max(total_possible, 1)) * 100
             
             # Get per-habit streaks
             habit_streaks = []
             for habit in habits:
-                habit_streak = self._calculate_habit_streak(habit['id'], checkins)
+                habit_state = habit_states.get(habit['id'])
+                habit_checkins = checkins_by_habit.get(habit['id'], [])
+                habit_completed = len([c for c in habit_checkins if c['completed']])
                 habit_streaks.append({
                     'id': habit['id'],
                     'name': habit['name'],
-                    'current_streak': habit_streak['current'],
-                    'longest_streak': habit_streak['longest'],
-                    'completion_rate': habit_streak['rate']
+                    'current_streak': habit_state.effective_current(today) if habit_state else 0,
+                    'longest_streak': habit_state.longest_streak if habit_state else 0,
+                    'completion_rate': round(
+                        (habit_completed / max(len(habit_checkins), 1)) * 100, 1
+                    )
                 })
             
             # Determine streak status
@@ -181,10 +130,10 @@ class StreakService:
             return {
                 'current_streak': current_streak,
                 'longest_streak': longest_streak,
-                'streak_start_date': streak_start_date.strftime('%Y-%m-%d') if streak_start_date else None,
+                'streak_start_date': streak.current_start(today),
                 'longest_streak_period': {
-                    'start': longest_streak_start.strftime('%Y-%m-%d') if longest_streak_start else None,
-                    'end': longest_streak_end.strftime('%Y-%m-%d') if longest_streak_end else None,
+                    'start': streak.longest_start(),
+                    'end': str(streak.longest_streak_end) if streak.longest_streak_end else None,
                     'days': longest_streak
                 },
                 'status': status,
@@ -201,70 +150,9 @@ class StreakService:
             logging.error(f"Error getting streak details: {str(e)}")
             import traceback
             traceback.print_exc()
+            dont_cache()
             return self._empty_streak_response()
     
-    def _calculate_habit_streak(
-        self, habit_id: int, all_checkins: List[Dict]
-    ) -> Dict[str, Any]:
-        """Calculate streak for a specific habit"""
-        habit_checkins = [c for c in all_checkins if c['habit_id'] == habit_id]
-        
-        if not habit_checkins:
-            return {'current': 0, 'longest': 0, 'rate': 0}
-        
-        # Sort by date descending
-        habit_checkins.sort(key=lambda x: x['date'], reverse=True)
-        
-        # Calculate current streak
-        current_streak = 0
-        today = date.today()
-        current_date = today
-        
-        completed_dates = set(
-            str(c['date']) for c in habit_checkins if c['completed']
-        )
-        
-        while True:
-            date_str = current_date.strftime('%Y-%m-%d')
-            if date_str in completed_dates:
-                current_streak += 1
-                current_date -= timedelta(days=1)
-            else:
-                if current_streak == 0 and current_date == today:
-                    current_date -= timedelta(days=1)
-                else:
-                    break
-        
-        # Calculate longest streak
-        all_dates = sorted(set(str(c['date']) for c in habit_checkins))
-        longest_streak = 0
-        current_run = 0
-        
-        if all_dates:
-            first_date = datetime.strptime(all_dates[0], '%Y-%m-%d').date()
-            last_date = datetime.strptime(all_dates[-1], '%Y-%m-%d').date()
-            
-            check_date = first_date
-            while check_date <= last_date:
-                date_str = check_date.strftime('%Y-%m-%d')
-                if date_str in completed_dates:
-                    current_run += 1
-                    longest_streak = max(longest_streak, current_run)
-                else:
-                    current_run = 0
-                check_date += timedelta(days=1)
-        
-        # Calculate completion rate
-        total_checkins = len(habit_checkins)
-        completed_checkins = len([c for c in habit_checkins if c['completed']])
-        rate = (completed_checkins / max(total_checkins, 1)) * 100
-        
-        return {
-            'current': current_streak,
-            'longest': longest_streak,
-            'rate': round(rate, 1)
-        }
-    
     def _get_streak_milestones(
         self, current_streak: int, longest_streak: int
     ) -> List[Dict[str, Any]]:
@@ -318,14 +206,14 @@ class StreakService:
             'next_milestone': {'days': 3, 'days_remaining': 3, 'progress': 0}
         }
     
-    def check_streak_at_risk(self, user_id: int) -> Dict[str, Any]:
+    async def check_streak_at_risk(self, user_id: int) -> Dict[str, Any]:
         """Check if user's streak is at risk today"""
         try:
             today = date.today()
             today_str = today.strftime('%Y-%m-%d')
             
             # Get habits
-            habits_response = self.supabase.table('habits').select('*').eq(
+            habits_response = await self.supabase.table('habits').select('*').eq(
                 'user_id', user_id
             ).execute()
             habits = habits_response.data or []
@@ -335,7 +223,7 @@ class StreakService:
                 return {'at_risk': False, 'reason': 'No habits'}
             
             # Get today's checkins
-            checkins_response = self.supabase.table('checkins').select('*').eq(
+            checkins_response = await self.supabase.table('checkins').select('*').eq(
                 'user_id', user_id
             ).eq('date', today_str).eq('completed', True).execute()
             
@@ -343,7 +231,7 @@ class StreakService:
             incomplete_today = total_habits - completed_today
             
             # Get current streak
-            streak_details = self.get_streak_details(user_id)
+            streak_details = await self.get_streak_details(user_id)
             current_streak = streak_details['current_streak']
             
             # Check if at risk
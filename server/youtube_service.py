@@ -1,10 +1,14 @@
 # server/youtube_service.py
 import os
+import asyncio
 import logging
 from typing import List, Dict, Optional
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from dotenv import load_dotenv
+from cache import cached
+from cache_tiers import dont_cache
+from metrics import external_call
 
 load_dotenv()
 
@@ -44,7 +48,8 @@ def search_habit_videos(
             safeSearch='strict'
         )
         
-        response = request.execute()
+        with external_call("youtube"):
+            response = request.execute()
         
         videos = []
         for item in response.get('items', []):
@@ -78,7 +83,8 @@ def get_video_details(video_id: str) -> Optional[Dict]:
             id=video_id
         )
         
-        response = request.execute()
+        with external_call("youtube"):
+            response = request.execute()
         
         if not response.get('items'):
             return None
@@ -205,6 +211,52 @@ def get_learning_path_videos(difficulty: str = "beginner") -> Dict:
         return {"difficulty": difficulty, "modules": []}
 
 
+# ============================================
+# CACHED ACCESSORS (async)
+# ============================================
+# Search results change slowly, so routes go through these: one YouTube
+# call per key per worker, refreshed in the background, with the blocking
+# client run in a thread. Empty results (API errors, quota) aren't kept.
+
+@cached(ttl_seconds=6 * 3600, key_prefix="videos", stale_ttl=24 * 3600)
+async def search_habit_videos_cached(
+    query: str,
+    max_results: int = 5,
+    category: Optional[str] = None
+) -> List[Dict]:
+    videos = await asyncio.to_thread(search_habit_videos, query, max_results, category)
+    if not videos:
+        dont_cache()
+    return videos
+
+
+@cached(ttl_seconds=6 * 3600, key_prefix="videos", stale_ttl=24 * 3600)
+async def get_recommended_videos_for_habit_cached(habit_name: str, max_results: int = 3) -> List[Dict]:
+    videos = await asyncio.to_thread(get_recommended_videos_for_habit, habit_name, max_results)
+    if not videos:
+        dont_cache()
+    return videos
+
+
+@cached(ttl_seconds=3 * 3600, key_prefix="videos", stale_ttl=24 * 3600)
+async def get_daily_video_recommendation_cached(
+    current_streak: int,
+    completion_rate: float,
+    time_of_day: str = "morning"
+) -> Optional[Dict]:
+    return await asyncio.to_thread(
+        get_daily_video_recommendation, current_streak, completion_rate, time_of_day
+    )
+
+
+@cached(ttl_seconds=24 * 3600, key_prefix="videos", stale_ttl=24 * 3600)
+async def get_learning_path_videos_cached(difficulty: str = "beginner") -> Dict:
+    path = await asyncio.to_thread(get_learning_path_videos, difficulty)
+    if not any(module.get("videos") for module in path.get("modules", [])):
+        dont_cache()
+    return path
+
+
 # Curated high-quality channels for habit building
 RECOMMENDED_CHANNELS = [
     {